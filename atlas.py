@@ -0,0 +1,145 @@
+## Micrograph atlas for the makesum report
+##
+## One row per micrograph: the binned micrograph, its power spectrum and the Gctf / ctffind
+## diagnostic image ( <stem>.ctf ) next to the fitted values, worst micrographs first. Every page
+## is made by its own process: the micrographs are memory mapped and transformed once, that one
+## transform gives the Fourier binned thumbnail and the block averaged power spectrum, and the
+## page is drawn to a PNG. The PNGs are then put together as the pages of one PDF.
+
+import os, multiprocessing, shutil, tempfile
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+import matplotlib.image
+import mrcheader, nativectf, nativemotion
+
+THUMBNAIL = 512
+SPECTRUM_BOX = 512
+ROWS_PER_PAGE = 4
+PAGE_SIZE = ( 8.27, 11.69 )
+PAGE_DPI = 100
+## sort key : ( table field, worst first )
+ORDERS = { 'res' : ( 'resolution', True ), 'cc' : ( 'ccc', False ) }
+
+def fourier_bin ( spectrum, ny, nx, size=THUMBNAIL ) :
+    ## the image of an rfft2, spectrum cropped so the longer side is about size pixels
+    factor = max ( 1.0, max ( ny, nx ) / float ( size ) )
+    by = max ( 2, int ( ny / factor ) // 2 * 2 )
+    bx = max ( 2, int ( nx / factor ) // 2 * 2 )
+    return np.fft.irfft2( nativemotion.crop_spectrum( spectrum, by, bx ), s=( by, bx ) ).astype( np.float32 )
+
+def binned_power ( spectrum, box=SPECTRUM_BOX ) :
+    ## the power of a whole micrograph rfft2 averaged in blocks down to the rfft2 shape of a box,
+    ## as smooth as averaging tiles and without a second transform
+    power = np.fft.fftshift( spectrum.real ** 2 + spectrum.imag ** 2, axes=0 )
+    ny, nh = power.shape
+    box = min ( box, ny - ny % 2, 2 * ( nh - 1 ) )
+    fy, fx = ny // box, ( nh - 1 ) // ( box // 2 )
+    y0 = ny // 2 - fy * box // 2
+    power = power[y0:y0 + fy * box, :fx * ( box // 2 )].reshape( box, fy, box // 2, fx ).mean( axis=( 1, 3 ) )
+    power = np.concatenate( ( power, power[:, -1:] ), axis=1 )
+    return np.fft.ifftshift( power, axes=0 ), box
+
+def full_spectrum ( half ) :
+    ## centred box x box image of an rfft2 half
+    box = half.shape[0]
+    negative = half[ ( -np.arange( box ) ) % box, 1:box // 2 ][:, ::-1]
+    return np.fft.fftshift( np.concatenate( ( half, negative ), axis=1 )[:, :box] )
+
+def to_bytes ( image, sigma=3.0 ) :
+    ## uint8 with the contrast stretched to mean +- sigma standard deviations
+    image = np.asarray( image, dtype=np.float32 )
+    mean, std = float ( image.mean() ), float ( image.std() ) or 1.0
+    scaled = ( image - ( mean - sigma * std ) ) / ( 2 * sigma * std )
+    return ( np.clip( scaled, 0, 1 ) * 255 ).astype( np.uint8 )
+
+def read_panels ( micrograph, ctf_image ) :
+    ## ( thumbnail, power spectrum, ctf image ) as uint8, None for what can not be read
+    thumbnail = spectrum = diagnostic = None
+    try :
+        image = mrcheader.read_image( micrograph )
+        transform = np.fft.rfft2( image )
+        thumbnail = to_bytes( fourier_bin( transform, image.shape[0], image.shape[1] ) )
+        ## background removed, so the Thon rings have the same contrast out to Nyquist
+        half, box = binned_power( transform )
+        spectrum = to_bytes( full_spectrum( nativectf.flatten_spectrum( half, box )[0] ), 2.0 )
+    except ( IOError, OSError, ValueError ) :
+        pass
+    if ctf_image and os.path.exists( ctf_image ) :
+        try :
+            diagnostic = to_bytes( mrcheader.read_image( ctf_image ) )
+        except ( IOError, OSError, ValueError ) :
+            pass
+    return thumbnail, spectrum, diagnostic
+
+def describe ( row ) :
+    return '%s\nDefocus U %.0f  V %.0f A  angle %.1f\nResolution %.2f A   CC %.3f' % ( row['name'], row['defocus_u'], row['defocus_v'],
+                                                                                 row['defocus_angle'], row['resolution'], row['ccc'] )
+
+def draw_page ( job ) :
+    ## one page as a PNG, returns its filename
+    filename, rows, number, pages = job
+    figure = Figure( figsize=PAGE_SIZE )
+    FigureCanvasAgg( figure )
+    for j, title in enumerate ( ( 'Micrograph', 'Power spectrum', 'CTF fit' ) ) :
+        figure.text( 0.18 + j * 0.32, 0.98, title, ha='center', va='top', fontsize=10 )
+    for i, row in enumerate ( rows ) :
+        panels = read_panels( row['micrograph'], row['ctf_image'] )
+        for j, panel in enumerate ( panels ) :
+            ax = figure.add_axes( [ 0.03 + j * 0.32, 0.955 - ( i + 1 ) * 0.235 + 0.01, 0.3, 0.17 ] )
+            ax.set_xticks( () )
+            ax.set_yticks( () )
+            if panel is None :
+                ax.text( 0.5, 0.5, 'not available', ha='center', va='center', fontsize=8 )
+            else :
+                ax.imshow( panel, cmap='gray', vmin=0, vmax=255, origin='lower', interpolation='nearest', aspect='equal' )
+        figure.text( 0.03, 0.955 - i * 0.235, describe( row ), fontsize=7, va='top', family='monospace' )
+    figure.text( 0.5, 0.01, '%d / %d' % ( number, pages ), ha='center', fontsize=7 )
+    figure.savefig( filename, dpi=PAGE_DPI )
+    return filename
+
+def atlas_rows ( results, micrographs, ctf_images, order='res' ) :
+    ## the rows of a ctflog table in atlas order, with the files of every micrograph
+    field, worst_first = ORDERS[order]
+    values = np.nan_to_num( results[field] )
+    index = np.argsort( values, kind='mergesort' )
+    if worst_first :
+        index = index[::-1]
+    rows = []
+    for i in index :
+        row = dict ( ( name, float ( results[name][i] ) ) for name in ( 'defocus_u', 'defocus_v', 'defocus_angle', 'resolution', 'ccc' ) )
+        row.update( name=str ( results['micrograph'][i] ), micrograph=micrographs[i], ctf_image=ctf_images[i] )
+        if 'estimator' in results.dtype.names :
+            row['name'] += '  ( ' + str ( results['estimator'][i] ) + ' )'
+        rows.append( row )
+    return rows
+
+def write_atlas ( filename, results, micrographs, ctf_images, order='res', processes=None, per_page=ROWS_PER_PAGE ) :
+    ## results: ctflog table, micrographs / ctf_images: the files of its rows
+    if processes is None :
+        processes = multiprocessing.cpu_count()
+    rows = atlas_rows( results, micrographs, ctf_images, order )
+    if not rows :
+        return None
+    tmpdir = tempfile.mkdtemp( prefix='atlas_', dir=os.path.dirname( os.path.abspath( filename ) ) )
+    try :
+        pages = [ rows[i:i + per_page] for i in range ( 0, len ( rows ), per_page ) ]
+        jobs = [ ( os.path.join( tmpdir, 'page%06d.png' % ( i + 1 ) ), page, i + 1, len ( pages ) ) for i, page in enumerate ( pages ) ]
+        pool = multiprocessing.Pool( max ( 1, min ( int ( processes ), len ( jobs ) ) ) )
+        try :
+            pngs = pool.map( draw_page, jobs, chunksize=1 )
+        finally :
+            pool.close()
+            pool.join()
+        part = filename + '.part'
+        with PdfPages( part ) as pdf :
+            for png in pngs :
+                figure = Figure( figsize=PAGE_SIZE )
+                FigureCanvasAgg( figure )
+                figure.figimage( matplotlib.image.imread( png ), origin='upper' )
+                pdf.savefig( figure, dpi=PAGE_DPI )
+        os.rename( part, filename )
+    finally :
+        shutil.rmtree( tmpdir, ignore_errors=True )
+    return filename
@@ -0,0 +1,148 @@
+## Facility catalog of CTF sessions ( SQLite )
+##
+## Every makesum run adds its session: who, which microscope, the optics, when, and the CTF of
+## every micrograph. The sums the statistics need ( count, sum and sum of squares of resolution
+## and defocus, best and worst ) are kept on the session row when it is added, so statistics per
+## microscope, user or month only read the session rows. Counts below a resolution use the
+## ( session, resolution ) index of the micrograph rows and never read the rows themselves.
+
+import os, time, sqlite3
+import numpy as np
+
+CATALOG = os.path.expanduser( '~/.em_catalog.sqlite' )
+GOOD_RESOLUTION = 4.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id             INTEGER PRIMARY KEY,
+    timestamp      TEXT,
+    datadir        TEXT,
+    started        REAL,
+    user           TEXT,
+    microscope     TEXT,
+    magnification  TEXT,
+    pixel_size     REAL,
+    kv             REAL,
+    cs             REAL,
+    estimator      TEXT,
+    command        TEXT,
+    micrographs    INTEGER,
+    resolution_n   INTEGER,
+    resolution_sum REAL,
+    resolution_sq  REAL,
+    resolution_min REAL,
+    resolution_max REAL,
+    defocus_n      INTEGER,
+    defocus_sum    REAL,
+    defocus_sq     REAL,
+    UNIQUE ( timestamp, datadir )
+);
+CREATE INDEX IF NOT EXISTS sessions_by_microscope ON sessions ( microscope, started );
+CREATE INDEX IF NOT EXISTS sessions_by_user ON sessions ( user, started );
+CREATE INDEX IF NOT EXISTS sessions_by_date ON sessions ( started );
+CREATE TABLE IF NOT EXISTS micrographs (
+    session       INTEGER,
+    name          TEXT,
+    estimator     TEXT,
+    defocus_u     REAL,
+    defocus_v     REAL,
+    defocus_angle REAL,
+    ccc           REAL,
+    resolution    REAL
+);
+CREATE INDEX IF NOT EXISTS micrographs_by_session ON micrographs ( session, resolution );
+"""
+
+## --by of the queries : SQL of the group
+GROUPS = { 'microscope' : 'microscope', 'user' : 'user', 'session' : 'timestamp',
+           'day' : "strftime('%Y-%m-%d', started, 'unixepoch', 'localtime')",
+           'month' : "strftime('%Y-%m', started, 'unixepoch', 'localtime')",
+           'year' : "strftime('%Y', started, 'unixepoch', 'localtime')" }
+
+def open_catalog ( path=CATALOG ) :
+    directory = os.path.dirname( os.path.abspath( path ) )
+    if not os.path.isdir( directory ) :
+        os.makedirs( directory )
+    db = sqlite3.connect( path, timeout=60 )
+    db.execute( 'PRAGMA journal_mode=WAL' )
+    db.execute( 'PRAGMA synchronous=NORMAL' )
+    db.executescript( SCHEMA )
+    return db
+
+def sums ( values ) :
+    ## ( n, sum, sum of squares, min, max ) of the finite values
+    values = np.asarray( values, dtype=np.float64 )
+    values = values[ np.isfinite( values ) ]
+    if len ( values ) == 0 :
+        return 0, 0.0, 0.0, None, None
+    return len ( values ), float ( values.sum() ), float ( ( values * values ).sum() ), float ( values.min() ), float ( values.max() )
+
+def add_session ( db, timestamp, results, estimator, datadir='', started=None, user='', microscope='', magnification='',
+                  pixel_size=0, kv=0, cs=0, command='' ) :
+    ## results: a ctflog table. A session added again ( --resume ) replaces the old one
+    if started is None :
+        started = time.time()
+    n_res, res_sum, res_sq, res_min, res_max = sums( results['resolution'] )
+    n_def, def_sum, def_sq = sums( ( results['defocus_u'] + results['defocus_v'] ) / 2 )[:3]
+    if 'estimator' in results.dtype.names :
+        estimators = [ str ( e ) for e in results['estimator'] ]
+    else :
+        estimators = [ estimator ] * len ( results )
+    with db :
+        old = db.execute( 'SELECT id, started FROM sessions WHERE timestamp = ? AND datadir = ?', ( timestamp, datadir ) ).fetchone()
+        if old is not None :
+            db.execute( 'DELETE FROM micrographs WHERE session = ?', ( old[0], ) )
+            db.execute( 'DELETE FROM sessions WHERE id = ?', ( old[0], ) )
+            started = old[1]
+        cursor = db.execute( 'INSERT INTO sessions ( timestamp, datadir, started, user, microscope, magnification, pixel_size, kv, cs, '
+                             'estimator, command, micrographs, resolution_n, resolution_sum, resolution_sq, resolution_min, '
+                             'resolution_max, defocus_n, defocus_sum, defocus_sq ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )',
+                             ( timestamp, datadir, started, user, microscope, str ( magnification ), float ( pixel_size ), float ( kv ),
+                               float ( cs ), estimator, command, len ( results ), n_res, res_sum, res_sq, res_min, res_max,
+                               n_def, def_sum, def_sq ) )
+        session = cursor.lastrowid
+        db.executemany( 'INSERT INTO micrographs ( session, name, estimator, defocus_u, defocus_v, defocus_angle, ccc, resolution ) '
+                        'VALUES ( ?, ?, ?, ?, ?, ?, ?, ? )',
+                        zip( [ session ] * len ( results ), [ str ( m ) for m in results['micrograph'] ], estimators,
+                             *[ [ None if np.isnan( v ) else float ( v ) for v in results[field] ]
+                                for field in ( 'defocus_u', 'defocus_v', 'defocus_angle', 'ccc', 'resolution' ) ] ) )
+    return session
+
+def where ( microscope=None, user=None, start=None, end=None ) :
+    ## SQL condition on the sessions and its parameters, start / end are seconds since the epoch
+    conditions = []
+    parameters = []
+    for column, value in ( ( 'microscope', microscope ), ( 'user', user ) ) :
+        if value is not None :
+            conditions.append( column + ' = ?' )
+            parameters.append( value )
+    if start is not None :
+        conditions.append( 'started >= ?' )
+        parameters.append( start )
+    if end is not None :
+        conditions.append( 'started < ?' )
+        parameters.append( end )
+    return ' AND '.join( conditions ) or '1', parameters
+
+def statistics ( db, by='microscope', better=GOOD_RESOLUTION, **filters ) :
+    ## one dict per group: sessions, micrographs, mean / std / best / worst resolution, mean and
+    ## std of the defocus and how many micrographs are better than `better` A
+    group = GROUPS[by]
+    condition, parameters = where( **filters )
+    rows = db.execute( 'SELECT ' + group + ', count(*), sum(micrographs), sum(resolution_n), sum(resolution_sum), sum(resolution_sq), '
+                       'min(resolution_min), max(resolution_max), sum(defocus_n), sum(defocus_sum), sum(defocus_sq) '
+                       'FROM sessions WHERE ' + condition + ' GROUP BY 1 ORDER BY 1', parameters ).fetchall()
+    counts = dict ( db.execute( 'SELECT ' + group + ', sum( ( SELECT count(*) FROM micrographs m WHERE m.session = sessions.id AND m.resolution <= ? ) ) '
+                                'FROM sessions WHERE ' + condition + ' GROUP BY 1', [ float ( better ) ] + parameters ).fetchall() )
+    stats = []
+    for key, sessions, micrographs, n_res, res_sum, res_sq, res_min, res_max, n_def, def_sum, def_sq in rows :
+        stats.append( dict ( group=key, sessions=sessions, micrographs=micrographs or 0,
+                             resolution=mean_std( n_res, res_sum, res_sq ), best=res_min, worst=res_max,
+                             defocus=mean_std( n_def, def_sum, def_sq ), better=counts.get( key, 0 ) ) )
+    return stats
+
+def mean_std ( n, total, squares ) :
+    if not n :
+        return None, None
+    mean = total / n
+    return mean, max ( 0.0, squares / n - mean * mean ) ** 0.5
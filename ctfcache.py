@@ -0,0 +1,197 @@
+## Gctf results shared by makesum.py, makesum_batch.py, quick2d.py and quick3d.py
+##
+## Every script runs Gctf in its own work directory, so the same micrographs went through it once
+## per script. The outputs of a run ( <stem>_gctf.log and <stem>.ctf ) are now also kept in a
+## cache directory shared by all of them ( $EM_CTF_CACHE, default ~/.cache/emctf, no to switch it
+## off ), under a key made of the content of the micrograph and the Gctf arguments. A script looks
+## its micrographs up first and only sends the misses to Gctf.
+##
+## The content of a micrograph is its size and a sha1 of its header and SAMPLE_BLOCKS blocks spread
+## over the file, so a copy of the data ( or a link to it ) hits the same entry. The digest is kept
+## in an SQLite index by device, inode, size and mtime: a file that was seen before is only stat'ed.
+## The arguments are those of the Gctf command of the script without the micrographs, the GPU id
+## and the output star, a change of --apix, --kV, --cs, --ac, --boxsize, --resH ... is a miss.
+
+import os, hashlib, shutil, sqlite3
+from multiprocessing.pool import ThreadPool
+import ctflog, ctfjobs
+
+CACHE_DIR = os.environ.get( 'EM_CTF_CACHE', os.path.expanduser( '~/.cache/emctf' ) )
+INDEX = 'index.sqlite'
+SAMPLE_BLOCKS = 8
+BLOCK_BYTES = 65536
+HASH_THREADS = 8
+OUTPUTS = { 'gctf' : ( '_gctf.log', '.ctf' ) }
+## the arguments of the command that name the files and the GPU of a batch
+BATCH_OPTIONS = ( '--gid', '--ctfstar' )
+PLACEHOLDER = '@micrograph@'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    device  INTEGER,
+    inode   INTEGER,
+    size    INTEGER,
+    mtime   INTEGER,
+    digest  TEXT,
+    PRIMARY KEY ( device, inode )
+);
+"""
+
+def enabled ( cache_dir=CACHE_DIR ) :
+    return cache_dir not in ( '', 'no' )
+
+def command_key ( make_command ) :
+    ## the arguments of a gpudispatch make_command that change the result: the command of a one
+    ## micrograph batch without the micrograph, the GPU and the output star, numbers as floats
+    args = make_command( [ PLACEHOLDER ], 0, 0 ).split()
+    kept = []
+    skip = False
+    for arg in args :
+        if skip or arg == PLACEHOLDER :
+            skip = False
+            continue
+        if arg in BATCH_OPTIONS :
+            skip = True
+            continue
+        try :
+            arg = repr ( float ( arg ) )
+        except ValueError :
+            pass
+        kept.append( arg )
+    return ' '.join( kept )
+
+def content_digest ( path ) :
+    ## sha1 of the size, the first block and SAMPLE_BLOCKS blocks spread over the file
+    h = hashlib.sha1()
+    with open( path, 'rb' ) as f :
+        size = os.fstat( f.fileno() ).st_size
+        h.update( str ( size ).encode() )
+        offsets = [ 0 ] + [ i * max ( 0, size - BLOCK_BYTES ) // SAMPLE_BLOCKS for i in range ( 1, SAMPLE_BLOCKS + 1 ) ]
+        for offset in offsets :
+            f.seek( offset )
+            h.update( f.read( BLOCK_BYTES ) )
+    return h.hexdigest()
+
+def open_index ( cache_dir=CACHE_DIR ) :
+    if not os.path.isdir( cache_dir ) :
+        os.makedirs( cache_dir )
+    db = sqlite3.connect( os.path.join( cache_dir, INDEX ), timeout=60 )
+    db.execute( 'PRAGMA journal_mode=WAL' )
+    db.execute( 'PRAGMA synchronous=NORMAL' )
+    db.executescript( SCHEMA )
+    return db
+
+def fingerprints ( paths, cache_dir=CACHE_DIR, threads=HASH_THREADS ) :
+    ## { path : content digest }, only the files the index does not know ( or that changed ) are read
+    db = open_index( cache_dir )
+    try :
+        stats = {}
+        for path in paths :
+            try :
+                st = os.stat( path )
+            except OSError :
+                continue
+            stats[path] = ( st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns )
+        known = dict ( ( ( d, i ), ( s, m, digest ) ) for d, i, s, m, digest in db.execute( 'SELECT device, inode, size, mtime, digest FROM files' ) )
+        digests = {}
+        todo = []
+        for path, ( device, inode, size, mtime ) in stats.items() :
+            row = known.get( ( device, inode ) )
+            if row is not None and row[:2] == ( size, mtime ) :
+                digests[path] = row[2]
+            else :
+                todo.append( path )
+        if todo :
+            pool = ThreadPool( max ( 1, min ( threads, len ( todo ) ) ) )
+            try :
+                new = pool.map( _digest, todo )
+            finally :
+                pool.close()
+                pool.join()
+            new = [ ( path, digest ) for path, digest in zip( todo, new ) if digest ]
+            with db :
+                db.executemany( 'INSERT OR REPLACE INTO files ( device, inode, size, mtime, digest ) VALUES ( ?, ?, ?, ?, ? )',
+                                [ stats[path] + ( digest, ) for path, digest in new ] )
+            digests.update( new )
+        return digests
+    finally :
+        db.close()
+
+def _digest ( path ) :
+    try :
+        return content_digest( path )
+    except ( IOError, OSError ) :
+        return ''
+
+def entry ( digest, key, cache_dir=CACHE_DIR ) :
+    ## the path of a cache entry without its suffix
+    name = hashlib.sha1( ( digest + ' ' + key ).encode( 'utf-8' ) ).hexdigest()
+    return os.path.join( cache_dir, name[:2], name )
+
+def output_stem ( micrograph, directory ) :
+    ## where Gctf writes the outputs of a micrograph: next to it, or in directory
+    return os.path.join( directory, ctfjobs.ctf_stem( micrograph ) )
+
+def _place ( source, target ) :
+    ## a hard link when it is the same file system, a copy otherwise, never half a file
+    part = target + '.part'
+    try :
+        os.link( source, part )
+    except OSError :
+        shutil.copyfile( source, part )
+    os.rename( part, target )
+
+def restore ( micrographs, key, estimator='gctf', directory='.', cache_dir=CACHE_DIR ) :
+    ## the outputs of the micrographs that are in the cache are put in directory, returns those
+    if not enabled( cache_dir ) or not micrographs :
+        return []
+    try :
+        digests = fingerprints( micrographs, cache_dir )
+    except ( IOError, OSError, sqlite3.Error ) :
+        return []
+    hits = []
+    for micrograph in micrographs :
+        if micrograph not in digests :
+            continue
+        source = entry( digests[micrograph], key, cache_dir )
+        target = output_stem( micrograph, directory )
+        if not all ( os.path.exists( source + suffix ) for suffix in OUTPUTS[estimator] ) :
+            continue
+        try :
+            for suffix in OUTPUTS[estimator] :
+                _place( source + suffix, target + suffix )
+        except ( IOError, OSError ) :
+            continue
+        hits.append( micrograph )
+    return hits
+
+def store ( micrographs, key, estimator='gctf', directory='.', cache_dir=CACHE_DIR ) :
+    ## the finished outputs of the micrographs go to the cache, returns how many
+    if not enabled( cache_dir ) or not micrographs :
+        return 0
+    try :
+        digests = fingerprints( micrographs, cache_dir )
+    except ( IOError, OSError, sqlite3.Error ) :
+        return 0
+    stored = 0
+    for micrograph in micrographs :
+        source = output_stem( micrograph, directory )
+        suffixes = OUTPUTS[estimator]
+        if micrograph not in digests or not all ( os.path.exists( source + suffix ) for suffix in suffixes ) :
+            continue
+        ## a log without a result ( Gctf crashed ) is not kept
+        try :
+            if ctflog.PARSERS[estimator]( source + suffixes[0] ) is None :
+                continue
+        except ( IOError, OSError, ValueError, IndexError ) :
+            continue
+        target = entry( digests[micrograph], key, cache_dir )
+        try :
+            if not os.path.isdir( os.path.dirname( target ) ) :
+                os.makedirs( os.path.dirname( target ) )
+            for suffix in reversed ( suffixes ) :
+                _place( source + suffix, target + suffix )
+        except ( IOError, OSError ) :
+            continue
+        stored += 1
+    return stored
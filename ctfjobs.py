@@ -0,0 +1,75 @@
+## The command lines of Gctf and ctffind4
+##
+## For gpudispatch: every function returns a make_command ( batch, slot, batch_number ) that
+## gives the shell command of one batch, Gctf on one GPU or ctffind4 on one cpu. makesum.py and
+## makesum_batch.py use the same commands. A make_command also takes the defocus search of the
+## batch, ( low, high, step ) in A or None for the full search ( see defocuswindow ).
+
+import os, stat
+
+## the full defocus search ( A ): Gctf's own defaults, what makesum always gave ctffind4
+GCTF_DEFOCUS = ( 5000, 90000, 500 )
+CTFFIND4_DEFOCUS = ( 5000, 50000, 500 )
+
+def ctf_stem ( micrograph ) :
+    ## the name of the outputs of a micrograph, for Gctf, ctffind4 and the native estimator alike:
+    ## dir/Grid1.sq2_0001.mrc -> Grid1.sq2_0001
+    return os.path.splitext( os.path.basename( micrograph ) )[0]
+
+def gctf_commands ( pixel_size, cs, kv, negative ) :
+    ## the Gctf command of one batch on one GPU, for gpudispatch
+    if float (pixel_size)  > 3 :
+        resH = 2 * float (pixel_size)
+        B_resH = 9.00
+    else :
+        resH = 4
+        B_resH = 7.00
+    if ( negative == 1 ) :
+        box = ' '
+        ac = ' --ac 0.35 '
+    else :
+        box = ' --boxsize 512 '
+        ac = ' --ac 0.07 '
+
+    def gctf_command ( batch, gpu, number, defocus=None ) :
+        star = 'gpu' + str (gpu) + '_' + str (number) + '.star'
+        args = 'Gctf --apix '+ str(pixel_size)+ ' --kV ' + str(kv) +' --cs ' + str(cs) + ' ' + ' '.join(batch) \
+               + ' --gid ' + str(gpu) + ' --do_validation' + ' --resH ' + str(resH) + ' --B_resH ' + str(B_resH) \
+               + box + ac + ' --ctfstar ' + star
+        if defocus is not None :
+            args += ' --defL %d --defH %d --defS %d' % tuple ( defocus )
+               #+ ' --ac 0.07 --do_EPA  --boxsize 512 --do_Hres_ref --Href_resL 20'
+        return args
+    return gctf_command
+
+def ctffind4_commands ( pixel_size, cs, kv, outdir='' ) :
+    ## the ctffind4 command of one batch on one cpu, the micrographs one after the other.
+    ## outdir is a directory ( '' the current one ) or a function giving it for a micrograph
+    def ctffind4_command ( batch, cpu, number, defocus=None ) :
+        coms = [ write_ctffind4_input( mic, pixel_size, cs, kv, outdir( mic ) if callable ( outdir ) else outdir, defocus ) for mic in batch ]
+        return ' ; '.join( com if os.path.isabs( com ) else './' + com for com in coms )
+    return ctffind4_command
+
+def write_ctffind4_input ( micrograph,pixel,cs, kv, outdir='', defocus=None ) :
+    ## ctffind4 reads the micrograph where it is, the .com, .ctf, .txt and .log go to outdir.
+    ## defocus is the ( min, max, step ) of the search, None the full 5000 - 50000 A
+    out_name = outdir + ctf_stem( micrograph )
+    low, high, step = defocus if defocus is not None else CTFFIND4_DEFOCUS
+    ctf_input_list = [ pixel, kv, cs, '0.07','512','20','5',str(int(low)),str(int(high)),str(int(step)),'no','no','yes','100','no','no','EOF']
+    ctf_input = []
+    ctf_input.append ( '#!/usr/bin/csh' )
+    ctf_input.append ('ctffind-4.1.5.exe > ' + out_name + '.log << EOF' )
+    ctf_input.append ( micrograph )
+    ctf_input.append ( out_name + '.ctf' )
+    ctf_input =  ctf_input + ctf_input_list
+    i = 0
+    out = out_name + '.com'
+    com = open (out, "w")
+    while (i < 21 ):
+        com.write( str (ctf_input[i] ) )
+        com.write("\n"  )
+        i += 1
+    st = os.stat(out)
+    os.chmod(out, st.st_mode | stat.S_IEXEC)
+    com.close()
+    return out
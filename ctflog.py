@@ -0,0 +1,235 @@
+## Gctf / ctffind4 results as one NumPy table
+##
+## Every Gctf log ( <stem>_gctf.log ) and ctffind4 / native output ( <stem>.txt ) is opened once and
+## only its tail is read: the results are the last lines both programs write. Big sessions are
+## parsed in a process pool. The table has one row per micrograph with the defocus, CCC, resolution,
+## B factor and the Gctf validation scores, and micrographs_ctf.star is written from it directly.
+## cached_logs keeps the table in an .npz next to the logs, keyed by the size and mtime of every
+## log, so plotting a finished session again only reads the logs that changed.
+
+import os, multiprocessing, zipfile
+import numpy as np
+import relionstar
+
+TAIL_BYTES = 16384
+POOL_MIN_FILES = 256
+## ctffind4 writes inf when it finds no Thon rings
+NO_RESOLUTION = 50.0
+VALIDATION_BINS = ( '20-08A', '15-06A', '12-05A', '10-04A', '08-03A' )
+VALIDATION_FIELDS = ( 'val_20_08', 'val_15_06', 'val_12_05', 'val_10_04', 'val_08_03' )
+NUMBER_FIELDS = ( 'defocus_u', 'defocus_v', 'defocus_angle', 'ccc', 'resolution', 'bfactor', 'phase_shift' )
+SUFFIXES = { 'gctf' : '_gctf.log', 'ctffind4' : '.txt' }
+CACHE = '.ctflog_%s.npz'
+## how far apart two fits of one micrograph may be ( A ) and still agree
+DEFOCUS_TOLERANCE = 500.0
+ASTIGMATISM_TOLERANCE = 500.0
+RESOLUTION_TOLERANCE = 3.0
+
+def read_tail ( filename, nbytes=TAIL_BYTES ) :
+    ## the last complete lines of a file, the whole file when nbytes is None
+    with open( filename, 'rb' ) as f :
+        f.seek( 0, os.SEEK_END )
+        size = f.tell()
+        start = 0 if nbytes is None else max ( 0, size - nbytes )
+        f.seek( start )
+        lines = f.read().decode( 'utf-8', 'replace' ).splitlines()
+    if start > 0 and lines :
+        lines = lines[1:]
+    return lines
+
+def number ( text ) :
+    value = float ( text )
+    if np.isinf( value ) :
+        return NO_RESOLUTION
+    return value
+
+def parse_gctf ( filename ) :
+    ## { field : value } of one Gctf log or None when the run did not finish
+    for nbytes in ( TAIL_BYTES, None ) :
+        lines = read_tail( filename, nbytes )
+        final = [ l for l in lines if 'Final Values' in l ]
+        if final or nbytes is None :
+            break
+    res = [ l for l in lines if 'RES_LIMIT' in l ]
+    if not final or not res :
+        return None
+    values = final[-1].split()
+    row = dict ( defocus_u=number( values[0] ), defocus_v=number( values[1] ), defocus_angle=number( values[2] ),
+                 ccc=number( values[3] ), resolution=number( res[-1].split()[-1] ) )
+    bfactor = [ l for l in lines if 'B_FACTOR' in l ]
+    if bfactor :
+        row['bfactor'] = number( bfactor[-1].split()[-1] )
+    for bin, field in zip( VALIDATION_BINS, VALIDATION_FIELDS ) :
+        scores = [ l for l in lines if bin in l ]
+        if scores :
+            row[field] = int ( float ( scores[-1].split()[-1] ) )
+    return row
+
+def parse_ctffind4 ( filename ) :
+    ## the last line of a ctffind4 ( or nativectf ) .txt:  # dU dV angle phase_shift cc resolution
+    lines = [ l for l in read_tail( filename, 4096 ) if l.strip() and not l.startswith('#') ]
+    if not lines :
+        return None
+    values = lines[-1].split()
+    if len ( values ) < 7 :
+        return None
+    return dict ( defocus_u=number( values[1] ), defocus_v=number( values[2] ), defocus_angle=number( values[3] ),
+                  phase_shift=number( values[4] ), ccc=number( values[5] ), resolution=number( values[6] ) )
+
+PARSERS = { 'gctf' : parse_gctf, 'ctffind4' : parse_ctffind4 }
+
+def _parse_file ( job ) :
+    filename, kind = job
+    try :
+        return filename, PARSERS[kind]( filename )
+    except ( IOError, OSError, ValueError, IndexError ) :
+        return filename, None
+
+def micrograph_stem ( filename, kind ) :
+    name = os.path.basename( filename )
+    suffix = SUFFIXES[kind]
+    if name.endswith( suffix ) :
+        return name[:-len ( suffix )]
+    return os.path.splitext( name )[0]
+
+def results_table ( logs, rows, kind ) :
+    ## structured array of the parsed rows, missing numbers are nan and missing scores 0
+    columns = [ ( 'micrograph', np.array( [ micrograph_stem( l, kind ) for l in logs ], dtype=str ) ),
+                ( 'log', np.array( logs, dtype=str ) ) ]
+    for field in NUMBER_FIELDS :
+        columns.append( ( field, np.array( [ r.get( field, np.nan ) for r in rows ], dtype=np.float64 ) ) )
+    for field in VALIDATION_FIELDS :
+        columns.append( ( field, np.array( [ r.get( field, 0 ) for r in rows ], dtype=np.int32 ) ) )
+    return relionstar.make_table( columns )
+
+def parse_logs ( files, kind='gctf', processes=None ) :
+    ## kind is gctf or ctffind4 ( also the nativectf .txt ). Unfinished logs are left out,
+    ## the rows keep the order of files
+    files = [ f for f in files if not ( kind == 'ctffind4' and 'avrot' in f ) ]
+    jobs = [ ( f, kind ) for f in files ]
+    if len ( jobs ) >= POOL_MIN_FILES :
+        pool = multiprocessing.Pool( processes or multiprocessing.cpu_count() )
+        try :
+            parsed = pool.map( _parse_file, jobs, chunksize=64 )
+        finally :
+            pool.close()
+            pool.join()
+    else :
+        parsed = [ _parse_file( job ) for job in jobs ]
+    parsed = [ ( f, row ) for f, row in parsed if row is not None ]
+    return results_table( [ f for f, row in parsed ], [ row for f, row in parsed ], kind )
+
+def load_cache ( cache ) :
+    ## ( table, mtime, size ) of a cache file, None when it is missing or from another version
+    if not os.path.exists( cache ) :
+        return None
+    try :
+        with np.load( cache, allow_pickle=False ) as npz :
+            results, mtime, size = npz['results'], npz['mtime'], npz['size']
+    except ( IOError, OSError, ValueError, KeyError, zipfile.BadZipfile ) :
+        return None
+    if results.dtype.names != parse_logs( [] ).dtype.names or len ( results ) != len ( mtime ) :
+        return None
+    return results, mtime, size
+
+def save_cache ( cache, results, mtime, size ) :
+    part = cache + '.part'
+    with open( part, 'wb' ) as f :
+        np.savez( f, results=results, mtime=np.asarray( mtime, dtype=np.float64 ), size=np.asarray( size, dtype=np.int64 ) )
+    os.rename( part, cache )
+
+def cached_logs ( files, kind='gctf', cache=None, processes=None ) :
+    ## parse_logs through the cache: the rows of logs with the same size and mtime as last
+    ## time come from the .npz, only new or changed logs are read
+    if cache is None :
+        cache = CACHE % kind
+    stats = {}
+    for f in files :
+        if kind == 'ctffind4' and 'avrot' in f :
+            continue
+        try :
+            st = os.stat( f )
+        except OSError :
+            continue
+        stats[f] = ( st.st_mtime, st.st_size )
+    files = [ f for f in files if f in stats ]
+    old = load_cache( cache )
+    keep = []
+    if old is not None :
+        results, mtime, size = old
+        rows = dict ( ( str ( log ), i ) for i, log in enumerate ( results['log'] ) )
+        keep = [ rows[f] for f in files if f in rows and ( mtime[rows[f]], size[rows[f]] ) == stats[f] ]
+    kept = set ( str ( log ) for log in results['log'][keep] ) if keep else set ()
+    fresh = parse_logs( [ f for f in files if f not in kept ], kind, processes )
+    table = fresh
+    if keep :
+        table = relionstar.concatenate( [ results[keep], fresh ] )
+    order = dict ( ( f, i ) for i, f in enumerate ( files ) )
+    table = table[ np.argsort( [ order[str ( log )] for log in table['log'] ] ) ]
+    if len ( fresh ) or old is None or len ( keep ) != len ( old[0] ) :
+        save_cache( cache, table, [ stats[str ( log )][0] for log in table['log'] ], [ stats[str ( log )][1] for log in table['log'] ] )
+    return table
+
+def merge_results ( tables ) :
+    ## one table from [ ( estimator, table ) ] with the estimator of every row. A micrograph in
+    ## more than one table is kept from the first
+    parts = []
+    seen = set ()
+    for estimator, table in tables :
+        keep = np.array( [ str ( m ) not in seen for m in table['micrograph'] ], dtype=bool )
+        seen.update( str ( m ) for m in table['micrograph'] )
+        table = table[keep]
+        parts.append( relionstar.with_column( table, 'estimator', np.array( [ estimator ] * len ( table ), dtype=str ) ) )
+    return relionstar.concatenate( parts )
+
+def prefixed ( table, prefix ) :
+    ## the columns renamed prefix + name, except the micrograph
+    return relionstar.make_table( [ ( name if name == 'micrograph' else prefix + name, table[name] ) for name in table.dtype.names ] )
+
+def consensus ( first, second, names=( 'gctf', 'ctffind4' ), defocus=DEFOCUS_TOLERANCE, astigmatism=ASTIGMATISM_TOLERANCE,
+                resolution=RESOLUTION_TOLERANCE ) :
+    ## the micrographs of both tables side by side ( joined on the micrograph, order of first ) and
+    ## how far apart the two fits are: mean defocus, astigmatism ( |dU - dV| ) and resolution.
+    ## agree is 1 when all three are within the tolerances, a missing value never agrees
+    joined = relionstar.join( prefixed( first, names[0] + '_' ), prefixed( second, names[1] + '_' ), 'micrograph' )
+    u1, v1 = joined[names[0] + '_defocus_u'], joined[names[0] + '_defocus_v']
+    u2, v2 = joined[names[1] + '_defocus_u'], joined[names[1] + '_defocus_v']
+    differences = [ ( 'defocus_difference', np.abs( ( u1 + v1 ) - ( u2 + v2 ) ) / 2, defocus ),
+                    ( 'astigmatism_difference', np.abs( np.abs( u1 - v1 ) - np.abs( u2 - v2 ) ), astigmatism ),
+                    ( 'resolution_difference', np.abs( joined[names[0] + '_resolution'] - joined[names[1] + '_resolution'] ), resolution ) ]
+    agree = np.ones( len ( joined ), dtype=bool )
+    with np.errstate( invalid='ignore' ) :
+        for name, difference, tolerance in differences :
+            agree &= difference <= float ( tolerance )
+    columns = [ ( name, joined[name] ) for name in joined.dtype.names ]
+    columns += [ ( name, difference ) for name, difference, tolerance in differences ]
+    columns.append( ( 'agree', agree.astype( np.int32 ) ) )
+    return relionstar.make_table( columns )
+
+def validation_scores ( results, bins=VALIDATION_BINS ) :
+    ## { '20-08A' : [ scores ] ... } for the plots
+    return dict ( ( bin, results[field].tolist() ) for bin, field in zip( VALIDATION_BINS, VALIDATION_FIELDS ) if bin in bins )
+
+def write_micrographs_star ( filename, micrographs, defocus_u, defocus_v, defocus_angle, ccc, resolution, pixel_size, kv, cs, ac ) :
+    table = micrographs_star( micrographs, defocus_u, defocus_v, defocus_angle, ccc, resolution, pixel_size, kv, cs, ac )
+    relionstar.write_loop( filename, table )
+    return table
+
+def micrographs_star ( micrographs, defocus_u, defocus_v, defocus_angle, ccc, resolution, pixel_size, kv, cs, ac ) :
+    ## what relion_run_ctffind --only_make_star writes, the magnification is 10000 so the
+    ## detector pixel is the pixel size
+    n = len ( micrographs )
+    ctf_images = [ os.path.splitext( m )[0] + '.ctf:mrc' for m in micrographs ]
+    table = relionstar.make_table( [ ( 'rlnMicrographName', np.array( micrographs, dtype=str ) ),
+                                     ( 'rlnCtfImage', np.array( ctf_images, dtype=str ) ),
+                                     ( 'rlnDefocusU', np.asarray( defocus_u, dtype=np.float64 ) ),
+                                     ( 'rlnDefocusV', np.asarray( defocus_v, dtype=np.float64 ) ),
+                                     ( 'rlnDefocusAngle', np.asarray( defocus_angle, dtype=np.float64 ) ),
+                                     ( 'rlnVoltage', np.full( n, float ( kv ) ) ),
+                                     ( 'rlnSphericalAberration', np.full( n, float ( cs ) ) ),
+                                     ( 'rlnAmplitudeContrast', np.full( n, float ( ac ) ) ),
+                                     ( 'rlnMagnification', np.full( n, 10000.0 ) ),
+                                     ( 'rlnDetectorPixelSize', np.full( n, float ( pixel_size ) ) ),
+                                     ( 'rlnCtfFigureOfMerit', np.asarray( ccc, dtype=np.float64 ) ),
+                                     ( 'rlnCtfMaxResolution', np.asarray( resolution, dtype=np.float64 ) ) ] )
+    return table
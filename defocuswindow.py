@@ -0,0 +1,138 @@
+## Adaptive defocus search for Gctf and ctffind4
+##
+## Both programs search their whole defocus range for every micrograph ( Gctf 0.5 - 9 um, ctffind4
+## 0.5 - 5 um ) while the micrographs of a session sit within a um or two of the targets. A
+## DefocusWindow wraps the make_command of ctfjobs for gpudispatch: before every batch it reads the
+## results of the micrographs it gave out before ( their logs, the finished ones ) and once
+## WINDOW_MIN_FITS fits are known the next batches only search from the median of the lower defocus
+## minus WINDOW_Z robust standard deviations ( median / MAD, at least WINDOW_MARGIN ) to the median of
+## the higher defocus plus as much.
+##
+## A fit of a narrowed search is suspect when its defocus is within a step of a narrowed edge of
+## its window ( the minimum may be outside ) or when its CC or resolution is more than WORSE_Z robust
+## standard deviations worse than the fits so far ( see triage.robust_z ). Then the window falls back
+## to the full search until WINDOW_MIN_FITS more micrographs are fitted that way, and the suspect
+## micrographs are in refits() to be done again with the full search once the run is over.
+## Only the micrographs fitted with the full search ( full_search ) go to the ctf cache, the
+## others are not what another script asking for the same Gctf arguments would get.
+
+import threading
+import numpy as np
+import ctfjobs, ctflog, ctfcache, triage
+
+WINDOW_MIN_FITS = 8
+WINDOW_Z = 4.0
+WINDOW_MARGIN = 2000.0
+WORSE_Z = 3.0
+FULL = { 'gctf' : ctfjobs.GCTF_DEFOCUS, 'ctffind4' : ctfjobs.CTFFIND4_DEFOCUS }
+
+class DefocusWindow (object) :
+    ## a make_command ( batch, slot, number ) that gives make_command the defocus search of the batch
+
+    def __init__ ( self, make_command, estimator='gctf', directory='.', full=None ) :
+        self.make_command = make_command
+        self.estimator = estimator
+        self.directory = directory
+        self.full = full or FULL[estimator]
+        self.lock = threading.Lock()
+        ## micrograph : window it was given, until its result is read
+        self.pending = {}
+        ## micrograph : window of its last fit, None for the full search
+        self.searched = {}
+        ## low defocus, high defocus, ccc, resolution of the fits that are trusted
+        self.fits = []
+        self.suspect = []
+        self.fallback = 0
+        self.given = 0
+        self.narrowed = 0
+
+    def __call__ ( self, batch, slot, number ) :
+        with self.lock :
+            self.update()
+            window = self.window()
+            for micrograph in batch :
+                self.pending[micrograph] = window
+                self.searched[micrograph] = window
+            self.given += len ( batch )
+            if window is not None :
+                self.narrowed += len ( batch )
+        return self.make_command( batch, slot, number, window )
+
+    def log ( self, micrograph ) :
+        directory = self.directory( micrograph ) if callable ( self.directory ) else self.directory
+        return ctfcache.output_stem( micrograph, directory or '.' ) + ctflog.SUFFIXES[self.estimator]
+
+    def update ( self ) :
+        ## the results that came in since the last batch
+        for micrograph, window in list ( self.pending.items() ) :
+            try :
+                row = ctflog.PARSERS[self.estimator]( self.log( micrograph ) )
+            except ( IOError, OSError, ValueError, IndexError ) :
+                continue
+            if row is None :
+                continue
+            del self.pending[micrograph]
+            fit = ( min ( row['defocus_u'], row['defocus_v'] ), max ( row['defocus_u'], row['defocus_v'] ), row['ccc'], row['resolution'] )
+            if window is not None and self.worse( fit, window ) :
+                self.suspect.append( micrograph )
+                self.fallback = WINDOW_MIN_FITS
+                continue
+            if window is None and self.fallback > 0 :
+                self.fallback -= 1
+            self.fits.append( fit )
+
+    def worse ( self, fit, window ) :
+        ## at the edge of its window, or a CC / resolution far worse than the trusted fits
+        low, high, step = window
+        if ( low > self.full[0] and fit[0] < low + step ) or ( high < self.full[1] and fit[1] > high - step ) :
+            return True
+        fits = np.array( self.fits + [ fit ], dtype=np.float64 )
+        for column, side in ( ( 2, triage.SIDES['ccc'] ), ( 3, triage.SIDES['resolution'] ) ) :
+            if np.nan_to_num( side * triage.robust_z( fits[:, column] )[-1] ) > WORSE_Z :
+                return True
+        return False
+
+    def window ( self ) :
+        ## ( low, high, step ) for the next batch, None for the full search
+        if len ( self.fits ) < WINDOW_MIN_FITS or self.fallback > 0 :
+            return None
+        fits = np.array( self.fits, dtype=np.float64 )
+        full_low, full_high, step = self.full
+        edges = []
+        for column in ( 0, 1 ) :
+            values = fits[:, column][np.isfinite( fits[:, column] )]
+            median = np.median( values )
+            spread = max ( WINDOW_MARGIN, WINDOW_Z * triage.MAD_SCALE * np.median( np.abs( values - median ) ) )
+            edges.append( median - spread if column == 0 else median + spread )
+        low = max ( full_low, step * np.floor( edges[0] / step ) )
+        high = min ( full_high, step * np.ceil( edges[1] / step ) )
+        if low <= full_low and high >= full_high :
+            return None
+        return ( int ( low ), int ( high ), int ( step ) )
+
+    def refits ( self ) :
+        ## the micrographs to fit again with the full search, once the workers are done: a
+        ## result that is not there by then will not come
+        with self.lock :
+            self.update()
+            self.pending.clear()
+            return [ m for m in self.suspect if self.searched.get( m ) is not None ]
+
+    def refitted ( self, micrographs ) :
+        ## these were done again with the full search
+        with self.lock :
+            for micrograph in micrographs :
+                self.searched[micrograph] = None
+
+    def summary ( self ) :
+        ## what the scripts print once the run is over
+        window = self.window()
+        return '%d of %d micrographs had a narrowed defocus search%s, %d of them suspect' % (
+            self.narrowed, self.given, ' ( now %.2f - %.2f um )' % ( window[0] / 1e4, window[1] / 1e4 ) if window and self.narrowed else '', len ( self.suspect ) )
+
+def full_search ( make_command, micrographs ) :
+    ## the micrographs a make_command ( a DefocusWindow or not ) fitted with the full search
+    if not isinstance ( make_command, DefocusWindow ) :
+        return list ( micrographs )
+    with make_command.lock :
+        return [ m for m in micrographs if make_command.searched.get( m ) is None ]
@@ -0,0 +1,101 @@
+## Finding the micrographs / movies of a directory
+##
+## One os.scandir pass lists a directory and every name is sorted into the wanted patterns
+## ( *mrcs, *tif, *mrc ... ) and checked against the exclude in the same loop, instead of a glob
+## per suffix and a list.remove per excluded file. The names are kept in an index under
+## ~/.cache/emdiscover ( the data directory may be read only ) together with the mtime of the
+## directory: as long as nothing was added or removed the next run, or the next call in this
+## run, only stats the directory.
+
+import os, re, time, fnmatch, hashlib, json
+
+INDEX_DIR = os.path.expanduser( '~/.cache/emdiscover' )
+## a directory changed this close to the scan may have changed again in the same mtime tick
+MTIME_SLACK = 2.0
+
+_memory = {}
+
+def index_file ( directory ) :
+    return os.path.join( INDEX_DIR, hashlib.sha1( directory.encode( 'utf-8', 'surrogateescape' ) ).hexdigest() + '.json' )
+
+def load_index ( directory, mtime ) :
+    ## the names of the last scan when the directory has not changed since
+    if directory in _memory :
+        known, scanned, names = _memory[directory]
+        if known == mtime and scanned - mtime >= MTIME_SLACK :
+            return names
+    try :
+        with open( index_file( directory ) ) as f :
+            index = json.load( f )
+    except ( IOError, OSError, ValueError ) :
+        return None
+    if index.get( 'directory' ) != directory or index.get( 'mtime' ) != mtime or index.get( 'scanned', 0 ) - mtime < MTIME_SLACK :
+        return None
+    _memory[directory] = ( mtime, index['scanned'], index['names'] )
+    return index['names']
+
+def save_index ( directory, mtime, scanned, names ) :
+    _memory[directory] = ( mtime, scanned, names )
+    if scanned - mtime < MTIME_SLACK :
+        return
+    try :
+        if not os.path.isdir( INDEX_DIR ) :
+            os.makedirs( INDEX_DIR )
+        filename = index_file( directory )
+        part = filename + '.%d.part' % os.getpid()
+        with open( part, 'w' ) as f :
+            json.dump( dict ( directory=directory, mtime=mtime, scanned=scanned, names=names ), f )
+        os.rename( part, filename )
+    except ( IOError, OSError ) :
+        pass
+
+def scan ( directory ) :
+    ## the names of the files ( and links ) in a directory, sorted
+    directory = os.path.abspath( directory )
+    try :
+        mtime = os.stat( directory ).st_mtime
+    except OSError :
+        return []
+    names = load_index( directory, mtime )
+    if names is not None :
+        return names
+    scanned = time.time()
+    names = []
+    for entry in os.scandir( directory ) :
+        if not entry.name.startswith( '.' ) and not entry.is_dir( follow_symlinks=False ) :
+            names.append( entry.name )
+    names.sort()
+    save_index( directory, mtime, scanned, names )
+    return names
+
+def classify ( names, patterns, exclude ) :
+    ## the names matching each glob pattern ( eg *FoilHole*mrcs ) and without exclude, one pass
+    matchers = [ re.compile( fnmatch.translate( pattern ) ).match for pattern in patterns ]
+    found = [ [] for pattern in patterns ]
+    for name in names :
+        if exclude and exclude in name :
+            continue
+        for i, match in enumerate ( matchers ) :
+            if match( name ) :
+                found[i].append( name )
+    return found
+
+def micrographs ( directory, patterns, exclude ) :
+    ## ( pattern, sorted paths ) of the first pattern with files, ( patterns[0], [] ) when none has
+    for pattern, names in zip( patterns, classify( scan( directory ), patterns, exclude ) ) :
+        if names :
+            return pattern, [ os.path.join( directory, name ) for name in names ]
+    return patterns[0], []
+
+def existing ( paths ) :
+    ## the paths that are there, one scan per directory instead of a stat per file
+    present = {}
+    kept = []
+    for path in paths :
+        directory, name = os.path.split( path )
+        directory = directory or '.'
+        if directory not in present :
+            present[directory] = set ( scan( directory ) )
+        if name in present[directory] :
+            kept.append( path )
+    return kept
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3.5
+import os, sys, time
+import catalog
+from optparse import OptionParser
+
+usage = "usage: %prog [options] \n\n" \
+        "emcatalog.py\n" \
+        "emcatalog.py --by=month --cem=Halos\n" \
+        "emcatalog.py --by=user --from=2017-01-01 --to=2017-07-01 --better=3.5\n\n" \
+        "Statistics of the CTF of all the sessions makesum has added to the catalog, per microscope, user,\n\
+         session, day, month or year"
+
+parser = OptionParser(usage=usage)
+parser.add_option("--db",     dest="db", help="Catalog file  default $EM_CATALOG or ~/.em_catalog.sqlite")
+parser.add_option("--by",     dest="by", default='microscope', help="Group by microscope, user, session, day, month or year  default microscope")
+parser.add_option("--cem",    dest="microscope_name", help="Only sessions of this microscope eg --cem=Halos")
+parser.add_option("--user",   dest="user", help="Only sessions of this user")
+parser.add_option("--from",   dest="start", help="Only sessions from this day on eg --from=2017-05-01")
+parser.add_option("--to",     dest="end", help="Only sessions before this day eg --to=2017-06-01")
+parser.add_option("--better", dest="better", default=catalog.GOOD_RESOLUTION, help="Count the micrographs with a resolution better than this ( A )  default 4")
+(options, args) = parser.parse_args()
+
+def day ( text ) :
+    ## seconds since the epoch of a YYYY-MM-DD ( local time )
+    try :
+        return time.mktime( time.strptime( text, '%Y-%m-%d' ) )
+    except ValueError :
+        print ('\nDates are given as YYYY-MM-DD, eg --from=2017-05-01')
+        sys.exit(1)
+
+def number ( value, format='%.1f' ) :
+    if value is None :
+        return '-'
+    return format % value
+
+if options.by not in catalog.GROUPS :
+    print ('\n--by can be', ', '.join( sorted ( catalog.GROUPS ) ) )
+    sys.exit(1)
+
+path = options.db or os.environ.get( 'EM_CATALOG', catalog.CATALOG )
+if not os.path.exists( path ) :
+    print ('\nThere is no catalog at', path, '- makesum adds every session it summarises to it' )
+    sys.exit(1)
+
+filters = dict ( microscope=options.microscope_name, user=options.user,
+                 start=day( options.start ) if options.start else None, end=day( options.end ) if options.end else None )
+db = catalog.open_catalog( path )
+stats = catalog.statistics( db, options.by, float ( options.better ), **filters )
+db.close()
+
+if not stats :
+    print ('\nNo sessions found')
+    sys.exit(0)
+
+header = ( options.by, 'sessions', 'micrographs', 'res mean', 'res std', 'best', 'worst', 'better ' + str ( options.better ) + 'A', 'defocus mean', 'defocus std' )
+width = max ( [ len ( str ( s['group'] ) ) for s in stats ] + [ len ( header[0] ), 10 ] )
+print ('')
+print ( header[0].ljust( width ) + ''.join( h.rjust( 14 ) for h in header[1:] ) )
+for s in stats :
+    fraction = 100.0 * s['better'] / s['micrographs'] if s['micrographs'] else 0
+    columns = ( str ( s['sessions'] ), str ( s['micrographs'] ), number( s['resolution'][0], '%.2f' ), number( s['resolution'][1], '%.2f' ),
+                number( s['best'], '%.2f' ), number( s['worst'], '%.2f' ), '%d ( %.0f%% )' % ( s['better'], fraction ),
+                number( s['defocus'][0], '%.0f' ), number( s['defocus'][1], '%.0f' ) )
+    print ( str ( s['group'] ).ljust( width ) + ''.join( c.rjust( 14 ) for c in columns ) )
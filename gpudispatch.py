@@ -0,0 +1,218 @@
+## Dynamic dispatch of micrographs/movies to GPU workers ( Gctf, Gautomatch, MotionCor2 )
+##
+## Instead of np.array_split-ing the list up front, every GPU slot pulls small batches from a
+## shared queue. Batches are sized by bytes and shrink as the queue drains ( guided scheduling ),
+## so a slow GPU or a run of large movies only holds up its own last batch and an idle GPU
+## simply takes the next one. Batches also keep the command lines well below ARG_MAX.
+##
+## Workers of different kinds ( Gctf on the GPUs and ctffind4 on the spare cores ) can share one
+## queue: every finished batch reports its bytes per second, and a worker's batches are sized by
+## the share of the total throughput its kind has measured, so a slow CPU worker never sits on a
+## big batch at the end of the run.
+
+import os, time, threading, collections
+import subprocess as subp
+
+MIN_BATCH_BYTES = 256 * 1024 * 1024
+MAX_BATCH_BYTES = 8 * 1024 * 1024 * 1024
+MAX_BATCH_FILES = 64
+
+def file_size ( name ) :
+    try :
+        return os.stat( name ).st_size
+    except OSError :
+        return 0
+
+
+class WorkQueue (object) :
+
+    def __init__ ( self, files, nworkers, min_bytes=MIN_BATCH_BYTES, max_bytes=MAX_BATCH_BYTES, max_files=MAX_BATCH_FILES ) :
+        self.items = collections.deque( ( f, file_size(f) ) for f in files )
+        self.remaining = sum ( s for f, s in self.items )
+        self.nworkers = max ( 1, nworkers )
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.max_files = max ( 1, max_files )
+        self.lock = threading.Lock()
+        self.batches = 0
+        ## kind : number of workers, kind : measured bytes per second of one worker
+        self.workers = collections.Counter()
+        self.rates = {}
+        ## workers that have not stopped yet
+        self.running = 0
+
+    def __len__ ( self ) :
+        return len ( self.items )
+
+    def add_worker ( self, kind ) :
+        with self.lock :
+            self.workers[kind] += 1
+
+    def start_worker ( self ) :
+        with self.lock :
+            self.running += 1
+
+    def stop_worker ( self ) :
+        ## returns how many workers are still running
+        with self.lock :
+            self.running -= 1
+            return self.running
+
+    def drain ( self ) :
+        ## the files no worker will take any more
+        with self.lock :
+            files = [ name for name, nbytes in self.items ]
+            self.items.clear()
+            self.remaining = 0
+            return files
+
+    def report ( self, kind, nbytes, seconds ) :
+        ## running average of the throughput of one worker of this kind
+        if seconds <= 0 or nbytes <= 0 :
+            return
+        with self.lock :
+            rate = nbytes / float ( seconds )
+            self.rates[kind] = rate if kind not in self.rates else 0.5 * ( self.rates[kind] + rate )
+
+    def share ( self, kind ) :
+        ## fraction of the throughput of all the workers one worker of this kind has. A kind not
+        ## measured yet gets nothing, so its workers take single files until their first one is
+        ## done, and counts as the average of the measured kinds for the others
+        if kind is None :
+            return 1.0 / self.nworkers
+        if kind not in self.rates :
+            return 0.0
+        default = sum ( self.rates.values() ) / len ( self.rates )
+        total = sum ( n * self.rates.get( k, default ) for k, n in self.workers.items() )
+        return self.rates[kind] / total
+
+    def next_batch ( self, kind=None ) :
+        ## half of a fair share of what is left, never less than min_bytes or one file
+        with self.lock :
+            if not self.items :
+                return None
+            target = self.remaining * self.share( kind ) / 2.0
+            target = min ( self.max_bytes, max ( self.min_bytes, target ) )
+            batch = []
+            size = 0
+            while self.items and len ( batch ) < self.max_files :
+                if batch and size + self.items[0][1] > target :
+                    break
+                name, nbytes = self.items.popleft()
+                batch.append( name )
+                size += nbytes
+            self.remaining -= size
+            self.batches += 1
+            return batch, self.batches
+
+
+class GpuWorker (threading.Thread) :
+    ## One slot on one GPU ( or one CPU core for a ctffind4 worker ). Looks like a Popen to
+    ## jobwatch ( poll / wait / returncode )
+
+    def __init__ ( self, queue, gpu_id, make_command, log=None, slot=0, kind=None ) :
+        threading.Thread.__init__( self )
+        self.daemon = True
+        self.queue = queue
+        self.gpu_id = gpu_id
+        self.make_command = make_command
+        self.log = log
+        self.slot = slot
+        self.kind = kind
+        self.returncode = None
+        self.failed = []
+        self.files = []
+        self.processed = 0
+        if kind is not None :
+            queue.add_worker( kind )
+        queue.start_worker()
+
+    def run ( self ) :
+        code = 0
+        batch = []
+        try :
+            while True :
+                job = self.queue.next_batch( self.kind )
+                if job is None :
+                    break
+                batch, number = job
+                args = self.make_command( batch, self.gpu_id, number )
+                if self.log is not None :
+                    self.log.write( str(args) + '\n' )
+                    self.log.flush()
+                start = time.time()
+                proc = subp.Popen( args, shell = True, stdout = self.log, stderr = subp.STDOUT )
+                status = proc.wait()
+                if self.kind is not None :
+                    self.queue.report( self.kind, sum ( file_size( f ) for f in batch ), time.time() - start )
+                self.processed += len ( batch )
+                self.files.extend( batch )
+                if status != 0 :
+                    self.failed.extend( batch )
+                    code = status
+                batch = []
+        except Exception as e :
+            ## the command of a batch could not be made or started: this worker stops with the
+            ## batch failed, the last worker to stop also fails what is left in the queue
+            self.failed.extend( batch )
+            code = code or 1
+            if self.log is not None :
+                try :
+                    self.log.write( 'worker ' + str ( self.gpu_id ) + ' stopped : ' + repr ( e ) + '\n' )
+                    self.log.flush()
+                except ( IOError, OSError, ValueError ) :
+                    pass
+        finally :
+            if self.queue.stop_worker() == 0 :
+                left = self.queue.drain()
+                if left :
+                    self.failed.extend( left )
+                    code = code or 1
+            self.returncode = code
+
+    def poll ( self ) :
+        if self.is_alive() :
+            return None
+        return self.returncode
+
+    def wait ( self ) :
+        self.join()
+        return self.returncode
+
+
+def dispatch ( files, gpu_ids, make_command, log=None, jobs_per_gpu=1, min_bytes=MIN_BATCH_BYTES, max_files=MAX_BATCH_FILES ) :
+    ## start the workers and return them, hand them to jobwatch.wait_for_outputs as the procs
+    ## make_command ( batch, gpu_id, batch_number ) returns the shell command for one batch
+    slots = []
+    for gpu in gpu_ids :
+        for j in range ( int ( jobs_per_gpu ) ) :
+            slots.append( ( gpu, j ) )
+    queue = WorkQueue( list ( files ), len ( slots ), min_bytes=min_bytes, max_files=max_files )
+    workers = [ GpuWorker( queue, gpu, make_command, log, slot ) for gpu, slot in slots ]
+    for w in workers :
+        w.start()
+    return workers
+
+def dispatch_mixed ( files, pools, log=None, min_bytes=0, max_files=MAX_BATCH_FILES ) :
+    ## several kinds of workers on one queue. pools: [ ( kind, slot_ids, make_command ) ], e.g.
+    ## ( 'gctf', gpu ids, gctf_command ) and ( 'ctffind4', cpu ids, ctffind4_command ).
+    ## No byte floor by default, so the batches follow the measured throughput down to one file
+    slots = [ ( kind, slot, make_command ) for kind, slot_ids, make_command in pools for slot in slot_ids ]
+    queue = WorkQueue( list ( files ), len ( slots ), min_bytes=min_bytes, max_files=max_files )
+    workers = [ GpuWorker( queue, slot, make_command, log, 0, kind ) for kind, slot, make_command in slots ]
+    for w in workers :
+        w.start()
+    return workers
+
+def files_by_kind ( workers ) :
+    ## { kind : [ files its workers ran ] }
+    files = collections.OrderedDict()
+    for w in workers :
+        files.setdefault( w.kind, [] ).extend( w.files )
+    return files
+
+def failed_files ( workers ) :
+    failed = []
+    for w in workers :
+        failed.extend( w.failed )
+    return failed
@@ -0,0 +1,181 @@
+## Sharing the GPUs ( and cpu cores ) of a workstation between runs
+##
+## Every run leases the devices it uses from a registry in a runtime directory all the users of
+## the host share ( $EM_LEASE_DIR, default /tmp/em_leases ). The registry is one JSON file that
+## is only read and written under an flock. A lease has its GPUs, a number of cpu cores, the pid
+## of the run and an expiry that a thread of the run keeps pushing forward, a lease whose process
+## is gone or whose expiry has passed is free again: a run that crashed or was killed gives its
+## GPUs back without anybody cleaning up. The GPUs are the entries of $EM_GPU_DIR ( default
+## /proc/driver/nvidia/gpus, one directory per GPU ), a directory of empty files stands in for
+## them where there are no GPUs.
+
+import os, json, time, fcntl, getpass, socket, threading, atexit, itertools, multiprocessing
+
+LEASE_DIR = os.environ.get( 'EM_LEASE_DIR', '/tmp/em_leases' )
+DEVICE_DIR = os.environ.get( 'EM_GPU_DIR', '/proc/driver/nvidia/gpus' )
+## a lease not renewed for this long ( s ) is free, the holder renews it every LEASE_TTL / 4
+LEASE_TTL = 120
+WAIT_POLL = 10
+## the leases of one process are told apart by a counter, not by the time they were taken
+_serial = itertools.count()
+
+def devices ( device_dir=DEVICE_DIR ) :
+    ## the GPU ids of the host, 0 .. n-1 in the order of the device entries
+    try :
+        return list ( range ( len ( [ name for name in os.listdir( device_dir ) if not name.startswith( '.' ) ] ) ) )
+    except OSError :
+        return []
+
+def visible ( gpus ) :
+    ## shell prefix for programs that take every GPU they see ( relion --gpu without ids )
+    return 'CUDA_VISIBLE_DEVICES=' + ','.join( str ( g ) for g in gpus ) + ' '
+
+def alive ( pid ) :
+    try :
+        os.kill( pid, 0 )
+    except ProcessLookupError :
+        return False
+    except PermissionError :
+        return True
+    return True
+
+def _shared ( path, mode ) :
+    ## everybody on the host uses the same files
+    try :
+        os.chmod( path, mode )
+    except OSError :
+        pass
+
+def _change ( directory, change ) :
+    ## change ( leases ) under the lock of the registry, the dead leases are dropped first
+    if not os.path.isdir( directory ) :
+        try :
+            os.makedirs( directory )
+            _shared( directory, 0o1777 )
+        except FileExistsError :
+            pass
+    lock = os.path.join( directory, 'leases.lock' )
+    registry = os.path.join( directory, 'leases.json' )
+    fd = os.open( lock, os.O_RDWR | os.O_CREAT, 0o666 )
+    try :
+        _shared( lock, 0o666 )
+        fcntl.flock( fd, fcntl.LOCK_EX )
+        try :
+            with open( registry ) as f :
+                leases = json.load( f )
+        except ( IOError, OSError, ValueError ) :
+            leases = {}
+        now = time.time()
+        leases = dict ( ( key, lease ) for key, lease in leases.items() if lease['expires'] > now and alive( lease['pid'] ) )
+        result = change( leases )
+        part = registry + '.' + str ( os.getpid() )
+        with open( part, 'w' ) as f :
+            json.dump( leases, f )
+        _shared( part, 0o666 )
+        os.rename( part, registry )
+        return result
+    finally :
+        os.close( fd )
+
+def holders ( directory=LEASE_DIR ) :
+    ## the live leases, { id : lease }
+    return _change( directory, lambda leases : dict ( leases ) )
+
+class Lease :
+    ## the GPUs and cpu cores one run holds, renewed by a thread until released
+    def __init__ ( self, key, record, directory, ttl ) :
+        self.key = key
+        self.record = record
+        self.gpus = record['gpus']
+        self.cores = record['cores']
+        self.directory = directory
+        self.ttl = ttl
+        self._stop = threading.Event()
+        self._thread = threading.Thread( target=self._renew_loop )
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register( self.release )
+
+    def renew ( self ) :
+        def change ( leases ) :
+            ## a lease dropped while this run was stopped ( ^Z, a long swap ) comes back as it was
+            lease = leases.get( self.key, self.record )
+            lease['expires'] = time.time() + self.ttl
+            leases[self.key] = lease
+        _change( self.directory, change )
+
+    def _renew_loop ( self ) :
+        while not self._stop.wait( self.ttl / 4.0 ) :
+            try :
+                self.renew()
+            except OSError :
+                pass
+
+    def release ( self ) :
+        if self._stop.is_set() :
+            return
+        self._stop.set()
+        try :
+            _change( self.directory, lambda leases : leases.pop( self.key, None ) )
+        except OSError :
+            pass
+
+    def add_gpus ( self, ngpu=0, wait=None, device_dir=DEVICE_DIR ) :
+        ## GPUs for a run that so far only held cpus, as acquire does
+        if self.gpus :
+            return self.gpus
+        host_gpus = devices( device_dir )
+        started = time.time()
+        def claim ( leases ) :
+            gpus = _free_gpus( leases, host_gpus, ngpu, wait, started )
+            if gpus is not None :
+                leases.setdefault( self.key, self.record )['gpus'] = gpus
+            return gpus
+        self.gpus = _waiting( self.directory, claim )
+        self.record['gpus'] = self.gpus
+        return self.gpus
+
+def _free_gpus ( leases, host_gpus, ngpu, wait, started ) :
+    ## ngpu ( 0 all ) of the GPUs nobody holds, None to wait for one
+    held = set ( g for lease in leases.values() for g in lease['gpus'] )
+    free = [ g for g in host_gpus if g not in held ]
+    if host_gpus and not free and ( wait is None or time.time() - started < wait ) :
+        return None
+    return free[:int ( ngpu )] if int ( ngpu ) > 0 else free
+
+def _waiting ( directory, claim ) :
+    ## claim under the lock until it gets something, telling once who holds the GPUs
+    told = False
+    while True :
+        result = _change( directory, claim )
+        if result is not None :
+            return result
+        if not told :
+            busy = [ '%s ( %s, GPU %s )' % ( l['user'], l['program'], ','.join( str ( g ) for g in l['gpus'] ) )
+                     for l in holders( directory ).values() if l['gpus'] ]
+            print ('\nAll GPUs are in use by', ', '.join( busy ), '- waiting for one' )
+            told = True
+        time.sleep ( WAIT_POLL )
+
+def acquire ( ngpu=0, ncpu=0, program='', use_gpus=True, wait=None, ttl=LEASE_TTL, directory=LEASE_DIR,
+              device_dir=DEVICE_DIR, total_cores=None ) :
+    ## lease ngpu of the free GPUs ( 0 all of them ) and ncpu cores ( 0 all that are free ). With no
+    ## free GPU it waits, up to wait seconds ( None for ever ), for one; a run gets at least one
+    ## core. use_gpus=False only leases cores, Lease.add_gpus gets GPUs later
+    if total_cores is None :
+        total_cores = multiprocessing.cpu_count()
+    host_gpus = devices( device_dir ) if use_gpus else []
+    key = socket.gethostname() + '.' + str ( os.getpid() ) + '.' + str ( int ( time.time() * 1000 ) ) + '.' + str ( next ( _serial ) )
+    started = time.time()
+
+    def claim ( leases ) :
+        gpus = _free_gpus( leases, host_gpus, ngpu, wait, started )
+        if gpus is None :
+            return None
+        free_cores = max ( 1, total_cores - sum ( lease['cores'] for lease in leases.values() ) )
+        cores = min ( int ( ncpu ), free_cores ) if int ( ncpu ) > 0 else free_cores
+        leases[key] = dict ( pid=os.getpid(), user=getpass.getuser(), program=program, gpus=gpus, cores=cores,
+                             started=time.time(), expires=time.time() + ttl )
+        return leases[key]
+
+    return Lease( key, _waiting( directory, claim ), directory, ttl )
@@ -0,0 +1,236 @@
+## Completion tracking for the external jobs (Gctf, ctffind4, MotionCor2, Gautomatch, relion ...)
+##
+## The scripts used to spin in  while ( a < b ) : a = len(glob.glob(...))  which keeps one core
+## busy re-listing the work directory. Here we wait on inotify events where the kernel gives
+## them to us and fall back to os.scandir polling with an interval that follows the rate at
+## which output files actually appear.
+
+import os, sys, time, fnmatch, select, struct, errno
+import collections
+import ctypes, ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = 0o2000000
+_event_header  = struct.Struct('iIII')
+
+_libc = None
+
+def _get_libc () :
+    global _libc
+    if _libc is None :
+        name = ctypes.util.find_library('c') or 'libc.so.6'
+        _libc = ctypes.CDLL(name, use_errno=True)
+    return _libc
+
+def inotify_watch ( directory ) :
+    ## returns an inotify file descriptor watching directory or None if inotify is not usable
+    if not sys.platform.startswith('linux') :
+        return None
+    try :
+        libc = _get_libc()
+        fd = libc.inotify_init1( IN_NONBLOCK | IN_CLOEXEC )
+    except (OSError, AttributeError) :
+        return None
+    if fd < 0 :
+        return None
+    mask = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE
+    wd = libc.inotify_add_watch( fd, os.fsencode(directory), mask )
+    if wd < 0 :
+        os.close(fd)
+        return None
+    return fd
+
+def read_inotify_names ( fd ) :
+    ## drain the inotify queue, returns ( names, overflow )
+    names = []
+    overflow = False
+    while True :
+        try :
+            data = os.read( fd, 65536 )
+        except OSError as e :
+            if e.errno in ( errno.EAGAIN, errno.EWOULDBLOCK ) :
+                break
+            raise
+        if not data :
+            break
+        pos = 0
+        while pos + _event_header.size <= len(data) :
+            wd, mask, cookie, length = _event_header.unpack_from( data, pos )
+            pos += _event_header.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW :
+                overflow = True
+            elif name :
+                names.append( os.fsdecode(name) )
+    return names, overflow
+
+def format_eta ( seconds ) :
+    if seconds is None :
+        return ''
+    seconds = int ( round ( seconds ) )
+    if seconds >= 3600 :
+        return 'ETA %dh%02dm' % ( seconds // 3600, ( seconds % 3600 ) // 60 )
+    if seconds >= 60 :
+        return 'ETA %dm%02ds' % ( seconds // 60, seconds % 60 )
+    return 'ETA %ds' % seconds
+
+
+class CompletionTracker (object) :
+    ## Counts files matching a glob style pattern ( e.g. '*.ctf', '../Particles/*_extract.star' )
+    ## until total of them exist or all the child processes are gone.
+
+    def __init__ ( self, pattern, total, procs=(), label='Micrographs are done', shown_total=None,
+                   min_interval=0.25, max_interval=5.0, window=25, use_inotify=True, expected=None ) :
+        self.directory = os.path.dirname( pattern ) or '.'
+        self.name_pattern = os.path.basename( pattern )
+        self.total = total
+        self.shown_total = total if shown_total is None else shown_total
+        self.procs = list ( procs )
+        self.label = label
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.done = set()
+        self.returncodes = [ None ] * len ( self.procs )
+        self.history = collections.deque( maxlen=window )
+        self.fd = None
+        self.use_inotify = use_inotify
+        ## only count these names when given, e.g. the outputs of this batch in a live session
+        self.expected = None if expected is None else set ( expected )
+        self._watch()
+        self.rescan()
+
+    def _watch ( self ) :
+        if self.use_inotify and self.fd is None and os.path.isdir( self.directory ) :
+            self.fd = inotify_watch( self.directory )
+
+    def close ( self ) :
+        if self.fd is not None :
+            os.close( self.fd )
+            self.fd = None
+
+    def _add ( self, names ) :
+        new = []
+        for name in names :
+            if name in self.done or not fnmatch.fnmatch( name, self.name_pattern ) :
+                continue
+            if self.expected is None or name in self.expected :
+                self.done.add( name )
+                new.append( name )
+        if new :
+            self.history.append( ( time.time(), len(self.done) ) )
+        return new
+
+    def rescan ( self ) :
+        ## one directory read, no stat calls
+        try :
+            names = [ entry.name for entry in os.scandir( self.directory ) ]
+        except OSError :
+            return []
+        return self._add( names )
+
+    def count ( self ) :
+        return len ( self.done )
+
+    def rate ( self ) :
+        ## micrographs per second from the last completions
+        if len ( self.history ) < 2 :
+            return None
+        t0, c0 = self.history[0]
+        t1, c1 = self.history[-1]
+        if t1 <= t0 or c1 <= c0 :
+            return None
+        return ( c1 - c0 ) / ( t1 - t0 )
+
+    def eta ( self ) :
+        rate = self.rate()
+        if rate is None :
+            return None
+        return max ( 0, self.total - self.count() ) / rate
+
+    def check_procs ( self ) :
+        ## returns True while at least one child is still running
+        running = False
+        for i, proc in enumerate ( self.procs ) :
+            if self.returncodes[i] is not None :
+                continue
+            code = proc.poll()
+            if code is None :
+                running = True
+                continue
+            self.returncodes[i] = code
+            if code != 0 :
+                print ( 'job', i, 'exited with status', code )
+        return running
+
+    def _next_interval ( self, found ) :
+        ## poll about twice per expected arrival, back off when nothing shows up
+        if found :
+            rate = self.rate()
+            if rate :
+                self.interval = 0.5 / rate
+            else :
+                self.interval = self.min_interval
+        else :
+            self.interval = self.interval * 1.5
+        self.interval = min ( self.max_interval, max ( self.min_interval, self.interval ) )
+
+    def poll ( self ) :
+        ## block until something may have changed, returns the new names
+        self._watch()
+        if self.fd is not None :
+            ready = select.select( [ self.fd ], [], [], self.max_interval )[0]
+            if not ready :
+                return self.rescan()
+            names, overflow = read_inotify_names( self.fd )
+            if overflow :
+                return self.rescan()
+            return self._add( names )
+        time.sleep( self.interval )
+        new = self.rescan()
+        self._next_interval( len ( new ) > 0 )
+        return new
+
+    def report ( self ) :
+        eta = format_eta( self.eta() )
+        if eta :
+            print ( self.count(), '/', self.shown_total, self.label, ' ' + eta )
+        else :
+            print ( self.count(), '/', self.shown_total, self.label )
+
+    def wait ( self ) :
+        shown = 0
+        try :
+            while self.count() < self.total :
+                running = self.check_procs()
+                if self.count() > shown :
+                    self.report()
+                    shown = self.count()
+                if self.procs and not running :
+                    self.rescan()
+                    break
+                if not self.procs and not self.rescan() :
+                    ## no job to wait for ( a dispatch over no GPUs ), what is not there will not come
+                    print ( 'No jobs are running for the', self.total - self.count(), 'missing outputs' )
+                    break
+                self.poll()
+        finally :
+            self.close()
+        for i, proc in enumerate ( self.procs ) :
+            self.returncodes[i] = proc.wait()
+        if self.count() > shown :
+            self.report()
+        if self.count() < self.total :
+            print ( 'Only', self.count(), 'of', self.total, 'outputs were written, some jobs failed' )
+        return self.returncodes
+
+
+def wait_for_outputs ( pattern, total, procs=(), label='Micrographs are done', shown_total=None, expected=None ) :
+    ## drop in for the old busy loops, returns the exit status of every child
+    tracker = CompletionTracker( pattern, total, procs, label=label, shown_total=shown_total, expected=expected )
+    return tracker.wait()
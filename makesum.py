@@ -2,15 +2,15 @@
 import glob, sys, string, time
 import os, fnmatch, re
 import shutil, getpass 
-import stat, platform, math
-import multiprocessing
+import platform, math
+import multiprocessing, sqlite3
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import numpy.random as rnd
 from matplotlib import cm as CM
-import subprocess as subp
+import jobwatch, gpudispatch, micdb, relionstar, nativectf, ctflog, atlas, catalog, discover, staging, ctfjobs, gpulease, prescreen, ctfcache, triage, defocuswindow
 
 
 ## Create a general dictionary of script parameters. Easy to expand later
@@ -28,19 +28,36 @@ drift_parameters['magnification'] = 'N/A'
 drift_parameters['time'] =  time.strftime("%d_%b_%Y_%I_%M_%S%p")
 drift_parameters['timestamp'] =  'EM_' + drift_parameters['time']
 drift_parameters['workdir'] = os.getcwd() + '/' + drift_parameters['timestamp'] + '/'
+drift_parameters['scratch'] = staging.SCRATCH
 drift_parameters['Microscope'] = 'N/A'
 drift_parameters['gctf'] = 1
 drift_parameters['ctffind4'] = 0
+drift_parameters['native'] = 0
+drift_parameters['mixed'] = 0
 drift_parameters['negative'] = 0
+drift_parameters['consensus'] = 0
+drift_parameters['defocus_tolerance'] = ctflog.DEFOCUS_TOLERANCE
+drift_parameters['astigmatism_tolerance'] = ctflog.ASTIGMATISM_TOLERANCE
+drift_parameters['resolution_tolerance'] = ctflog.RESOLUTION_TOLERANCE
 drift_parameters['gctf_available'] = 1
 drift_parameters['ctffind4_available'] = 1
 drift_parameters['plot_only'] = 0
-drift_parameters['power_users'] = 0
+drift_parameters['atlas'] = ''
+drift_parameters['catalog'] = os.environ.get( 'EM_CATALOG', catalog.CATALOG )
 drift_parameters['ngpu'] = 0
 drift_parameters['ncpu'] = 0
 drift_parameters['output_text'] = []
 drift_parameters['input_commands'] = ' '.join(sys.argv)
 drift_parameters['rescut'] = 0
+drift_parameters['watch'] = 0
+drift_parameters['resume'] = ''
+drift_parameters['watch_every'] = 50
+drift_parameters['watch_minutes'] = 10
+drift_parameters['watch_poll'] = 20
+drift_parameters['prescreen'] = 1
+drift_parameters['quarantine'] = 0
+drift_parameters['triage'] = triage.OUTLIER_Z
+drift_parameters['defocus_window'] = 1
 
 
 ### Command line and help text
@@ -65,12 +82,27 @@ parser.add_option("--mag",   dest="magnification", help="Magnification of the mi
 parser.add_option("--suf",   dest="suffix", help="Micrograph suffix  eg mrc  default mrc ")
 parser.add_option("--cem",        dest="microscope_name", help="Microscope name  eg Halos  no default")
 parser.add_option("--ctffind",    dest="ctffind", action="store_true", default=False, help="Use ctffind4 instead of Gctf")
+parser.add_option("--ctf",        dest="ctf", help="CTF program gctf, ctffind, mixed ( Gctf on the GPUs and ctffind4 on the other cpus together ), consensus ( both programs on every micrograph at the same time, compared ) or native ( CPU only, no external programs ) eg --ctf=native default gctf")
 parser.add_option("--negative",   dest="negative", action="store_true", default=False, help="Negative stain data")
 parser.add_option("--plot",       dest="plot_only", action="store_true", default=False, help="plot results of precomputed ctf Gctf or/and ctffind4")
+parser.add_option("--atlas",      dest="atlas", help="Also write an atlas PDF: thumbnail, power spectrum and ctf fit of every micrograph, worst first by res or cc eg --atlas=res")
+parser.add_option("--catalog",    dest="catalog", help="Catalog the session is added to ( see emcatalog.py ), no to leave it out  default $EM_CATALOG or ~/.em_catalog.sqlite")
 parser.add_option("--cpu",        dest="ncpu", help="Number of cpus to use")
 parser.add_option("--gpu",        dest="ngpu", help="Number of gpus to use")
-parser.add_option("--devel",      dest="power", action="store_true", default=False, help="For developers....")
-parser.add_option("--rcut",       dest="rescut", help="only works with --devel")
+parser.add_option("--devel",      dest="power", action="store_true", default=False, help="Same as --ctf=consensus")
+parser.add_option("--rcut",       dest="rescut", help="with --ctf=consensus, only micrographs with a Gctf resolution better than this are in the matching star eg --rcut=4")
+parser.add_option("--dftol",      dest="defocus_tolerance", help="with --ctf=consensus, largest difference of the mean defocus ( A ) of a match eg --dftol=500 default 500")
+parser.add_option("--asttol",     dest="astigmatism_tolerance", help="with --ctf=consensus, largest difference of the astigmatism ( A ) of a match eg --asttol=500 default 500")
+parser.add_option("--restol",     dest="resolution_tolerance", help="with --ctf=consensus, largest difference of the resolution ( A ) of a match eg --restol=3 default 3")
+parser.add_option("--watch",      dest="watch", action="store_true", default=False, help="Keep running during collection, calculate ctf for new micrographs as they arrive")
+parser.add_option("--every",      dest="every", help="with --watch, update the PDF after this many new micrographs eg --every=50 default 50")
+parser.add_option("--resume",     dest="resume", help="Continue a run that stopped, ctf is only calculated for the missing micrographs eg --resume=EM_01_Jan_2018_10_00_00AM")
+parser.add_option("--scratch",    dest="scratch", help="Work directory ( links and temporary files ) on this node local disk, the outputs still go to the data directory eg --scratch=/scratch default $EM_SCRATCH")
+parser.add_option("--noscreen",   dest="noscreen", action="store_true", default=False, help="Do not pre-screen the micrographs, by default empty, truncated and saturated ones are skipped")
+parser.add_option("--quarantine", dest="quarantine", action="store_true", default=False, help="Move the micrographs that fail the pre-screen to a quarantine directory in the data directory")
+parser.add_option("--notriage",   dest="notriage", action="store_true", default=False, help="Put every micrograph in micrographs_selected.star, by default those with a ctf fit far off the others go to micrographs_rejected.star")
+parser.add_option("--fullsearch", dest="fullsearch", action="store_true", default=False, help="Search the whole defocus range for every micrograph, by default the search narrows to the defocus of the micrographs done so far")
+parser.add_option("--minutes",    dest="minutes", help="with --watch, update the PDF at least this often ( minutes ) eg --minutes=10 default 10")
 (options, args) = parser.parse_args()
 
 if options.kv :
@@ -106,17 +138,91 @@ if options.ngpu :
 if options.rescut :
     drift_parameters['rescut'] = options.rescut
 
+if options.defocus_tolerance :
+    drift_parameters['defocus_tolerance'] = float ( options.defocus_tolerance )
+
+if options.astigmatism_tolerance :
+    drift_parameters['astigmatism_tolerance'] = float ( options.astigmatism_tolerance )
+
+if options.resolution_tolerance :
+    drift_parameters['resolution_tolerance'] = float ( options.resolution_tolerance )
+
+if options.every :
+    drift_parameters['watch_every'] = int ( options.every )
+
+if options.minutes :
+    drift_parameters['watch_minutes'] = float ( options.minutes )
+
+if options.scratch :
+    drift_parameters['scratch'] = options.scratch
+
+if drift_parameters['scratch'] :
+    drift_parameters['workdir'] = staging.work_directory( drift_parameters['datadir'], drift_parameters['timestamp'], drift_parameters['scratch'] )
+
+if options.resume :
+    drift_parameters['resume'] = options.resume
+    drift_parameters['timestamp'] = os.path.basename( os.path.normpath( options.resume ) )
+    drift_parameters['workdir'] = os.path.abspath( options.resume ) + '/'
+
+## work directories of earlier runs whose background removal was cut short
+if staging.reclaim( os.path.dirname( os.path.normpath( drift_parameters['workdir'] ) ) ) :
+    print ('\nRemoving the work directories left by earlier runs in the background')
+
+if str(options.notriage) == "True" :
+    drift_parameters['triage'] = float ( 'inf' )
+
+if str(options.fullsearch) == "True" :
+    drift_parameters['defocus_window'] = 0
+
+if str(options.noscreen) == "True" :
+    drift_parameters['prescreen'] = 0
+
+if str(options.quarantine) == "True" :
+    drift_parameters['quarantine'] = 1
+
+if str(options.watch) == "True" :
+    drift_parameters['watch'] = 1
+
 if str(options.ctffind) == "True" :
     drift_parameters['ctffind4'] = 1
     drift_parameters['gctf'] = 0
     #print ('\nUsing ctffind4 instead of Gctf\n')
 
+if options.ctf :
+    if options.ctf == 'native' :
+        drift_parameters['native'] = 1
+        drift_parameters['gctf'] = 0
+        drift_parameters['ctffind4'] = 0
+    elif options.ctf in ( 'ctffind', 'ctffind4' ) :
+        drift_parameters['ctffind4'] = 1
+        drift_parameters['gctf'] = 0
+    elif options.ctf in ( 'mixed', 'consensus' ) :
+        drift_parameters[options.ctf] = 1
+        drift_parameters['gctf'] = 0
+        drift_parameters['ctffind4'] = 0
+    elif options.ctf != 'gctf' :
+        print ('\n--ctf can be gctf, ctffind, mixed, consensus or native')
+        quit ()
+
 if str(options.plot_only) == "True" :
     drift_parameters['plot_only'] = 1
     print ('\nplotting the results, no ctf calculations\n')
 
+if options.catalog :
+    drift_parameters['catalog'] = options.catalog
+
+if options.atlas :
+    if options.atlas not in atlas.ORDERS :
+        print ('\n--atlas can be res or cc')
+        quit ()
+    drift_parameters['atlas'] = options.atlas
+
 if str(options.power) == "True" :
-    drift_parameters['power_users'] = 1
+    drift_parameters['consensus'] = 1
+    drift_parameters['mixed'] = 0
+    drift_parameters['gctf'] = 0
+    drift_parameters['ctffind4'] = 0
+    drift_parameters['native'] = 0
 
 if str(options.negative) == "True" :
     drift_parameters['negative'] = 1
@@ -136,6 +242,8 @@ text_print_list = ( drift_parameters['pixel_size'] , drift_parameters['magnifica
 ## CHECK FOR THE PRESENSE OF EXECUTABLES
 def check_execs() :
 
+    if drift_parameters['native'] == 1 :
+        return
     exec_list = ['Gctf', 'ctffind415']
 
     for i in range (len(exec_list)):
@@ -147,10 +255,24 @@ def check_execs() :
             drift_parameters['gctf_available'] = 0
         if 'ctffind415' in drift_parameters['missing_execs'] :
             drift_parameters['ctffind4_available'] = 0
+    if drift_parameters['gctf_available'] == 1 and len ( gpulease.devices() ) == 0 :
+        print ('\nGctf is in the path but there is no GPU')
+        drift_parameters['gctf_available'] = 0
+    both = drift_parameters['mixed'] == 1 or drift_parameters['consensus'] == 1
+    if both and ( drift_parameters['gctf_available'] == 0 or drift_parameters['ctffind4_available'] == 0 ) :
+        print ('\n--ctf=mixed and --ctf=consensus need Gctf ( and a GPU ) and ctffind415, I will use the one that is there')
+        drift_parameters['mixed'] = 0
+        drift_parameters['consensus'] = 0
+        if drift_parameters['gctf_available'] == 1 :
+            drift_parameters['gctf'] = 1
+        elif drift_parameters['ctffind4_available'] == 1 :
+            drift_parameters['ctffind4'] = 1
     if ( drift_parameters['ctffind4_available'] == 0 and drift_parameters['gctf_available'] == 0 ) :
         print ('\nNo  Gctf and ctffind415 executables in the path')
-        print ('I will quit')
-        quit ()
+        print ('I will calculate the CTF on the CPU ( native )')
+        drift_parameters['native'] = 1
+        drift_parameters['gctf'] = 0
+        drift_parameters['ctffind4'] = 0
     elif ( drift_parameters['gctf'] == 1 and drift_parameters['gctf_available'] == 0 ) :
         if ( drift_parameters['ctffind4_available'] == 1 ):
             print ('\nNo Gctf executables in the path, but ctffind415 is available')
@@ -164,9 +286,12 @@ def check_execs() :
             drift_parameters['gctf'] = 1
             drift_parameters['ctffind4'] = 0
 
-if (  drift_parameters['gctf_available'] == 1 and drift_parameters['ctffind4_available'] == 1   and drift_parameters['power_users'] == 1) :
-    drift_parameters['ctffind4'] = 1
-    drift_parameters['gctf'] = 1
+if drift_parameters['watch'] == 1 :
+    drift_parameters['plot_only'] = 0
+    if drift_parameters['consensus'] == 1 :
+        print ('\n--ctf=consensus does not work with --watch, I will use Gctf')
+        drift_parameters['consensus'] = 0
+        drift_parameters['gctf'] = 1
 
 def check_for_executables(program):
     import os
@@ -194,11 +319,7 @@ else :
 
 
 def count_micrographs(pattern, micdir, exclude) :
-    micrographs_list = glob.glob(os.path.join(micdir,pattern ))
- 
-    for name in glob.glob(os.path.join(micdir,pattern )) :
-        if exclude in name :
-            micrographs_list.remove(name)
+    micrographs_list = discover.micrographs( micdir, [ pattern ], exclude )[1]
     micrographs_total = len( micrographs_list )
 
     if micrographs_total == 0 :
@@ -207,152 +328,298 @@ def count_micrographs(pattern, micdir, exclude) :
         quit ()
     else:
         print ('\nYou have',micrographs_total, 'micrographs')
+    if drift_parameters['prescreen'] == 1 :
+        micrographs_list = screen_micrographs ( micrographs_list )[0]
+        micrographs_total = len( micrographs_list )
+        if micrographs_total == 0 :
+            print ('None of the micrographs pass the pre-screen')
+            print ('I will quit')
+            quit ()
     return micrographs_total,micrographs_list
 
-def make_dir_soft_links ( workdir, micdir, pattern, exclude) :
-    dest_dir  = workdir + '/'
-    os.makedirs(workdir)
-    for file in glob.glob (pattern) :
-        if exclude not in file :
-            file_with_dir = micdir + '/' + file
-            file_with_dest_dir = dest_dir + '/' + file
-            os.symlink ( file_with_dir, file_with_dest_dir )
-    os.chdir ( dest_dir )
-
-def count_micrographs_workdir(pattern, micdir) :
-    micrographs_total = len(glob.glob(os.path.join(micdir,pattern )))
-    micrographs_list = glob.glob(os.path.join(micdir,pattern ))
-    suf = '.' + drift_parameters['micrograph_name_suffix']
-    names_list = [w.replace(suf, '') for w in micrographs_list]
-    return micrographs_total,micrographs_list,names_list
+def screen_micrographs ( micrographs_list, skipped=None, total=0 ) :
+    ## empty, truncated and saturated micrographs are left out before any ctf job ( see prescreen ).
+    ## With --watch skipped has the micrographs left out so far, of total, the report lists them all
+    report = output_path ( drift_parameters['timestamp'] + '_prescreen.txt' )
+    quarantine_dir = output_path ( prescreen.QUARANTINE ) if drift_parameters['quarantine'] == 1 else ''
+    kept, rejected = prescreen.check_micrographs( micrographs_list, report if skipped is None else '', quarantine_dir, run_lease().cores )
+    if skipped is not None and rejected :
+        skipped.extend( rejected )
+        prescreen.write_report( skipped, total, report )
+    if rejected :
+        drift_parameters['screened_out'] = ( len ( skipped ) if skipped is not None else len ( rejected ), report )
+    return kept, rejected
+
+def stage_micrographs ( micrographs_list, links ) :
+    ## into the work directory. Gctf writes its .ctf and log next to the micrographs so it gets
+    ## links, ctffind4 and the native CTF read the micrographs where they are
+    workdir = drift_parameters['workdir']
+    if os.path.isdir (workdir) != True :
+        os.makedirs(workdir)
+    if links :
+        micrographs_list = staging.link_many( micrographs_list, workdir )
+    os.chdir ( workdir )
+    return micrographs_list
+
+def output_path ( filename ) :
+    ## the outputs go to the data directory, the work directory may be on scratch
+    return os.path.join( drift_parameters['datadir'], filename )
+
+def run_lease( gpus=False ) :
+    ## the cpus ( and GPUs ) of this run, leased from the other runs on this host ( see gpulease ).
+    ## --gpu / --cpu ask for that many, by default all the free ones. The GPUs are only leased
+    ## when there is something for them to do
+    if 'lease' not in drift_parameters :
+        drift_parameters['lease'] = gpulease.acquire( int( drift_parameters['ngpu'] ), int( drift_parameters['ncpu'] ), 'makesum', False )
+    if gpus :
+        drift_parameters['lease'].add_gpus( int( drift_parameters['ngpu'] ) )
+    return drift_parameters['lease']
+
+def gpu_ids() :
+    return run_lease( True ).gpus
 
 def number_of_gpu() :
-    gpus = len(glob.glob('/proc/driver/nvidia/gpus/*'))
-    drift_parameters['ngpu']  = int( drift_parameters['ngpu'] )
-    if drift_parameters['ngpu'] == 0 :
-        print (' Available GPUS: ',gpus )
-    else :
-        if ( gpus != 0 ) :
-            print (' Available GPUS: ',gpus )
-            print (' Using ', drift_parameters['ngpu'], 'GPUS' )
-            gpus = drift_parameters['ngpu']
-    return gpus
+    gpus = len ( gpulease.devices() )
+    lease = run_lease( True )
+    print (' Available GPUS: ',gpus )
+    if len ( lease.gpus ) != gpus :
+        print (' Using GPUS', ' '.join( str ( g ) for g in lease.gpus ), '( the others are in use or not asked for )' )
+    return len ( lease.gpus )
 
 def number_of_cpu() :
     cpus = multiprocessing.cpu_count()
-    drift_parameters['ncpu']  = int (drift_parameters['ncpu'] )
-    if drift_parameters['ncpu'] == 0 :
+    lease = run_lease()
+    if lease.cores == cpus :
         print (' Available CPUS: ',cpus )
     else :
-        if ( cpus != 0 ) :
-            cpus = drift_parameters['ncpu']
-            print (' Using ', drift_parameters['ncpu'], 'CPUS' )
-    return cpus
+        print (' Using ', lease.cores, 'of', cpus, 'CPUS' )
+    return lease.cores
+
+def pending_ctf ( micrographs_list, stage ) :
+    ## the micrographs without a ctf of this stage in the manifest
+    if manifest is None :
+        return micrographs_list
+    names = micdb.names_for( manifest, micrographs_list )
+    pending = set ( micdb.pending( manifest, names, stage ) )
+    return [ m for m, n in zip( micrographs_list, names ) if n in pending ]
 
 def GCTF ( pixel_size, cs, kv, micrographs_list, negative) :
-    number_of_gpus = number_of_gpu()
-    split_by_gpu = np.array_split(micrographs_list,number_of_gpus)
-    import subprocess as subp
-    import time
-    if float (pixel_size)  > 3 :
-        resH = 2 * float (pixel_size)
-        B_resH = 9.00
-    else :
-        resH = 4
-        B_resH = 7.00
-    if ( negative == 1 ) :
-        box = ' '
-        ac = ' --ac 0.35 '
-    else :
-        box = ' --boxsize 512 '
-        ac = ' --ac 0.07 '
-    output = open("gctf.log", 'w')
-    ps = []
-    for i in range(number_of_gpus) :
-        star = 'gpu' + str (i) + '.star'
-        args = 'Gctf --apix '+ str(pixel_size)+ ' --kV ' + str(kv) +' --cs ' + str(cs) + ' ' + ' '.join(split_by_gpu[i]) \
-               + ' --gid ' + str(i) + ' --do_validation' + ' --resH ' + str(resH) + ' --B_resH ' + str(B_resH) \
-               + box + ac + ' --ctfstar ' + star
-               #+ ' --ac 0.07 --do_EPA  --boxsize 512 --do_Hres_ref --Href_resL 20'  
-        #print (args)
-        proc = subp.Popen( args,  shell = True,  stdout = output)
-        ps.append(proc)
+    todo = pending_ctf ( micrographs_list, 'ctf' )
+    if len (todo) == 0 :
+        print ('\n CTF of all micrographs is already known\n')
+        return
+    gctf_command = ctfjobs.gctf_commands ( pixel_size, cs, kv, negative )
+    ## micrographs Gctf already did with the same arguments, in this or another script ( see ctfcache )
+    cache_key = ctfcache.command_key ( gctf_command )
+    cached = ctfcache.restore ( todo, cache_key )
+    if cached :
+        print ('\n', len (cached), 'micrographs have a Gctf result of an earlier run ( ctf cache )')
+        record_ctf ( cached, 'ctf', '_gctf.log' )
+        cached = set ( cached )
+        todo = [ m for m in todo if m not in cached ]
+        if len (todo) == 0 :
+            return
+    output = open("gctf.log", 'a')
+
+    window = adaptive ( gctf_command, 'gctf' )
+    ps = gpudispatch.dispatch( todo, gpu_ids(), window, output )
 
     #Keep the user informed       
-    a = len(glob.glob("*.ctf" ))
-    b = len (micrographs_list ) 
-    c = 0
     print ('\n I am going to calculate CTF for your micrographs using Gctf\n')
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob("*.ctf" ))
-       
-    for p in ps:
+    expected = [ ctfjobs.ctf_stem( m ) + '.ctf' for m in todo ]
+    jobwatch.wait_for_outputs( "*.ctf", len (todo ), ps, expected=expected )
+    full_search_refits ( window, ps, gpu_ids(), output )
+    output.close()
+    record_ctf ( todo, 'ctf', '_gctf.log' )
+    ## a fit of a narrowed defocus search is not what the cache key says
+    ctfcache.store ( defocuswindow.full_search ( window, todo ), cache_key )
+
+## one DefocusWindow per estimator for the whole run, the batches of --watch keep narrowing it
+defocus_windows = {}
+
+def adaptive ( make_command, estimator ) :
+    ## make_command with the defocus search narrowed to the micrographs done so far ( see
+    ## defocuswindow ), as it is with --fullsearch
+    if drift_parameters['defocus_window'] != 1 :
+        return make_command
+    if estimator not in defocus_windows :
+        defocus_windows[estimator] = defocuswindow.DefocusWindow( make_command, estimator )
+    window = defocus_windows[estimator]
+    window.make_command = make_command
+    return window
+
+def full_search_refits ( window, ps, slots, output, min_bytes=gpudispatch.MIN_BATCH_BYTES ) :
+    ## once the workers are done, the micrographs whose fit in a narrowed defocus search is
+    ## suspect are done again with the full search, on the same slots
+    for p in ps :
         p.wait()
+    if not isinstance ( window, defocuswindow.DefocusWindow ) :
+        return []
+    refit = window.refits()
+    print (' ' + window.summary() )
+    if len (refit) == 0 :
+        return []
+    print ('\n', len (refit), 'micrographs are done again with the full defocus search\n')
+    stems = [ ctfjobs.ctf_stem( m ) for m in refit ]
+    for stem in stems :
+        for suffix in ( '.ctf', ctflog.SUFFIXES[window.estimator] ) :
+            if os.path.exists( stem + suffix ) :
+                os.remove( stem + suffix )
+    refit_ps = gpudispatch.dispatch( refit, slots, window.make_command, output, min_bytes=min_bytes )
+    jobwatch.wait_for_outputs( "*.ctf", len (refit), refit_ps, expected=[ s + '.ctf' for s in stems ] )
+    for p in refit_ps :
+        p.wait()
+    window.refitted( refit )
+    return refit
+
+def record_ctf ( micrographs_list, stage, log_suffix, ctf_suffix='.ctf' ) :
+    ## a micrograph is done once its ctf and log files are written
+    if manifest is None :
+        return
+    names = micdb.names_for( manifest, micrographs_list )
+    done = []
+    failed = []
+    for mic, name in zip( micrographs_list, names ) :
+        stem = ctfjobs.ctf_stem( mic )
+        if os.path.exists( stem + ctf_suffix ) and os.path.exists( stem + log_suffix ) :
+            micdb.update( manifest, name, ctf_log=os.path.abspath( stem + log_suffix ) )
+            done.append( name )
+        else :
+            failed.append( name )
+    micdb.mark( manifest, done, stage )
+    micdb.mark( manifest, failed, stage, 'failed' )
 
-def write_ctffind4_input ( micname,pixel,cs, kv ) :
-    name = ''.join ( micname.split('.')[:-1] )
-    suf = micname.split('.')[-1]
-    ctf_input_list = [ pixel, kv, cs, '0.07','512','20','5','5000','50000','500','no','no','yes','100','no','no','EOF']
-    ctf_input = []
-    ctf_input.append ( '#!/usr/bin/csh' )
-    ctf_input.append ('ctffind-4.1.5.exe > ' + name + '.log << EOF' )
-    ctf_input.append ( name + '.' + suf )
-    ctf_input.append ( name + '.ctf' )
-    ctf_input =  ctf_input + ctf_input_list
-    i = 0
-    out = name + '.com'
-    com = open (out, "w")
-    while (i < 21 ):
-        com.write( str (ctf_input[i] ) ) 
-        com.write("\n"  ) 
-        i += 1
-    st = os.stat(out)
-    os.chmod(out, st.st_mode | stat.S_IEXEC)
-    com.close()
+def NATIVE_CTF ( pixel_size, cs, kv, micrographs_list, negative ) :
+    number_of_cpus = number_of_cpu()
+    if ( negative == 1 ) :
+        ac = 0.35
+    else :
+        ac = 0.07
+    if manifest is not None :
+        names = micdb.names_for( manifest, micrographs_list )
+        pending = set ( micdb.pending( manifest, names, 'native' ) )
+        micrographs_list = [ m for m, n in zip( micrographs_list, names ) if n in pending ]
+        if len (micrographs_list) == 0 :
+            print ('\n CTF of all micrographs is already known\n')
+            return
+    print ('\n I am going to calculate CTF for your micrographs on the CPU ( native )\n')
+    nativectf.estimate_many( micrographs_list, pixel_size, kv, cs, ac, number_of_cpus )
+    record_ctf ( micrographs_list, 'native', '.txt', '.txt' )
+
+def MIXED_CTF ( pixel_size, cs, kv, micrographs_list, negative ) :
+    ## Gctf on every GPU and ctffind4 on the other cpus take their micrographs from one queue,
+    ## each as fast as it goes
+    todo = pending_ctf ( micrographs_list, 'mixed' )
+    if len (todo) == 0 :
+        print ('\n CTF of all micrographs is already known\n')
+        return
+    number_of_gpus = number_of_gpu()
+    number_of_cpus = max ( 1, number_of_cpu() - number_of_gpus )
+    output = open("mixed.log", 'a')
+    gctf_command = ctfjobs.gctf_commands ( pixel_size, cs, kv, negative )
+    pools = [ ( 'gctf', gpu_ids(), adaptive ( gctf_command, 'gctf' ) ),
+              ( 'ctffind4', range(number_of_cpus), adaptive ( ctfjobs.ctffind4_commands ( pixel_size, cs, kv ), 'ctffind4' ) ) ]
+    ps = gpudispatch.dispatch_mixed( todo, pools, output )
+
+    #Keep the user informed
+    print ('\n I am going to calculate CTF for your micrographs using Gctf (', number_of_gpus, 'GPUs ) and ctffind4 (', number_of_cpus, 'CPUs )\n')
+    expected = [ ctfjobs.ctf_stem( m ) + '.ctf' for m in todo ]
+    jobwatch.wait_for_outputs( "*.ctf", len (todo ), ps, expected=expected )
+    ## the logs come after the .ctf
+    for p in ps :
+        p.wait()
+    ## every pool narrows its own defocus search, its suspect fits are done again on its own slots
+    for kind, slots, command in pools :
+        full_search_refits ( command, ps, slots, output, min_bytes=0 if kind == 'ctffind4' else gpudispatch.MIN_BATCH_BYTES )
+    output.close()
+    done = gpudispatch.files_by_kind( ps )
+    print (' Gctf :', len ( done.get('gctf', []) ), 'micrographs, ctffind4 :', len ( done.get('ctffind4', []) ), 'micrographs' )
+    record_ctf ( done.get('gctf', []), 'mixed', '_gctf.log' )
+    record_ctf ( done.get('ctffind4', []), 'mixed', '.txt' )
+    ctfcache.store ( defocuswindow.full_search ( pools[0][2], done.get('gctf', []) ), ctfcache.command_key ( gctf_command ) )
+
+def CONSENSUS_CTF ( pixel_size, cs, kv, micrographs_list, negative ) :
+    ## Gctf on the GPUs and ctffind4 on the other cpus both do every micrograph, at the same time.
+    ## ctffind4 writes to CONSENSUS_DIR so the two .ctf files do not collide
+    todo = pending_ctf ( micrographs_list, 'consensus' )
+    if len (todo) == 0 :
+        print ('\n CTF of all micrographs is already known\n')
+        return
+    number_of_gpus = number_of_gpu()
+    number_of_cpus = max ( 1, number_of_cpu() - number_of_gpus )
+    if os.path.isdir( CONSENSUS_DIR ) != True :
+        os.mkdir( CONSENSUS_DIR )
+    gctf_output = open("gctf.log", 'a')
+    ctffind_output = open("ctffind4.log", 'a')
+    gctf_command = ctfjobs.gctf_commands ( pixel_size, cs, kv, negative )
+    gctf_ps = gpudispatch.dispatch( todo, gpu_ids(), gctf_command, gctf_output )
+    ctffind_ps = gpudispatch.dispatch( todo, range(number_of_cpus), ctfjobs.ctffind4_commands ( pixel_size, cs, kv, CONSENSUS_DIR ), ctffind_output, min_bytes=0 )
+
+    #Keep the user informed
+    print ('\n I am going to calculate CTF for your micrographs using Gctf (', number_of_gpus, 'GPUs ) and ctffind4 (', number_of_cpus, 'CPUs ) at the same time\n')
+    stems = [ ctfjobs.ctf_stem( m ) for m in todo ]
+    jobwatch.wait_for_outputs( "*.ctf", len (todo ), gctf_ps, label='Micrographs are done by Gctf', expected=[ s + '.ctf' for s in stems ] )
+    jobwatch.wait_for_outputs( CONSENSUS_DIR + "*.ctf", len (todo ), ctffind_ps, label='Micrographs are done by ctffind4', expected=[ s + '.ctf' for s in stems ] )
+    gctf_output.close()
+    ctffind_output.close()
+    if manifest is not None :
+        names = micdb.names_for( manifest, todo )
+        done = [ n for n, s in zip( names, stems ) if os.path.exists( s + '_gctf.log' ) and os.path.exists( CONSENSUS_DIR + s + '.txt' ) ]
+        micdb.mark( manifest, done, 'consensus' )
+        micdb.mark( manifest, sorted ( set ( names ) - set ( done ) ), 'consensus', 'failed' )
+    ctfcache.store ( todo, ctfcache.command_key ( gctf_command ) )
+
+def write_consensus_stars ( agreement, matching, differ ) :
+    ## the micrographs both programs agree on ( and better than --rcut ) and the others, with the
+    ## Gctf values, as micrographs_ctf.star
+    good = agreement['agree'] == 1
+    if float ( drift_parameters['rescut'] ) != 0 :
+        good &= agreement['gctf_resolution'] < float ( drift_parameters['rescut'] )
+    ac = 0.35 if drift_parameters['negative'] == 1 else 0.07
+    suf = '.' + drift_parameters['micrograph_name_suffix']
+    for filename, rows in ( ( matching, good ), ( differ, agreement['agree'] == 0 ) ) :
+        table = agreement[rows]
+        ctflog.write_micrographs_star( filename, [ str ( m ) + suf for m in table['micrograph'] ], table['gctf_defocus_u'], table['gctf_defocus_v'],
+                                       table['gctf_defocus_angle'], table['gctf_ccc'], table['gctf_resolution'],
+                                       drift_parameters['pixel_size'], drift_parameters['kv'], drift_parameters['cs'], ac )
+    return int ( good.sum() ), int ( ( agreement['agree'] == 0 ).sum() )
+
+def write_triage_stars ( results ) :
+    ## micrographs_selected.star and micrographs_rejected.star in the data directory, the
+    ## micrographs whose fit is far off the others are rejected ( see triage )
+    ac = 0.35 if drift_parameters['negative'] == 1 else 0.07
+    suf = '.' + drift_parameters['micrograph_name_suffix']
+    star = ctflog.micrographs_star( [ str ( m ) + suf for m in results['micrograph'] ], results['defocus_u'], results['defocus_v'],
+                                    results['defocus_angle'], results['ccc'], results['resolution'],
+                                    drift_parameters['pixel_size'], drift_parameters['kv'], drift_parameters['cs'], ac )
+    keep, reasons = triage.select( results, drift_parameters['triage'] )
+    selected, rejected = triage.write_stars( star, keep, reasons, output_path ( triage.SELECTED ), output_path ( triage.REJECTED ) )
+    triage.report( [ ( str ( m ), r ) for m, r, k in zip( star['rlnMicrographName'], reasons, keep ) if not k ], len ( star ), triage.REJECTED )
+    drift_parameters['triage_counts'] = ( selected, rejected )
 
 def CTFFIND4 ( pixel_size, cs, kv, micrographs_list) :
     number_of_cpus = number_of_cpu()
 
     the_dot_with_suff = '.' + drift_parameters['micrograph_name_suffix']
-    for mics in micrographs_list :
-       micname =     mics.split('/')[-1]
-       write_ctffind4_input( micname,pixel_size ,cs, kv   )
-    com_list = glob.glob("*.com" )
-    split_by_cpu = np.array_split(com_list,number_of_cpus)
-    for i in range (number_of_cpus) :
-        out = 'cpu'+ str (i)
-        outfile = open ( out, 'w')
-        for j in split_by_cpu[i] :
-            outfile.write( j ) 
-            outfile.write("\n"  ) 
-        outfile.close()
-        st = os.stat(out)
-        os.chmod(out, st.st_mode | stat.S_IEXEC)
-
-    ps = []
-    output = open("test.log", 'w')
-    for i in range(number_of_cpus) :
-        args = 'cpu'+ str (i)
-        proc = subp.Popen( args,  shell = True,  stdout = output)
-        time.sleep(0.1)
-        ps.append(proc)
+    if manifest is not None :
+        names = micdb.names_for( manifest, micrographs_list )
+        pending = set ( micdb.pending( manifest, names, 'ctffind4' ) )
+        micrographs_list = [ m for m, n in zip( micrographs_list, names ) if n in pending ]
+        if len (micrographs_list) == 0 :
+            print ('\n CTF of all micrographs is already known\n')
+            return
+    ## one .com per micrograph, written when a cpu takes it so the defocus search can narrow
+    output = open("ctffind4.log", 'a')
+    window = adaptive ( ctfjobs.ctffind4_commands ( pixel_size, cs, kv ), 'ctffind4' )
+    ps = gpudispatch.dispatch( micrographs_list, range(number_of_cpus), window, output, min_bytes=0 )
 
     #Keep the user informed
-    a = len(glob.glob("*.ctf" ))
-    b = len (micrographs_list )
-    c = 0
     print ('\n I am going to calculate CTF for your micrographs using ctffind4\n')
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob("*.ctf" ))
-
-    for p in ps:
-        p.wait()
+    expected = [ ctfjobs.ctf_stem( m ) + '.ctf' for m in micrographs_list ]
+    jobwatch.wait_for_outputs( "*.ctf", len (micrographs_list ), ps, expected=expected )
+    full_search_refits ( window, ps, range(number_of_cpus), output, min_bytes=0 )
+    output.close()
+    record_ctf ( micrographs_list, 'ctffind4', '.txt' )
 
         
 def grep(pattern,fileObj):
@@ -368,55 +635,84 @@ def tail(file):
     with open(file, 'r') as o:
         return o.readlines()[-1]
 
-def CTFFIND4_results_list () :
-    defocus1_list = []
-    defocus2_list = []
-    defocus_angle_list = []
-    CCC_list = []
-    resolution_list = []
-
-    for file in glob.glob("*.txt") :
-        if 'avrot'not  in file :
-            b  =  tail(file )
-            defocus1_list.append(b.split()[1])
-            defocus2_list.append(b.split()[2])
-            defocus_angle_list.append(b.split()[3])
-            CCC_list.append(b.split()[5])
-            resolution_list.append(b.split()[6])
-    for i in  range (len (resolution_list)) :
-        if ( resolution_list[i] == 'inf' ) :
-            resolution_list[i] = 50 
-    defocus1_list = list(map(float, defocus1_list))
-    defocus2_list = list(map(float, defocus2_list))
-    defocus_angle_list = list(map(float, defocus_angle_list))
-    CCC_list = list(map(float, CCC_list))
-    resolution_list = list(map(float, resolution_list))
-    return defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list
-
-def GCTF_results_list () :
-    defocus1_list = []
-    defocus2_list = []
-    defocus_angle_list = []
-    CCC_list = []
-    resolution_list = []
-    for file in glob.glob("*_gctf.log") :
-        myfile = open (file, "r" )
-        b  =  ' '.join(grep("Final",myfile ))
-        defocus1_list.append(b.split()[0])
-        defocus2_list.append(b.split()[1])
-        defocus_angle_list.append(b.split()[2])
-        CCC_list.append(b.split()[3])
-    for file in glob.glob("*_gctf.log") :
-        myfile = open (file, "r" )
-        b  =  ' '.join(grep("RES_LIMIT",myfile ))
-        resolution_list.append(b.split()[-1])
-    defocus1_list = list(map(float, defocus1_list))
-    defocus2_list = list(map(float, defocus2_list))
-    defocus_angle_list = list(map(float, defocus_angle_list))
-    CCC_list = list(map(float, CCC_list))
-    resolution_list = list(map(float, resolution_list))
-    myfile.close()
-    return defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list
+def results_lists ( results ) :
+    ## the five lists the plots take, from a ctflog table
+    return [ results[field].tolist() for field in ( 'defocus_u', 'defocus_v', 'defocus_angle', 'ccc', 'resolution' ) ]
+
+def CTFFIND4_results ( files=None ) :
+    if files is None :
+        files = glob.glob("*.txt")
+    return ctflog.parse_logs( files, 'ctffind4', number_of_cpu() )
+
+def CTFFIND4_results_list ( files=None ) :
+    return results_lists ( CTFFIND4_results ( files ) )
+
+def GCTF_results ( logs=None ) :
+    ## every log read once: the defocus, resolution and validation scores together
+    if logs is None :
+        logs = glob.glob("*_gctf.log")
+    return ctflog.parse_logs( logs, 'gctf', number_of_cpu() )
+
+def GCTF_results_list ( logs=None ) :
+    return results_lists ( GCTF_results ( logs ) )
+
+def MIXED_results ( stems=None ) :
+    ## --ctf=mixed: the Gctf logs and the ctffind4 .txt files as one table, with the estimator
+    ## of every micrograph
+    if stems is None :
+        logs = glob.glob("*_gctf.log")
+        txts = glob.glob("*.txt")
+    else :
+        logs = [ s + '_gctf.log' for s in stems if os.path.isfile( s + '_gctf.log' ) ]
+        txts = [ s + '.txt' for s in stems if os.path.isfile( s + '.txt' ) ]
+    return ctflog.merge_results( [ ( 'gctf', GCTF_results ( logs ) ), ( 'ctffind4', CTFFIND4_results ( txts ) ) ] )
+
+def estimator_counts ( results ) :
+    names, counts = np.unique( results['estimator'], return_counts=True )
+    return dict ( zip ( [ str ( n ) for n in names ], counts.tolist() ) )
+
+def plot_only_results ( kind ) :
+    ## --plot: the logs in this directory through the ctflog cache, only new or changed logs are read
+    files = glob.glob( '*' + ctflog.SUFFIXES[kind] )
+    return ctflog.cached_logs( files, kind, processes=number_of_cpu() )
+
+def make_atlas ( results, filename ) :
+    ## --atlas: a row for every micrograph of a ctflog table, the micrographs are in the data
+    ## directory and the .ctf diagnostic images next to the logs
+    if not drift_parameters['atlas'] :
+        return
+    print ('\nI am making the micrograph atlas')
+    suf = '.' + drift_parameters['micrograph_name_suffix']
+    stems = [ str ( m ) for m in results['micrograph'] ]
+    atlas.write_atlas( filename, results, [ os.path.join( drift_parameters['datadir'], s + suf ) for s in stems ], [ s + '.ctf' for s in stems ], drift_parameters['atlas'], number_of_cpu() )
+    print ('Atlas PDF file             :', os.path.basename( filename ) )
+
+def estimator_name () :
+    if drift_parameters['gctf'] == 1 :
+        return 'gctf'
+    if drift_parameters['mixed'] == 1 :
+        return 'mixed'
+    if drift_parameters['consensus'] == 1 :
+        return 'consensus'
+    if drift_parameters['native'] == 1 :
+        return 'native'
+    return 'ctffind4'
+
+def catalog_session ( results, estimator ) :
+    ## adds the session and the ctf of every micrograph to the facility catalog ( emcatalog.py )
+    if drift_parameters['catalog'] == 'no' or len ( results ) == 0 :
+        return
+    started = time.mktime( time.strptime( drift_parameters['time'], "%d_%b_%Y_%I_%M_%S%p" ) )
+    try :
+        db = catalog.open_catalog( drift_parameters['catalog'] )
+        try :
+            catalog.add_session( db, drift_parameters['timestamp'], results, estimator, drift_parameters['datadir'], started,
+                                 drift_parameters['user'], drift_parameters['Microscope'], drift_parameters['magnification'],
+                                 drift_parameters['pixel_size'], drift_parameters['kv'], drift_parameters['cs'], drift_parameters['input_commands'] )
+        finally :
+            db.close()
+    except ( sqlite3.Error, OSError ) as e :
+        print ('\nThe session is not in the catalog', drift_parameters['catalog'], ':', e )
 
 def plot_only_gctf_micrographs_list () :
     suf = '.' + drift_parameters['micrograph_name_suffix']
@@ -439,33 +735,52 @@ def plot_only_ctffind4_micrographs_list () :
     micrographs_total = len (micrographs_list)
     return micrographs_total, micrographs_list
 
-def power_calculation () :
-    id_list = [ 3336, 491 ]
-    extra_calculation = 0
-    for id in id_list :
-        if id == drift_parameters['user_uid'] :
-            a = 1
-    if a == 1 :
-        extra_calculation = 1
-    else :
-        print ('Not implemented' )
-        quit ()
-    return extra_calculation
+def validation_bins () :
+    ## Gctf validation bins that are meaningful for this pixel size
+    bins_list = [ '20-08A', '15-06A', '12-05A','10-04A','08-03A' ]
+    if ( float ( drift_parameters['pixel_size'] ) * 2  ) < 3 :
+        bins_list = [ '20-08A', '15-06A', '12-05A','10-04A','08-03A' ]
+    elif ( float ( drift_parameters['pixel_size'] ) * 2  ) < 4 :
+        bins_list = [ '20-08A', '15-06A', '12-05A','10-04A' ]
+    elif ( float ( drift_parameters['pixel_size'] ) * 2  ) < 5 :
+        bins_list = [ '20-08A', '15-06A', '12-05A', ]
+    elif ( float ( drift_parameters['pixel_size'] ) * 2  ) < 6 :
+        bins_list = [ '20-08A', '15-06A' ]
+    return bins_list
+
+def GCTF_validation_scores ( results ) :
+    return ctflog.validation_scores( results, validation_bins () )
 
-def plot_and_format_results (defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list, text_print_list, time, gctf_flag ) :
+## --ctf=consensus: where ctffind4 writes, next to the Gctf files
+CONSENSUS_DIR = 'ctffind4/'
+
+## above this many micrographs the astigmatism panel is a density image instead of outlines
+ELLIPSE_OUTLINES = 5000
+ASTIGMATISM_PIXELS = 300
+
+def plot_and_format_results (defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list, text_print_list, time, gctf_flag, validation=None, estimators=None ) :
     print ('\nCTF done\nI am plotting the results')
-    mean_defocus1 = round ( sum (defocus1_list) / len (defocus1_list), 1 )
-    mean_defocus2 = round ( sum (defocus2_list) / len (defocus2_list), 1 )
-    mean_defocus_angle = round ( sum (defocus_angle_list) / len (defocus_angle_list), 1 )
-    mean_CCC = round ( sum (CCC_list) / len (CCC_list), 1 )
-    mean_resolution = round ( sum (resolution_list) / len (resolution_list),1 )
+    ## everything is binned with numpy first, the plots only get the counts, and the panels that
+    ## grow with the number of micrographs are rasterized: the time and the size of the PDF stay
+    ## the same for 100 or 50000 micrographs
+    defocus1 = np.asarray( defocus1_list, dtype=np.float64 )
+    defocus2 = np.asarray( defocus2_list, dtype=np.float64 )
+    defocus_angle = np.asarray( defocus_angle_list, dtype=np.float64 )
+    CCC = np.asarray( CCC_list, dtype=np.float64 )
+    resolution = np.asarray( resolution_list, dtype=np.float64 )
+    mean_defocus1 = round ( float ( defocus1.mean() ), 1 )
+    mean_defocus2 = round ( float ( defocus2.mean() ), 1 )
+    mean_defocus_angle = round ( float ( defocus_angle.mean() ), 1 )
+    mean_CCC = round ( float ( CCC.mean() ), 1 )
+    mean_resolution = round ( float ( resolution.mean() ),1 )
     csfont = {'fontname':'Sans-serif'}
 
     plt.style.use('ggplot')
     title_font_size = 12
     summary_font_size = 10
     ax = plt.axes([.65, .6, .4, .4])
-    plt.hist(resolution_list, range(2,30), color='royalblue',alpha=0.75)
+    counts, edges = np.histogram( resolution, range(2,30) )
+    plt.hist(edges[:-1], edges, weights=counts, color='royalblue',alpha=0.75)
     #plt.hist(resolution_list,  color='royalblue',alpha=0.75)
     plt.title('Estimated Resolution', size=title_font_size, y = 1.05 )
     ax.set_xlabel( r'$Resolution ( {\AA})$')
@@ -476,19 +791,21 @@ def plot_and_format_results (defocus1_list, defocus2_list, defocus_angle_list, C
     #ax.xaxis.set_tick_params(labelbottom='off')
 
     ax1 = plt.axes([1.2, .6, .4, .4])
-    plt.hist(CCC_list, color = 'crimson', alpha=0.75)
+    counts, edges = np.histogram( CCC[np.isfinite( CCC )] )
+    plt.hist(edges[:-1], edges, weights=counts, color = 'crimson', alpha=0.75)
     plt.title('CTF Score', size=title_font_size, y = 1.04 )
     ax1.set_xlabel(r'$CCC$')
     ax1.set_ylabel(r'$No.\ of\ Micrographs$')
 
     with plt.style.context(('ggplot')):
-        defocus1_list_in_micrometer = [ x / 10000 for x in defocus1_list ]
-        defocus2_list_in_micrometer = [ x / 10000 for x in defocus2_list ]
+        defocus1_in_micrometer = defocus1 / 10000
+        defocus2_in_micrometer = defocus2 / 10000
         ax3 = plt.axes([0.1, 0.02, .4, .4])
         ax3.set_xlabel (  r'$Defocus-x ({\mu}m)$' )
         ax3.set_ylabel (  r'$Defocus-y ({\mu}m)$' )
 
-        plt.hist2d( defocus1_list_in_micrometer, defocus2_list_in_micrometer, bins = 40, cmap=CM.Blues )
+        counts, xedges, yedges = np.histogram2d( defocus1_in_micrometer, defocus2_in_micrometer, bins = 40 )
+        plt.pcolormesh( xedges, yedges, counts.T, cmap=CM.Blues, rasterized=True )
         plt.colorbar()
         plt.title('Defocus Spread', size=title_font_size, y = 1.05 )
         plt.grid(b=False)
@@ -497,13 +814,15 @@ def plot_and_format_results (defocus1_list, defocus2_list, defocus_angle_list, C
         ax = plt.axes([.1, 0.6, .4, .4 ])
         y = list(reversed(np.arange(0,1,0.15)))
         #text = [time.strftime("%c"),\
-        text = ['Number of  Micrographs : '+ str(len(micrographs_list)),\
+        text = ['Number of  Micrographs : '+ str(len(defocus1_list)),\
                'Mean Resolution estimate : '+str(mean_resolution)+  ' '+  r'$ \AA $',\
                'Mean Defocus estimate : '+str(mean_defocus1)+' '+  r'$ \AA $', \
                'Pixel size : '+ text_print_list[0] +  r'$\ \AA $', \
                'Magnification : '+ text_print_list[1],\
                'Microscope : '+ text_print_list[2]   ]
-        for i in range(6):
+        if estimators :
+            text.append( 'Estimators : ' + ',  '.join( k + ' ' + str ( estimators[k] ) for k in sorted ( estimators ) ) )
+        for i in range(len(text)):
             plt.text(0.05, y[i], text[i], alpha=1,clip_on=True,fontsize=summary_font_size)
             plt.xticks(())
             plt.yticks(())
@@ -515,21 +834,39 @@ def plot_and_format_results (defocus1_list, defocus2_list, defocus_angle_list, C
             title = 'Summary: ' + time
             plt.title(title,size=title_font_size, y = 1.05 )
 
-    from matplotlib.patches import Ellipse
+    from matplotlib.collections import PolyCollection
     
     with plt.style.context(('ggplot')):
-        ells= []
-        xlimit = max(defocus1_list)/10000 + 0.5
-        ylimit = max(defocus2_list)/10000 + 0.5
-        for i, j, k in zip (defocus1_list,defocus2_list,defocus_angle_list ) :
-            ells.append ( Ellipse( xy = [ xlimit/2 , ylimit/2 ] , width = i / 10000 , height = j / 10000 , angle = k, linewidth = 0.4 ) )
+        xlimit = defocus1.max()/10000 + 0.5
+        ylimit = defocus2.max()/10000 + 0.5
         ax = plt.axes([.7 ,  0.02, .3, .4])
-        for e in ells:
-            ax.add_artist(e)
-            e.set_clip_box(ax.bbox)
-            e.set_alpha(0.1)
-            e.set_facecolor('none' )
-            e.set_edgecolor( [0.4, 0.4, 0.4 ])
+        angle = np.radians( defocus_angle )[:, None]
+        a = defocus1[:, None] / 20000
+        b = defocus2[:, None] / 20000
+        if len ( defocus1 ) <= ELLIPSE_OUTLINES :
+            ## all the ellipses as one collection of outlines, drawn as a single image in the PDF
+            t = np.linspace( 0, 2 * np.pi, 65 )
+            x = xlimit/2 + a * np.cos( t ) * np.cos( angle ) - b * np.sin( t ) * np.sin( angle )
+            y = ylimit/2 + a * np.cos( t ) * np.sin( angle ) + b * np.sin( t ) * np.cos( angle )
+            ells = PolyCollection( np.stack( ( x, y ), axis=-1 ), facecolors='none', edgecolors=[ [0.4, 0.4, 0.4, 0.1] ], linewidths=0.4 )
+            ells.set_rasterized( True )
+            ax.add_collection( ells )
+        else :
+            ## too many to draw one by one: how many outlines cross each pixel, as one image
+            size = ASTIGMATISM_PIXELS
+            t = np.linspace( 0, 2 * np.pi, 2 * size, endpoint=False )
+            cos_t, sin_t = np.cos( t ), np.sin( t )
+            density = np.zeros( size * size, dtype=np.int64 )
+            for i in range ( 0, len ( defocus1 ), 1024 ) :
+                cos, sin = np.cos( angle[i:i + 1024] ), np.sin( angle[i:i + 1024] )
+                x = xlimit/2 + a[i:i + 1024] * cos_t * cos - b[i:i + 1024] * sin_t * sin
+                y = ylimit/2 + a[i:i + 1024] * cos_t * sin + b[i:i + 1024] * sin_t * cos
+                ix = np.clip( ( x / xlimit * size ).astype( np.int64 ), 0, size - 1 )
+                iy = np.clip( ( y / ylimit * size ).astype( np.int64 ), 0, size - 1 )
+                density += np.bincount( ( iy * size + ix ).ravel(), minlength=size * size )
+            ## the grey of that many 0.1 alpha outlines on the panel background
+            grey = 0.4 + 0.5 * 0.9 ** density.reshape( size, size )
+            ax.imshow( grey, origin='lower', extent=( 0, xlimit, 0, ylimit ), cmap=CM.gray, vmin=0, vmax=1, aspect='auto', interpolation='nearest' )
            
         ax.grid(b=False)
         ax.set_xlim(0, xlimit)
@@ -541,61 +878,15 @@ def plot_and_format_results (defocus1_list, defocus2_list, defocus_angle_list, C
     
     if ( gctf_flag == 1 ) :
         ax = plt.axes([1.2 , 0.02, .4, .4])
-        scores_twenty_to_eight,scores_fifteen_to_six,scores_twelve_to_five,scores_ten_to_four,scores_eight_to_three = ([] for i in range(5))
-        bins_list = [ '20-08A', '15-06A', '12-05A','10-04A','08-03A' ]
-        if ( float ( drift_parameters['pixel_size'] ) * 2  ) < 3 :
-            bins_list = [ '20-08A', '15-06A', '12-05A','10-04A','08-03A' ]
-        elif ( float ( drift_parameters['pixel_size'] ) * 2  ) < 4 :
-            bins_list = [ '20-08A', '15-06A', '12-05A','10-04A' ]
-            scores_eight_to_three.append(1)
-        elif ( float ( drift_parameters['pixel_size'] ) * 2  ) < 5 :
-            bins_list = [ '20-08A', '15-06A', '12-05A', ]
-            scores_eight_to_three.append(1)
-            scores_ten_to_four.append(1) 
-        elif ( float ( drift_parameters['pixel_size'] ) * 2  ) < 6 :
-            bins_list = [ '20-08A', '15-06A' ]
-            scores_eight_to_three.append(1)
-            scores_ten_to_four.append(1) 
-            scores_twelve_to_five.append(1)
-
-        for file in glob.glob("*_gctf.log") :
-            for bin in bins_list :
-                myfile = open (file, "r" )
-                if   ( bin == '20-08A' ):
-                    a  =  ' '.join(grep(bin,myfile ))
-                    scores_twenty_to_eight.append ((a.split()[-1]))
-                elif ( bin == '15-06A' ):
-                    a  =  ' '.join(grep(bin,myfile ))
-                    scores_fifteen_to_six.append ((a.split()[-1]))
-                elif ( bin == '12-05A' ):
-                    a  =  ' '.join(grep(bin,myfile ))
-                    scores_twelve_to_five.append ((a.split()[-1]))
-                elif ( bin == '10-04A' ):
-                    a  =  ' '.join(grep(bin,myfile ))
-                    scores_ten_to_four.append ((a.split()[-1]))
-                elif ( bin == '08-03A' ):
-                    a  =  ' '.join(grep(bin,myfile ))
-                    scores_eight_to_three.append ((a.split()[-1]))
-        myfile.close()
-        scores_twenty_to_eight = (np.array(list(map(int, scores_twenty_to_eight ))))
-        scores_fifteen_to_six  = (np.array(list(map(int, scores_fifteen_to_six ))))
-        scores_twelve_to_five  = (np.array(list(map(int, scores_twelve_to_five ))))
-        scores_ten_to_four     = (np.array(list(map(int, scores_ten_to_four ))))
-        scores_eight_to_three  = (np.array(list(map(int, scores_eight_to_three ))))
-
-        scores_list = ( scores_twenty_to_eight,scores_fifteen_to_six,scores_twelve_to_five,scores_ten_to_four,scores_eight_to_three )
-        scores = []
-        for name in scores_list :
-            for i in range(1,6):
-                scores.append(np.sum ( name == i ))
-        j = 1
-        x = []
-        y = []
-        for i in scores_list :
-            x.extend ([j] * len (i)  )
-            y.extend (i)
-            j += 1
-        plt.hist2d ( x, y, bins = 5, cmap=CM.Blues )
+        if validation is None :
+            validation = GCTF_validation_scores ( GCTF_results () )
+        ## counts [ resolution bin, score 1..5 ] on fixed edges, so bins beyond Nyquist are
+        ## empty columns and the panel always has five
+        bin_keys = [ '20-08A', '15-06A', '12-05A', '10-04A', '08-03A' ]
+        counts = np.array( [ np.bincount( np.clip( np.asarray( validation.get( key, [] ), dtype=np.int64 ), 0, 6 ), minlength=7 )[1:6] for key in bin_keys ] )
+        scores = counts.ravel().tolist()
+        edges = np.linspace( 1, 5, 6 )
+        plt.pcolormesh( edges, edges, counts.T, cmap=CM.Blues )
         plt.grid(b=False)
 
         x = [ 1.4, 2.2, 2.9 ,3.7, 4.5, 5.5 ]
@@ -633,10 +924,10 @@ def plot_and_format_results (defocus1_list, defocus2_list, defocus_angle_list, C
 
     plt.savefig('try.pdf',bbox_inches='tight')
     plt.gcf().clear()
-    drift_parameters['output_text'] = [ len(micrographs_list) , mean_resolution, mean_defocus1, text_print_list[0] , text_print_list[1], text_print_list[2] ]
+    drift_parameters['output_text'] = [ len(defocus1_list) , mean_resolution, mean_defocus1, text_print_list[0] , text_print_list[1], text_print_list[2] ]
 
 def make_output_pdf ( filename ) :
-    output_file_name =  '../' + filename +'.pdf'
+    output_file_name =  output_path ( filename +'.pdf' )
     if os.path.isfile("try.pdf"):
         shutil.move("try.pdf", output_file_name)
         #print ('\nCaculations are done.. Your output PDF is :',filename+'.pdf\n')
@@ -655,44 +946,215 @@ def make_output_pdf_plot_only ( filename ) :
         print ('something went wrong.. Inform Rajan')
     return pdf
 
-def make_clean ( datadir, workdir, miclist ) :
+def make_clean ( datadir, workdir ) :
+    ## the work directory is renamed and removed in the background, links and all
     os.chdir ( datadir )
-    remove_dir = datadir + '/' + workdir 
-    #os.system( rmdir )
-    for link in miclist :
-        os.unlink(link) 
-    tempdir = datadir +'/'+workdir+'/*'
-    #print ('I am cleaning up the temp files' )
-    for file in glob.glob(tempdir) :
-        os.remove(file)
-    #time.sleep(3)
-    shutil.rmtree( remove_dir, ignore_errors=True )
+    staging.reap( workdir )
+
+def list_new_micrographs ( micdir, pattern, exclude, seen, sizes ) :
+    ## one directory read per poll. A file is taken once its size is the same in two polls,
+    ## so we do not start on micrographs that are still being written by EPU/rsync
+    new = []
+    current = {}
+    for entry in os.scandir( micdir ) :
+        name = entry.name
+        if name in seen or name.startswith('.') or exclude in name or not fnmatch.fnmatch( name, pattern ) :
+            continue
+        try :
+            size = entry.stat().st_size
+        except OSError :
+            continue
+        current[name] = size
+        if size > 0 and sizes.get(name) == size :
+            new.append( name )
+    sizes.clear()
+    sizes.update( current )
+    return sorted ( new )
+
+def watch_session ( pattern ) :
+    ## live mode: ctf only for the new micrographs, the PDF is redrawn from the running lists
+    datadir = drift_parameters['datadir']
+    workdir = drift_parameters['workdir']
+    os.makedirs( workdir )
+    os.chdir ( workdir )
+    name = drift_parameters['timestamp'] + '_' + estimator_name().upper()
+    results = ( [], [], [], [], [] )
+    tables = []
+    validation = {}
+    estimators = {}
+    seen = set()
+    sizes = {}
+    skipped = []
+    pdf = None
+    since_plot = 0
+    last_plot = time.time()
+
+    def refresh () :
+        defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = results
+        gctf_flag = 1 if ( drift_parameters['gctf'] == 1 or estimators.get('gctf') ) else 0
+        plot_and_format_results(defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list , text_print_list, drift_parameters['time'], gctf_flag, validation, estimators )
+        return make_output_pdf ( name )
+
+    print ('\nWatching', datadir, 'for new micrographs, press Ctrl-C to stop')
+    try :
+        while True :
+            new = list_new_micrographs ( datadir, pattern, drift_parameters['micrograph_name_exclude'], seen, sizes )
+            if new and drift_parameters['prescreen'] == 1 :
+                seen.update ( new )
+                kept = screen_micrographs ( [ os.path.join( datadir, mic ) for mic in new ], skipped, len ( seen ) )[0]
+                new = [ os.path.basename( mic ) for mic in kept ]
+            if new :
+                print ('\n', len (new), 'new micrographs' )
+                seen.update ( new )
+                batch = [ os.path.join( datadir, mic ) for mic in new ]
+                if drift_parameters['gctf'] == 1 or drift_parameters['mixed'] == 1 :
+                    batch = staging.link_many( batch, workdir )
+                if drift_parameters['gctf'] == 1 :
+                    stems = [ os.path.splitext(mic)[0] for mic in new ]
+                    GCTF( drift_parameters['pixel_size'], drift_parameters['cs'], drift_parameters['kv'], batch, drift_parameters['negative'])
+                    logs = [ s + '_gctf.log' for s in stems if os.path.isfile( s + '_gctf.log' ) ]
+                    table = GCTF_results ( logs )
+                    new_results = results_lists ( table )
+                    for bin, scores in GCTF_validation_scores ( table ).items() :
+                        validation.setdefault( bin, [] ).extend( scores )
+                elif drift_parameters['mixed'] == 1 :
+                    MIXED_CTF( drift_parameters['pixel_size'], drift_parameters['cs'], drift_parameters['kv'], batch, drift_parameters['negative'])
+                    table = MIXED_results ( [ os.path.splitext(mic)[0] for mic in new ] )
+                    new_results = results_lists ( table )
+                    for bin, scores in GCTF_validation_scores ( table[ table['estimator'] == 'gctf' ] ).items() :
+                        validation.setdefault( bin, [] ).extend( scores )
+                    for estimator, count in estimator_counts ( table ).items() :
+                        estimators[estimator] = estimators.get( estimator, 0 ) + count
+                else :
+                    if drift_parameters['native'] == 1 :
+                        NATIVE_CTF( drift_parameters['pixel_size'], drift_parameters['cs'], drift_parameters['kv'], batch, drift_parameters['negative'])
+                    else :
+                        CTFFIND4( drift_parameters['pixel_size'], drift_parameters['cs'], drift_parameters['kv'], batch)
+                    stems = [ ctfjobs.ctf_stem( mic ) for mic in new ]
+                    txts = [ s + '.txt' for s in stems if os.path.isfile( s + '.txt' ) ]
+                    table = CTFFIND4_results ( txts )
+                    new_results = results_lists ( table )
+                for total, part in zip ( results, new_results ) :
+                    total.extend ( part )
+                tables.append ( table )
+                since_plot += len (new)
+            minutes = ( time.time() - last_plot ) / 60.0
+            if results[0] and since_plot > 0 and ( since_plot >= drift_parameters['watch_every'] or minutes >= drift_parameters['watch_minutes'] ) :
+                pdf = refresh ()
+                print ('Updated', pdf, 'with', len (results[0]), 'micrographs' )
+                since_plot = 0
+                last_plot = time.time()
+            if not new :
+                time.sleep ( drift_parameters['watch_poll'] )
+    except KeyboardInterrupt :
+        print ('\nStopping the watch')
+    if results[0] and ( since_plot > 0 or pdf is None ) :
+        pdf = refresh ()
+    if pdf is None :
+        print ('No micrographs arrived, nothing to summarise')
+        make_clean ( datadir, workdir )
+        quit ()
+    return pdf, relionstar.concatenate( tables )
 
 
 ## Call modules and get the job done
 ## check if all ok
-extra_calculations = power_calculation()
+manifest = None
+
+if  drift_parameters['watch'] == 1 :
+    pattern = '*'+drift_parameters['micrograph_name_pattern'] +'*'+ drift_parameters['micrograph_name_suffix']
+    pdf, watch_results = watch_session ( pattern )
+    write_triage_stars ( watch_results )
+    catalog_session ( watch_results, estimator_name() )
+    drift_parameters['gctf'] = 0
+    drift_parameters['ctffind4'] = 0
+    drift_parameters['native'] = 0
+    drift_parameters['mixed'] = 0
 
 if  drift_parameters['gctf'] == 1 :
     pattern = '*'+drift_parameters['micrograph_name_pattern'] +'*'+ drift_parameters['micrograph_name_suffix']
     micrographs_total, micrographs_list = count_micrographs(pattern, drift_parameters['datadir'], drift_parameters['micrograph_name_exclude']  )
-    make_dir_soft_links(drift_parameters['workdir'],drift_parameters['datadir'] , pattern, drift_parameters['micrograph_name_exclude']    )
-    micrographs_total, micrographs_list,mics_names_list = count_micrographs_workdir(pattern, drift_parameters['workdir'])
+    manifest = micdb.open_manifest( drift_parameters['workdir'] )
+    micdb.register( manifest, micrographs_list )
+    micrographs_list = stage_micrographs ( micrographs_list, True )
     GCTF( drift_parameters['pixel_size'], drift_parameters['cs'], drift_parameters['kv'], micrographs_list, drift_parameters['negative'])
-    defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = GCTF_results_list()
-    plot_and_format_results(defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list , text_print_list, drift_parameters['time'] , 1 )
+    gctf_results = GCTF_results()
+    defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = results_lists ( gctf_results )
+    plot_and_format_results(defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list , text_print_list, drift_parameters['time'] , 1, GCTF_validation_scores ( gctf_results ) )
     pdf = make_output_pdf ( drift_parameters['timestamp']+'_GCTF'  )
+    make_atlas ( gctf_results, output_path ( drift_parameters['timestamp'] + '_GCTF_atlas.pdf' ) )
+    write_triage_stars ( gctf_results )
+    catalog_session ( gctf_results, 'gctf' )
+
+if  drift_parameters['mixed'] == 1 :
+    pattern = '*'+drift_parameters['micrograph_name_pattern'] +'*'+ drift_parameters['micrograph_name_suffix']
+    micrographs_total, micrographs_list = count_micrographs(pattern, drift_parameters['datadir'], drift_parameters['micrograph_name_exclude']  )
+    manifest = micdb.open_manifest( drift_parameters['workdir'] )
+    micdb.register( manifest, micrographs_list )
+    micrographs_list = stage_micrographs ( micrographs_list, True )
+    MIXED_CTF( drift_parameters['pixel_size'], drift_parameters['cs'], drift_parameters['kv'], micrographs_list, drift_parameters['negative'])
+    mixed_results = MIXED_results()
+    gctf_rows = mixed_results[ mixed_results['estimator'] == 'gctf' ]
+    defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = results_lists ( mixed_results )
+    plot_and_format_results(defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list , text_print_list, drift_parameters['time'] , 1 if len ( gctf_rows ) else 0,
+                            GCTF_validation_scores ( gctf_rows ), estimator_counts ( mixed_results ) )
+    pdf = make_output_pdf ( drift_parameters['timestamp']+'_MIXED'  )
+    ## which program did which micrograph
+    relionstar.write_loop( output_path ( drift_parameters['timestamp'] + '_MIXED.star' ), mixed_results )
+    make_atlas ( mixed_results, output_path ( drift_parameters['timestamp'] + '_MIXED_atlas.pdf' ) )
+    write_triage_stars ( mixed_results )
+    catalog_session ( mixed_results, 'mixed' )
+
+if  drift_parameters['consensus'] == 1 :
+    pattern = '*'+drift_parameters['micrograph_name_pattern'] +'*'+ drift_parameters['micrograph_name_suffix']
+    micrographs_total, micrographs_list = count_micrographs(pattern, drift_parameters['datadir'], drift_parameters['micrograph_name_exclude']  )
+    manifest = micdb.open_manifest( drift_parameters['workdir'] )
+    micdb.register( manifest, micrographs_list )
+    micrographs_list = stage_micrographs ( micrographs_list, True )
+    CONSENSUS_CTF( drift_parameters['pixel_size'], drift_parameters['cs'], drift_parameters['kv'], micrographs_list, drift_parameters['negative'])
+    gctf_results = GCTF_results()
+    ctffind_results = CTFFIND4_results( glob.glob( CONSENSUS_DIR + '*.txt' ) )
+    agreement = ctflog.consensus( gctf_results, ctffind_results, ( 'gctf', 'ctffind4' ), drift_parameters['defocus_tolerance'],
+                                  drift_parameters['astigmatism_tolerance'], drift_parameters['resolution_tolerance'] )
+    defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = results_lists ( gctf_results )
+    plot_and_format_results(defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list , text_print_list, drift_parameters['time'] , 1, GCTF_validation_scores ( gctf_results ) )
+    pdf = make_output_pdf ( drift_parameters['timestamp']+'_CONSENSUS'  )
+    relionstar.write_loop( output_path ( drift_parameters['timestamp'] + '_CONSENSUS.star' ), agreement )
+    matching, differ = write_consensus_stars ( agreement, output_path ( 'micrographs_ctf_matching.star' ), output_path ( 'micrographs_ctf_differ.star' ) )
+    make_atlas ( gctf_results, output_path ( drift_parameters['timestamp'] + '_CONSENSUS_atlas.pdf' ) )
+    write_triage_stars ( gctf_results )
+    catalog_session ( gctf_results, 'consensus' )
 
 if  drift_parameters['ctffind4'] == 1 :
     pattern = '*'+drift_parameters['micrograph_name_pattern'] +'*'+ drift_parameters['micrograph_name_suffix']
     micrographs_total, micrographs_list = count_micrographs(pattern, drift_parameters['datadir'], drift_parameters['micrograph_name_exclude']  )
-    if drift_parameters['power_users'] == 0 :
-        make_dir_soft_links(drift_parameters['workdir'],drift_parameters['datadir'] , pattern, drift_parameters['micrograph_name_exclude']    )
-    micrographs_total, micrographs_list,mics_names_list = count_micrographs_workdir(pattern, drift_parameters['workdir'])
+    if manifest is None :
+        manifest = micdb.open_manifest( drift_parameters['workdir'] )
+        micdb.register( manifest, micrographs_list )
+    micrographs_list = stage_micrographs ( micrographs_list, False )
     CTFFIND4( drift_parameters['pixel_size'], drift_parameters['cs'], drift_parameters['kv'], micrographs_list)
-    defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = CTFFIND4_results_list()
+    ctffind_results = CTFFIND4_results()
+    defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = results_lists ( ctffind_results )
     plot_and_format_results(defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list , text_print_list, drift_parameters['time'],  0 )
     pdf = make_output_pdf ( drift_parameters['timestamp']+'_CTFFIND4'  )
+    make_atlas ( ctffind_results, output_path ( drift_parameters['timestamp'] + '_CTFFIND4_atlas.pdf' ) )
+    write_triage_stars ( ctffind_results )
+    catalog_session ( ctffind_results, 'ctffind4' )
+
+if  drift_parameters['native'] == 1 :
+    pattern = '*'+drift_parameters['micrograph_name_pattern'] +'*'+ drift_parameters['micrograph_name_suffix']
+    micrographs_total, micrographs_list = count_micrographs(pattern, drift_parameters['datadir'], drift_parameters['micrograph_name_exclude']  )
+    manifest = micdb.open_manifest( drift_parameters['workdir'] )
+    micdb.register( manifest, micrographs_list )
+    micrographs_list = stage_micrographs ( micrographs_list, False )
+    NATIVE_CTF( drift_parameters['pixel_size'], drift_parameters['cs'], drift_parameters['kv'], micrographs_list, drift_parameters['negative'])
+    ctffind_results = CTFFIND4_results()
+    defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = results_lists ( ctffind_results )
+    plot_and_format_results(defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list , text_print_list, drift_parameters['time'],  0 )
+    pdf = make_output_pdf ( drift_parameters['timestamp']+'_NATIVE'  )
+    make_atlas ( ctffind_results, output_path ( drift_parameters['timestamp'] + '_NATIVE_atlas.pdf' ) )
+    write_triage_stars ( ctffind_results )
+    catalog_session ( ctffind_results, 'native' )
 
 
 if  drift_parameters['plot_only'] == 1 :
@@ -706,9 +1168,11 @@ if  drift_parameters['plot_only'] == 1 :
 
     if gctf_logs > 0 :
         micrographs_total, micrographs_list = plot_only_gctf_micrographs_list ()
-        defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = GCTF_results_list()
+        gctf_results = plot_only_results ( 'gctf' )
+        defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = results_lists ( gctf_results )
         plot_and_format_results(defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list , text_print_list, drift_parameters['time'] , 0 )
         pdf = make_output_pdf_plot_only ( drift_parameters['timestamp'] + '-GCTF' )
+        make_atlas ( gctf_results, drift_parameters['timestamp'] + '-GCTF_atlas.pdf' )
    
     if ctffind3_logs > 0 :
         micrographs_total, micrographs_list = plot_only_ctffind3_micrographs_list ()
@@ -717,49 +1181,12 @@ if  drift_parameters['plot_only'] == 1 :
         pdf = make_output_pdf_plot_only ( drift_parameters['timestamp'] + '-CTFFIND3' )
    
     if ctffind4_logs > 0 :
-        micrographs_total, micrographs_list = plot_only_ctffind3_micrographs_list ()
-        defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = CTFFIND4_results_list()
+        micrographs_total, micrographs_list = plot_only_ctffind4_micrographs_list ()
+        ctffind_results = plot_only_results ( 'ctffind4' )
+        defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list = results_lists ( ctffind_results )
         plot_and_format_results(defocus1_list, defocus2_list, defocus_angle_list, CCC_list, resolution_list , text_print_list, drift_parameters['time'] , 0 )
         pdf = make_output_pdf_plot_only ( drift_parameters['timestamp'] + '_CTFFIND4' )
-
-if drift_parameters['power_users'] == 1 and extra_calculations == 1:
-    power_calculation()
-    micrographs_total, micrographs_list,mics_names_list = count_micrographs_workdir(pattern, drift_parameters['workdir'])
-    suf = '.' + drift_parameters['micrograph_name_suffix']
-    names_list = [w.replace(suf, '') for w in micrographs_list]
-    res_dic = {}
-    for name in names_list :
-        name = name.split('/')[-1]
-        ctf_log  = '.txt'
-        gctf_log = '_gctf.log'
-        filec = name + ctf_log
-        fileg = name + gctf_log
-        myfile = open (fileg, "r" )
-        g  =  float ( ( ' '.join(grep("RES_LIMIT",myfile )) ).split()[-1] )
-        file = open (filec, "r" )
-        b  =  tail(filec )
-        c = float (b.split()[6])
-        res_dic[name] = g,c
-        myfile.close()
-
-    good = 'micrographs_matching.star'
-    bad  = 'micrographs_differ.star'
-    g = open (good, "w")
-    b = open (bad,  "w")
-    g.writelines ( '\n' + 'data_' + '\n\n' + 'loop_' + '\n' + '_rlnMicrographName #1' + '\n')
-    b.writelines ( '\n' + 'data_' + '\n\n' + 'loop_' + '\n' + '_rlnMicrographName #1' + '\n')
-    for i in res_dic :
-        if  abs ( res_dic [i][0] - res_dic [i][1] )  > 3   :
-            b.writelines( i+suf+ '\n')
-        else :
-            if ( float (drift_parameters['rescut'] ) == 0 ) :
-                g.write(i+suf+ '\n')    
-            else :
-                if res_dic [i][0] < float ( drift_parameters['rescut'] ):
-                    g.write(i+suf+ '\n')    
-    g.close()
-    b.close()
-    
+        make_atlas ( ctffind_results, drift_parameters['timestamp'] + '_CTFFIND4_atlas.pdf' )
 
 ## PRINT A NICE SUMMARY 
 print ('\n') 
@@ -772,16 +1199,21 @@ print ('Mean Defocus estimate      :', drift_parameters['output_text'] [2],'A' )
 print ('Pixel size                 :', drift_parameters['output_text'] [3],'A' )
 print ('Magnification              :', drift_parameters['output_text'] [4] )
 print ('Microscope                 :', drift_parameters['output_text'] [5] )
-if drift_parameters['power_users'] == 1 and extra_calculations == 1:
-    print ('Matching/similar ctf       : micrographs_ctf_matching.star')
-    shutil.move("micrographs_matching.star", "../micrographs_ctf_matching.star")
-    print ('Differences in ctf         : micrographs_ctf_differ.star')
-    shutil.move("micrographs_differ.star", "../micrographs_ctf_differ.star")
+if 'triage_counts' in drift_parameters :
+    print ('Selected by the triage     :', drift_parameters['triage_counts'][0], 'micrographs (', triage.SELECTED, '),', drift_parameters['triage_counts'][1], 'rejected' )
+if 'screened_out' in drift_parameters :
+    print ('Left out by the pre-screen :', drift_parameters['screened_out'][0], 'micrographs (', os.path.basename( drift_parameters['screened_out'][1] ), ')' )
+if drift_parameters['consensus'] == 1 :
+    print ('Matching/similar ctf       : micrographs_ctf_matching.star (', matching, 'micrographs )' )
+    print ('Differences in ctf         : micrographs_ctf_differ.star (', differ, 'micrographs )' )
+    print ('Both fits side by side     :', drift_parameters['timestamp'] + '_CONSENSUS.star' )
 print ('######################################################################')
 ## Output
 
 #make_output_pdf ( drift_parameters['timestamp'] )
 
 ## CLEAN UP
+## --plot works on the files where it is run, there are no links or workdir to remove
 
-make_clean ( drift_parameters['datadir'] , drift_parameters['timestamp'], micrographs_list )
+if drift_parameters['plot_only'] != 1 :
+    make_clean ( drift_parameters['datadir'] , drift_parameters['workdir'] )
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3.5
+import os, sys, time, subprocess
+import gpudispatch, micdb, discover, staging, ctfjobs, gpulease, prescreen, ctfcache
+from optparse import OptionParser
+
+usage = "usage: %prog [options] session_dir [session_dir ...]\n\n" \
+        "makesum_batch.py --pix=1.06 /data/session1 /data/session2 /data/session3\n" \
+        "makesum_batch.py --pix=1.06 --ctf=mixed /data/session1 /data/session2:0.83\n\n" \
+        "makesum.py for many session directories at once: the micrographs of all the sessions go to one\n\
+         queue shared by the GPUs ( and cpus ), and the PDF of a session is made ( by makesum.py --resume )\n\
+         as soon as its last micrograph is done, while the others are still running.\n\
+         A session given as dir:pixel has its own pixel size"
+
+parser = OptionParser(usage=usage)
+parser.add_option("--pix",      dest="pixel_size", help="Pixel size of the sessions without their own eg --pix=1.42")
+parser.add_option("--kv",       dest="kv", default='300', help="Voltage of the Microscope eg --kv=300 default 300")
+parser.add_option("--cs",       dest="spherical_aberration", default='2.7', help="Spherical aberration of the Microscope eg --cs=2.7 default 2.7")
+parser.add_option("--mic",      dest="pattern", default='', help="Common unique pattern in the micrograph name eg --mic=FoilHole")
+parser.add_option("--exc",      dest="exclude_pattern", default='\#', help="Micrograph name that you want to exclude eg --exc=_DW")
+parser.add_option("--suf",      dest="suffix", default='mrc', help="Micrograph suffix eg mrc default mrc")
+parser.add_option("--mag",      dest="magnification", help="Magnification of the microscope, only used for the summary")
+parser.add_option("--cem",      dest="microscope_name", help="Microscope name eg Halos")
+parser.add_option("--ctf",      dest="ctf", default='gctf', help="gctf, ctffind or mixed ( Gctf on the GPUs and ctffind4 on the other cpus ) default gctf")
+parser.add_option("--negative", dest="negative", action="store_true", default=False, help="Negative stain data")
+parser.add_option("--atlas",    dest="atlas", help="Also write the atlas PDF of every session eg --atlas=res")
+parser.add_option("--catalog",  dest="catalog", help="Catalog the sessions are added to, no to leave them out")
+parser.add_option("--cpu",      dest="ncpu", help="Number of cpus to use")
+parser.add_option("--gpu",      dest="ngpu", help="Number of gpus to use")
+parser.add_option("--noscreen", dest="noscreen", action="store_true", default=False, help="Do not pre-screen the micrographs, by default empty, truncated and saturated ones are skipped")
+parser.add_option("--quarantine", dest="quarantine", action="store_true", default=False, help="Move the micrographs that fail the pre-screen to a quarantine directory in their session")
+parser.add_option("--scratch",  dest="scratch", help="Work directories on this node local disk eg --scratch=/scratch default $EM_SCRATCH")
+(options, args) = parser.parse_args()
+
+MAKESUM = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'makesum.py' )
+## sessions whose PDF is being made at the same time, next to the CTF of the others
+RENDER_JOBS = 2
+POLL = 5
+## makesum.py stage of every --ctf in the manifest
+STAGES = { 'gctf' : 'ctf', 'ctffind' : 'ctffind4', 'mixed' : 'mixed' }
+
+def check_for_executables ( program ) :
+    for path in os.environ["PATH"].split(os.pathsep) :
+        exe_file = os.path.join( path.strip('"'), program )
+        if os.path.isfile( exe_file ) and os.access( exe_file, os.X_OK ) :
+            return True
+    return False
+
+def programs ( ctf, ngpu ) :
+    ## the --ctf that can run here, checked once for all the sessions
+    gctf = check_for_executables( 'Gctf' ) and ngpu > 0
+    ctffind = check_for_executables( 'ctffind415' )
+    if ctf == 'mixed' and not ( gctf and ctffind ) :
+        print ('\n--ctf=mixed needs Gctf ( and a GPU ) and ctffind415, I will use the one that is there')
+        ctf = 'gctf' if gctf else 'ctffind'
+    if ctf == 'gctf' and not gctf and ctffind :
+        print ('\nNo Gctf ( or no GPU ), I will use ctffind4')
+        ctf = 'ctffind'
+    if ctf == 'ctffind' and not ctffind and gctf :
+        print ('\nNo ctffind415 in the path, I will use Gctf')
+        ctf = 'gctf'
+    if not ( gctf or ctffind ) :
+        print ('\nNo Gctf and ctffind415 executables in the path, run makesum.py --ctf=native in each session')
+        sys.exit(1)
+    return ctf
+
+class Session :
+    ## one session directory: its micrographs, work directory, manifest and the makesum.py
+    ## that makes its PDF once the ctf is done
+    def __init__ ( self, argument, index, timestamp ) :
+        directory, pixel_size = argument, options.pixel_size
+        if ':' in argument and not os.path.isdir( argument ) :
+            directory, pixel_size = argument.rsplit( ':', 1 )
+        self.datadir = os.path.abspath( directory )
+        self.pixel_size = pixel_size
+        scratch = os.path.join( batch_parameters['scratch'], 'session' + str ( index ) ) if batch_parameters['scratch'] else ''
+        self.workdir = staging.work_directory( self.datadir, timestamp, scratch )
+        pattern = '*' + options.pattern + '*' + options.suffix
+        self.micrographs = discover.micrographs( self.datadir, [ pattern ], options.exclude_pattern )[1]
+        self.inputs = []
+        self.render = None
+        self.log = None
+        self.state = 'ctf'
+        self.cached = 0
+
+    def screen ( self ) :
+        ## the empty, truncated and saturated micrographs are left out, the render of makesum.py
+        ## screens them again and comes to the same list
+        report = os.path.join( self.datadir, os.path.basename( os.path.normpath( self.workdir ) ) + '_prescreen.txt' )
+        quarantine_dir = os.path.join( self.datadir, prescreen.QUARANTINE ) if options.quarantine else ''
+        self.micrographs = prescreen.check_micrographs( self.micrographs, report, quarantine_dir, int ( options.ncpu or 0 ) )[0]
+
+    def stage ( self, ctf ) :
+        ## Gctf writes next to its input so it gets links, ctffind4 reads the micrographs where they are
+        if not os.path.isdir( self.workdir ) :
+            os.makedirs( self.workdir )
+        self.manifest = micdb.open_manifest( self.workdir )
+        micdb.register( self.manifest, self.micrographs )
+        if ctf == 'ctffind' :
+            self.inputs = list ( self.micrographs )
+        else :
+            self.inputs = staging.link_many( self.micrographs, self.workdir )
+        if ctf == 'gctf' :
+            ## what Gctf already did with the same arguments is put in the work directory ( see ctfcache )
+            cached = set ( ctfcache.restore( self.inputs, self.cache_key(), directory=self.workdir ) )
+            self.inputs = [ f for f in self.inputs if f not in cached ]
+            self.cached = len ( cached )
+
+    def cache_key ( self ) :
+        return ctfcache.command_key( ctfjobs.gctf_commands( self.pixel_size, options.spherical_aberration, options.kv, 1 if options.negative else 0 ) )
+
+    def stems ( self ) :
+        return [ os.path.splitext( os.path.basename( m ) )[0] for m in self.micrographs ]
+
+    def finished ( self ) :
+        ## the stems with a .ctf and a log, one listing of the work directory
+        names = set ( discover_names( self.workdir ) )
+        return [ s for s in self.stems() if s + '.ctf' in names and ( s + '_gctf.log' in names or s + '.txt' in names ) ]
+
+    def record ( self, stage ) :
+        ## mark the manifest as makesum.py does, so makesum.py --resume only makes the PDF
+        done = set ( self.finished() )
+        names = micdb.names_for( self.manifest, self.micrographs )
+        good = []
+        for name, stem in zip( names, self.stems() ) :
+            if stem in done :
+                log = stem + '_gctf.log' if os.path.exists( os.path.join( self.workdir, stem + '_gctf.log' ) ) else stem + '.txt'
+                micdb.update( self.manifest, name, ctf_log=os.path.join( self.workdir, log ) )
+                good.append( name )
+        micdb.mark( self.manifest, good, stage )
+        if stage != 'ctffind4' :
+            ctfcache.store( self.inputs, self.cache_key(), directory=self.workdir )
+        micdb.mark( self.manifest, sorted ( set ( names ) - set ( good ) ), stage, 'failed' )
+        self.manifest.close()
+        return len ( good )
+
+    def start_render ( self, ctf ) :
+        args = [ sys.executable, MAKESUM, '--resume=' + self.workdir, '--pix=' + str ( self.pixel_size ), '--ctf=' + ctf,
+                 '--kv=' + str ( options.kv ), '--cs=' + str ( options.spherical_aberration ), '--suf=' + options.suffix,
+                 '--exc=' + options.exclude_pattern ]
+        for flag, value in ( ( '--mic', options.pattern ), ( '--mag', options.magnification ), ( '--cem', options.microscope_name ),
+                             ( '--atlas', options.atlas ), ( '--catalog', options.catalog ), ( '--cpu', options.ncpu ), ( '--gpu', options.ngpu ) ) :
+            if value :
+                args.append( flag + '=' + str ( value ) )
+        for flag, value in ( ( '--negative', options.negative ), ( '--noscreen', options.noscreen ), ( '--quarantine', options.quarantine ) ) :
+            if value :
+                args.append( flag )
+        self.log = open( os.path.join( self.datadir, os.path.basename( os.path.normpath( self.workdir ) ) + '_makesum.log' ), 'w' )
+        self.render = subprocess.Popen( args, cwd=self.datadir, stdin=subprocess.DEVNULL, stdout=self.log, stderr=subprocess.STDOUT )
+        self.state = 'render'
+
+    def poll_render ( self ) :
+        code = self.render.poll()
+        if code is None :
+            return False
+        self.log.close()
+        self.state = 'done' if code == 0 else 'failed'
+        return True
+
+def discover_names ( directory ) :
+    ## the work directory changes all the time, no index
+    try :
+        return [ entry.name for entry in os.scandir( directory ) ]
+    except OSError :
+        return []
+
+def session_commands ( sessions, ctf ) :
+    ## the make_command of gpudispatch for every kind of worker: a batch may hold micrographs of
+    ## several sessions, each part runs with the pixel size of its session
+    owner = {}
+    for session in sessions :
+        for path in session.inputs :
+            owner[path] = session
+    negative = 1 if options.negative else 0
+    kv, cs = options.kv, options.spherical_aberration
+    def split ( make ) :
+        commands = {}
+        def command ( batch, slot, number ) :
+            parts = []
+            for session in sessions :
+                files = [ f for f in batch if owner[f] is session ]
+                if files :
+                    if session not in commands :
+                        commands[session] = make( session )
+                    parts.append( commands[session]( files, slot, str ( number ) + '_' + str ( len ( parts ) ) ) )
+            return ' ; '.join( parts )
+        return command
+    gctf = split( lambda s : ctfjobs.gctf_commands( s.pixel_size, cs, kv, negative ) )
+    ## ctffind4 writes next to the links, or to the work directory when it reads the data directly
+    ctffind = split( lambda s : ctfjobs.ctffind4_commands( s.pixel_size, cs, kv, s.workdir ) )
+    return gctf, ctffind
+
+batch_parameters = {}
+batch_parameters['timestamp'] = 'EM_' + time.strftime("%d_%b_%Y_%I_%M_%S%p")
+batch_parameters['scratch'] = os.path.abspath( options.scratch or staging.SCRATCH ) if ( options.scratch or staging.SCRATCH ) else ''
+
+if len ( args ) == 0 :
+    parser.print_help()
+    sys.exit(1)
+
+if options.ctf not in STAGES :
+    print ('\n--ctf can be gctf, ctffind or mixed, makesum.py does the others one session at a time')
+    sys.exit(1)
+
+ctf = programs( options.ctf, len ( gpulease.devices() ) )
+
+sessions = []
+for i, argument in enumerate ( args ) :
+    session = Session( argument, i, batch_parameters['timestamp'] )
+    if not os.path.isdir( session.datadir ) :
+        print ( session.datadir, ': no such directory' )
+        sys.exit(1)
+    if not session.pixel_size :
+        print ( session.datadir, ': no pixel size, give --pix or', session.datadir + ':1.06' )
+        sys.exit(1)
+    if session.micrographs and not options.noscreen :
+        session.screen()
+    if not session.micrographs :
+        print ( session.datadir, ': no micrographs, skipped' )
+        continue
+    sessions.append( session )
+
+if not sessions :
+    print ('\nNo micrographs in any of the sessions')
+    sys.exit(1)
+
+for session in sessions :
+    session.stage( ctf )
+    print ( session.datadir, ':', len ( session.micrographs ), 'micrographs' + ( ', ' + str ( session.cached ) + ' from the ctf cache' if session.cached else '' ) )
+
+## one queue for all the sessions, in the order given so the first ones are done first
+files = [ f for session in sessions for f in session.inputs ]
+batch_dir = os.path.join( batch_parameters['scratch'] or os.getcwd(), batch_parameters['timestamp'] + '_batch' )
+os.makedirs( batch_dir )
+os.chdir( batch_dir )
+output = open( 'ctf.log', 'a' )
+## the GPUs and cpus of the batch are leased from the other runs on this host, Gctf alone needs
+## a core per GPU and leaves the rest to the PDFs
+cores = int ( options.ncpu or 0 )
+if ctf == 'gctf' and cores == 0 :
+    cores = int ( options.ngpu or 0 ) or len ( gpulease.devices() )
+lease = gpulease.acquire( int ( options.ngpu or 0 ), cores, 'makesum_batch', ctf != 'ctffind' )
+ngpu, ncpu = len ( lease.gpus ), lease.cores
+gctf_command, ctffind_command = session_commands( sessions, ctf )
+if ctf == 'gctf' :
+    workers = gpudispatch.dispatch( files, lease.gpus, gctf_command, output )
+elif ctf == 'ctffind' :
+    workers = gpudispatch.dispatch( files, range(ncpu), ctffind_command, output, min_bytes=0 )
+else :
+    workers = gpudispatch.dispatch_mixed( files, [ ( 'gctf', lease.gpus, gctf_command ),
+                                                   ( 'ctffind4', range(max ( 1, ncpu - ngpu )), ctffind_command ) ], output )
+print ('\n', len ( files ), 'micrographs of', len ( sessions ), 'sessions on', ngpu if ctf != 'ctffind' else 0, 'GPUs and',
+       ncpu if ctf == 'ctffind' else ( max ( 1, ncpu - ngpu ) if ctf == 'mixed' else 0 ), 'cpus\n' )
+
+started = time.time()
+while any ( session.state in ( 'ctf', 'waiting', 'render' ) for session in sessions ) :
+    ## the workers are done ( or failed ) with everything, what is missing by now will not come
+    idle = all ( w.poll() is not None for w in workers )
+    for session in sessions :
+        if session.state == 'ctf' and ( idle or len ( session.finished() ) == len ( session.micrographs ) ) :
+            good = session.record( STAGES[ctf] )
+            print ( session.datadir, ': ctf of', good, '/', len ( session.micrographs ), 'micrographs after', int ( time.time() - started ), 's' )
+            session.state = 'waiting'
+        elif session.state == 'render' and session.poll_render() :
+            print ( session.datadir, ': PDF', 'done' if session.state == 'done' else 'failed, see ' + session.log.name )
+    rendering = sum ( 1 for session in sessions if session.state == 'render' )
+    for session in sessions :
+        if session.state == 'waiting' and rendering < RENDER_JOBS :
+            session.start_render( ctf )
+            rendering += 1
+    if any ( session.state in ( 'ctf', 'waiting', 'render' ) for session in sessions ) :
+        time.sleep ( POLL )
+
+output.close()
+os.chdir( os.path.dirname( batch_dir ) )
+staging.reap( batch_dir )
+print ('\nAll', len ( sessions ), 'sessions done in', int ( time.time() - started ), 's' )
+for session in sessions :
+    print ( ' ', session.datadir, ':', session.state )
@@ -0,0 +1,161 @@
+## Per-micrograph manifest of a processing directory ( SQLite )
+##
+## One row per micrograph keyed by the name stem of the raw input ( movie or micrograph ).
+## It keeps every derived file ( aligned sum, DW sum, ctf log and parameters, picks, particles )
+## and the status of every stage together with the input fingerprint the stage was run on,
+## so a script pointed at an old work directory only redoes what is missing or out of date.
+
+import os, time, sqlite3
+
+MANIFEST = 'manifest.sqlite'
+
+ARTIFACTS = ( 'aligned', 'dw', 'ctf_log', 'defocus_u', 'defocus_v', 'defocus_angle', 'ccc', 'resolution',
+              'pick_star', 'pick_box', 'particles', 'nparticles' )
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS micrographs (
+    name          TEXT PRIMARY KEY,
+    source        TEXT,
+    fingerprint   TEXT,
+    aligned       TEXT,
+    dw            TEXT,
+    ctf_log       TEXT,
+    defocus_u     REAL,
+    defocus_v     REAL,
+    defocus_angle REAL,
+    ccc           REAL,
+    resolution    REAL,
+    pick_star     TEXT,
+    pick_box      TEXT,
+    particles     TEXT,
+    nparticles    INTEGER
+);
+CREATE TABLE IF NOT EXISTS stages (
+    name        TEXT,
+    stage       TEXT,
+    status      TEXT,
+    fingerprint TEXT,
+    updated     REAL,
+    PRIMARY KEY ( name, stage )
+);
+CREATE INDEX IF NOT EXISTS stages_by_stage ON stages ( stage, status );
+CREATE TABLE IF NOT EXISTS run (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+## taken off the end of a file name for its stem, longest first; a dot elsewhere in the name
+## ( Grid1.sq2_0001.mrc ) is part of it
+SUFFIXES = ( '.frames.mrcs', '.frames.tiff', '.frames.tif', '.mrcs', '.tiff', '.tif', '.eer', '.mrc' )
+
+def stem ( path ) :
+    ## same naming as the MotionCor2 outputs:  dir/FoilHole_1.frames.mrcs -> FoilHole_1. A sum is
+    ## its own micrograph ( X.mrc and X_DW.mrc both in a directory makesum reads ), the sums of a
+    ## movie of the manifest are found by their aligned / dw columns ( names_for )
+    name = os.path.basename( path )
+    for suffix in SUFFIXES :
+        if name.endswith( suffix ) and len ( name ) > len ( suffix ) :
+            return name[:-len ( suffix )]
+    return os.path.splitext( name )[0] or name
+
+def fingerprint ( path ) :
+    ## cheap identity of an input file: size and mtime, no data read
+    try :
+        st = os.stat( path )
+    except OSError :
+        return ''
+    return '%d:%d' % ( st.st_size, int ( st.st_mtime * 1e9 ) )
+
+def open_manifest ( workdir ) :
+    if not os.path.isdir( workdir ) :
+        os.makedirs( workdir )
+    db = sqlite3.connect( os.path.join( workdir, MANIFEST ), timeout=60 )
+    db.execute( 'PRAGMA journal_mode=WAL' )
+    db.execute( 'PRAGMA synchronous=NORMAL' )
+    db.executescript( SCHEMA )
+    return db
+
+def set_run ( db, key, value ) :
+    with db :
+        db.execute( 'INSERT OR REPLACE INTO run ( key, value ) VALUES ( ?, ? )', ( key, str ( value ) ) )
+
+def get_run ( db, key, default=None ) :
+    row = db.execute( 'SELECT value FROM run WHERE key = ?', ( key, ) ).fetchone()
+    if row is None :
+        return default
+    return row[0]
+
+def register ( db, sources ) :
+    ## add the raw inputs, a changed input invalidates all of its stages. Returns the names
+    names = []
+    rows = []
+    for path in sources :
+        name = stem( path )
+        names.append( name )
+        rows.append( ( name, os.path.abspath( path ), fingerprint( path ) ) )
+    known = dict ( db.execute( 'SELECT name, fingerprint FROM micrographs' ).fetchall() )
+    changed = [ ( r[0], ) for r in rows if r[0] in known and known[r[0]] != r[2] ]
+    with db :
+        db.executemany( 'DELETE FROM stages WHERE name = ?', changed )
+        db.executemany( 'INSERT OR IGNORE INTO micrographs ( name ) VALUES ( ? )', [ ( r[0], ) for r in rows ] )
+        db.executemany( 'UPDATE micrographs SET source = ?, fingerprint = ? WHERE name = ?', [ ( r[1], r[2], r[0] ) for r in rows ] )
+    return names
+
+def done_names ( db, stage ) :
+    rows = db.execute( 'SELECT s.name FROM stages s JOIN micrographs m ON s.name = m.name '
+                       'WHERE s.stage = ? AND s.status = ? AND s.fingerprint = m.fingerprint', ( stage, 'done' ) )
+    return set ( r[0] for r in rows )
+
+def pending ( db, names, stage ) :
+    ## the names that still need this stage, in the given order
+    done = done_names( db, stage )
+    return [ n for n in names if n not in done ]
+
+def mark ( db, names, stage, status='done' ) :
+    now = time.time()
+    with db :
+        db.executemany( 'INSERT OR REPLACE INTO stages ( name, stage, status, fingerprint, updated ) '
+                        'SELECT name, ?, ?, fingerprint, ? FROM micrographs WHERE name = ?',
+                        [ ( stage, status, now, n ) for n in names ] )
+
+def update ( db, name, **artifacts ) :
+    if not artifacts :
+        return
+    for key in artifacts :
+        if key not in ARTIFACTS :
+            raise KeyError( 'unknown manifest column ' + key )
+    keys = sorted ( artifacts )
+    sql = 'UPDATE micrographs SET ' + ', '.join( k + ' = ?' for k in keys ) + ' WHERE name = ?'
+    with db :
+        db.execute( sql, [ artifacts[k] for k in keys ] + [ name ] )
+
+def update_many ( db, column, values ) :
+    ## values: { name : value }
+    if column not in ARTIFACTS :
+        raise KeyError( 'unknown manifest column ' + column )
+    with db :
+        db.executemany( 'UPDATE micrographs SET ' + column + ' = ? WHERE name = ?', [ ( v, n ) for n, v in values.items() ] )
+
+def column ( db, column, names=None ) :
+    ## { name : value } for the rows where the column is set
+    if column not in ARTIFACTS and column not in ( 'source', 'fingerprint' ) :
+        raise KeyError( 'unknown manifest column ' + column )
+    rows = db.execute( 'SELECT name, ' + column + ' FROM micrographs WHERE ' + column + ' IS NOT NULL' ).fetchall()
+    values = dict ( rows )
+    if names is not None :
+        values = dict ( ( n, values[n] ) for n in names if n in values )
+    return values
+
+def summary ( db ) :
+    rows = db.execute( 'SELECT stage, status, count(*) FROM stages GROUP BY stage, status ORDER BY stage' ).fetchall()
+    return rows
+
+def names_for ( db, files ) :
+    ## micrograph names for raw, aligned or DW files of this manifest
+    keys = {}
+    for col in ( 'source', 'aligned', 'dw' ) :
+        rows = db.execute( 'SELECT name, ' + col + ' FROM micrographs WHERE ' + col + ' IS NOT NULL' ).fetchall()
+        for n, v in rows :
+            keys[ os.path.basename( v ) ] = n
+    return [ keys.get( os.path.basename( f ), stem( f ) ) for f in files ]
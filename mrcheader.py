@@ -0,0 +1,242 @@
+## MRC / MRCS / TIFF header reader ( and a minimal MRC writer )
+##
+## Replaces the  header -size -i  and  header -pixel -i  calls. Only the header bytes of a file
+## are touched ( mmap + struct ), so every movie of a session can be checked before any GPU job starts:
+## the headers are read in parallel, grouped by shape and pixel size, and files shorter than
+## their header says are flagged as truncated.
+
+import os, mmap, struct, collections
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+HEADER_BYTES = 1024
+PROBE_THREADS = 16
+
+## mode : ( numpy dtype, bits per voxel )
+MRC_MODES = { 0 : ( 'i1', 8 ), 1 : ( 'i2', 16 ), 2 : ( 'f4', 32 ), 3 : ( 'i2', 32 ), 4 : ( 'f4', 64 ),
+              6 : ( 'u2', 16 ), 12 : ( 'f2', 16 ), 101 : ( 'u1', 4 ) }
+
+## modes that map straight onto a numpy dtype
+REAL_MODES = ( 0, 1, 2, 6, 12 )
+
+## MRC2014 / IMOD: mode 0 is signed unless the IMOD stamp is there without bit 0 ( signed bytes )
+## of the IMOD flags, as in the 8 bit files IMOD, SerialEM and some EPU exports write
+IMOD_STAMP = 1146047817
+IMOD_SIGNED_BYTES = 1
+
+TIFF_WIDTH = 256
+TIFF_LENGTH = 257
+TIFF_BITS = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_STRIP_BYTES = 279
+TIFF_SAMPLE_FORMAT = 339
+TIFF_TYPES = { 1 : ( 'B', 1 ), 3 : ( 'H', 2 ), 4 : ( 'I', 4 ) }
+
+Header = collections.namedtuple( 'Header', [ 'filename', 'nx', 'ny', 'nz', 'mode', 'pixel_size', 'offset',
+                                             'expected_size', 'size', 'truncated', 'error', 'byteorder', 'unsigned' ] )
+
+def failed ( filename, size, error ) :
+    return Header( filename, 0, 0, 0, -1, 0.0, 0, 0, size, False, error, '<', False )
+
+def data_bytes ( nx, ny, nz, mode ) :
+    bits = MRC_MODES[mode][1]
+    if bits == 4 :
+        ## 4 bit data, every row starts on a byte
+        return ( ( nx + 1 ) // 2 ) * ny * nz
+    return nx * ny * nz * bits // 8
+
+def mrc_byteorder ( buf ) :
+    ## machine stamp first, then a sanity check of the mode word for old files without one
+    stamp = buf[212:214]
+    if stamp == b'\x11\x11' :
+        return '>'
+    if stamp in ( b'\x44\x44', b'\x44\x41' ) :
+        return '<'
+    if struct.unpack_from( '<i', buf, 12 )[0] in MRC_MODES :
+        return '<'
+    return '>'
+
+def parse_mrc ( filename, buf, size ) :
+    order = mrc_byteorder( buf )
+    nx, ny, nz, mode = struct.unpack_from( order + '4i', buf, 0 )
+    mx = struct.unpack_from( order + 'i', buf, 28 )[0]
+    xlen = struct.unpack_from( order + 'f', buf, 40 )[0]
+    nsymbt = struct.unpack_from( order + 'i', buf, 92 )[0]
+    if mode not in MRC_MODES :
+        return failed( filename, size, 'unsupported MRC mode ' + str ( mode ) )
+    if nx <= 0 or ny <= 0 or nz <= 0 or nsymbt < 0 :
+        return failed( filename, size, 'bad MRC header' )
+    if mx > 0 and xlen > 0 :
+        pixel_size = xlen / mx
+    else :
+        pixel_size = 1.0
+    offset = HEADER_BYTES + nsymbt
+    expected = offset + data_bytes( nx, ny, nz, mode )
+    imod_stamp, imod_flags = struct.unpack_from( order + '2i', buf, 152 )
+    unsigned = mode == 0 and imod_stamp == IMOD_STAMP and not imod_flags & IMOD_SIGNED_BYTES
+    return Header( filename, nx, ny, nz, mode, round ( pixel_size, 4 ), offset, expected, size, size < expected, '', order, unsigned )
+
+def tiff_directory ( buf, order, ifd ) :
+    ## { tag : tuple of values } of one TIFF page and the offset of the next one
+    if ifd + 2 > len ( buf ) :
+        raise ValueError( 'truncated TIFF directory' )
+    entries = struct.unpack_from( order + 'H', buf, ifd )[0]
+    end = ifd + 2 + entries * 12
+    if end + 4 > len ( buf ) :
+        raise ValueError( 'truncated TIFF directory' )
+    tags = {}
+    for i in range ( entries ) :
+        tag, kind, count = struct.unpack_from( order + 'HHI', buf, ifd + 2 + i * 12 )
+        if kind not in TIFF_TYPES :
+            continue
+        code, width = TIFF_TYPES[kind]
+        where = ifd + 2 + i * 12 + 8
+        if count * width > 4 :
+            where = struct.unpack_from( order + 'I', buf, where )[0]
+            if where + count * width > len ( buf ) :
+                raise ValueError( 'truncated TIFF directory' )
+        tags[tag] = struct.unpack_from( order + str ( count ) + code, buf, where )
+    return tags, struct.unpack_from( order + 'I', buf, end )[0]
+
+def tiff_pages ( buf ) :
+    ## the directories of all the pages ( frames ) of a TIFF file
+    order = '<' if buf[:2] == b'II' else '>'
+    pages = []
+    seen = set()
+    ifd = struct.unpack_from( order + 'I', buf, 4 )[0]
+    while ifd != 0 and ifd not in seen :
+        seen.add( ifd )
+        tags, ifd = tiff_directory( buf, order, ifd )
+        pages.append( tags )
+    return pages, order
+
+def parse_tiff ( filename, buf, size ) :
+    ## the frame count is the number of pages, no pixel size in a tiff movie
+    try :
+        pages, order = tiff_pages( buf )
+    except ( ValueError, struct.error ) as e :
+        return failed( filename, size, str ( e ) )._replace( truncated=True )
+    if len ( pages ) == 0 or TIFF_WIDTH not in pages[0] or TIFF_LENGTH not in pages[0] :
+        return failed( filename, size, 'no image in the TIFF file' )
+    nx = pages[0][TIFF_WIDTH][0]
+    ny = pages[0][TIFF_LENGTH][0]
+    expected = max ( [ o + n for p in pages for o, n in zip( p.get( TIFF_STRIP_OFFSETS, () ), p.get( TIFF_STRIP_BYTES, () ) ) ] or [ size ] )
+    return Header( filename, nx, ny, len ( pages ), -1, 1.0, 0, expected, size, size < expected, '', order, False )
+
+def read_header ( filename ) :
+    try :
+        with open( filename, 'rb' ) as f :
+            size = os.fstat( f.fileno() ).st_size
+            if size < 8 :
+                return failed( filename, size, 'empty file' )._replace( truncated=True )
+            buf = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+            try :
+                if buf[:4] in ( b'II*\x00', b'MM\x00*' ) :
+                    return parse_tiff( filename, buf, size )
+                if size < HEADER_BYTES :
+                    return failed( filename, size, 'shorter than an MRC header' )._replace( truncated=True )
+                return parse_mrc( filename, buf, size )
+            finally :
+                buf.close()
+    except ( IOError, OSError, ValueError, struct.error ) as e :
+        return failed( filename, 0, str ( e ) )
+
+def probe ( files, threads=PROBE_THREADS ) :
+    ## headers of all the files, in the given order
+    files = list ( files )
+    if len ( files ) < 2 :
+        return [ read_header( f ) for f in files ]
+    pool = ThreadPool( min ( threads, len ( files ) ) )
+    try :
+        return pool.map( read_header, files, chunksize=8 )
+    finally :
+        pool.close()
+        pool.join()
+
+def group ( headers ) :
+    ## { ( nx, ny, nz, pixel_size ) : [ headers ] } largest group first
+    groups = collections.OrderedDict()
+    for h in headers :
+        groups.setdefault( ( h.nx, h.ny, h.nz, h.pixel_size ), [] ).append( h )
+    return collections.OrderedDict( sorted ( groups.items(), key=lambda item : -len ( item[1] ) ) )
+
+def bad ( headers ) :
+    return [ h for h in headers if h.truncated or h.error ]
+
+def describe ( h ) :
+    if h.error :
+        return h.filename + ' : ' + h.error
+    return '%s : %d bytes, the header needs %d' % ( h.filename, h.size, h.expected_size )
+
+def check_movies ( files, threads=PROBE_THREADS ) :
+    ## reads every header, prints the shapes found and the broken files.
+    ## Returns the headers of the largest group of consistent files
+    headers = probe( files, threads )
+    broken = bad( headers )
+    if broken :
+        print ('\n' + str ( len ( broken ) ) + ' files are truncated or unreadable, I will skip them:' )
+        for h in broken :
+            print ( '  ' + describe( h ) )
+    groups = group( [ h for h in headers if not ( h.truncated or h.error ) ] )
+    if len ( groups ) > 1 :
+        print ('\nThe movies are not all the same:' )
+        for ( nx, ny, nz, pixel_size ), members in groups.items() :
+            print ( '  %d x %d x %d  pixel %.4f A : %d files' % ( nx, ny, nz, pixel_size, len ( members ) ) )
+        print ('I will only use the first group, process the others separately ( --list )' )
+    if len ( groups ) == 0 :
+        return []
+    return list ( groups.values() )[0]
+
+def dtype ( h ) :
+    if h.mode == 0 and h.unsigned :
+        return h.byteorder + 'u1'
+    return h.byteorder + MRC_MODES[h.mode][0]
+
+def read_image ( filename ) :
+    ## a micrograph as float32 through a memory map, the frames are summed for a stack
+    h = read_header( filename )
+    if h.error or h.truncated :
+        raise ValueError( describe( h ) )
+    if h.mode not in REAL_MODES :
+        raise ValueError( filename + ': unsupported MRC mode ' + str ( h.mode ) )
+    data = np.memmap( filename, dtype=dtype( h ), mode='r', offset=h.offset, shape=( h.nz, h.ny, h.nx ) )
+    image = np.zeros( ( h.ny, h.nx ), dtype=np.float32 )
+    for z in range ( h.nz ) :
+        image += data[z]
+    return image
+
+def pack_header ( nx, ny, nz, pixel_size, mode=2, dmin=0.0, dmax=0.0, dmean=0.0, rms=0.0 ) :
+    ## a plain little endian MRC2014 header, no extended header
+    buf = bytearray( HEADER_BYTES )
+    struct.pack_into( '<4i', buf, 0, nx, ny, nz, mode )
+    struct.pack_into( '<3i', buf, 28, nx, ny, nz )
+    struct.pack_into( '<6f', buf, 40, nx * pixel_size, ny * pixel_size, nz * pixel_size, 90.0, 90.0, 90.0 )
+    struct.pack_into( '<3i', buf, 64, 1, 2, 3 )
+    struct.pack_into( '<3f', buf, 76, dmin, dmax, dmean )
+    struct.pack_into( '<i', buf, 104, 20140 )
+    buf[208:212] = b'MAP '
+    buf[212:216] = b'\x44\x44\x00\x00'
+    struct.pack_into( '<f', buf, 216, rms )
+    return bytes ( buf )
+
+def write_mrc ( filename, data, pixel_size ) :
+    ## float32 image or stack, written next to the target and renamed so nobody sees half a file
+    data = np.ascontiguousarray( data, dtype='<f4' )
+    if data.ndim == 2 :
+        data = data[None]
+    nz, ny, nx = data.shape
+    header = pack_header( nx, ny, nz, float ( pixel_size ), 2, float ( data.min() ), float ( data.max() ),
+                          float ( data.mean( dtype=np.float64 ) ), float ( data.std( dtype=np.float64 ) ) )
+    part = filename + '.part'
+    with open( part, 'wb' ) as f :
+        f.write( header )
+        data.tofile( f )
+    os.rename( part, filename )
+
+def create_stack ( filename, nz, ny, nx, pixel_size ) :
+    ## a preallocated float32 stack, filled in place through the returned memory map
+    with open( filename, 'wb' ) as f :
+        f.write( pack_header( nx, ny, nz, float ( pixel_size ), 2 ) )
+        f.truncate( HEADER_BYTES + 4 * nz * ny * nx )
+    return np.memmap( filename, dtype='<f4', mode='r+', offset=HEADER_BYTES, shape=( nz, ny, nx ) )
@@ -0,0 +1,229 @@
+## CTF estimation on the CPU with NumPy ( no Gctf / ctffind4 / GPU needed )
+##
+## Periodogram averaging: overlapping boxes of the micrograph go through numpy.fft.rfft2 in
+## batches and their power spectra are averaged. The smooth background is removed ring by ring
+## and the Thon rings are matched against CTF^2 with a coarse-to-fine grid search:
+##   1. mean defocus on the rotational average ( 1D, fast )
+##   2. mean defocus, astigmatism and its angle on a coarse 2D grid
+##   3. the same on a fine grid around the best point
+## The result is written as a ctffind4 style <micrograph>.txt, so everything that reads the
+## ctffind4 output ( CTFFIND4_results_list, relion ) reads it too.
+
+import os, math
+import multiprocessing
+import numpy as np
+import mrcheader, ctfjobs
+
+BOX = 512
+RES_LOW = 30.0
+DEFOCUS_MIN = 5000.0
+DEFOCUS_MAX = 50000.0
+DEFOCUS_STEP = 500.0
+FIT_CC_CUTOFF = 0.3
+BATCH_TILES = 32
+BATCH_MODELS = 64
+
+def electron_wavelength ( kv ) :
+    ## relativistic wavelength in A
+    volts = float ( kv ) * 1000.0
+    return 12.2643247 / math.sqrt( volts * ( 1.0 + volts * 0.978466e-6 ) )
+
+def power_spectrum ( image, box=BOX, batch=BATCH_TILES ) :
+    ## average |rfft2|^2 of half-overlapping boxes, returns ( spectrum, box )
+    ny, nx = image.shape
+    box = min ( box, ny - ny % 2, nx - nx % 2 )
+    step = box // 2
+    corners = [ ( y, x ) for y in range ( 0, ny - box + 1, step ) for x in range ( 0, nx - box + 1, step ) ]
+    total = np.zeros( ( box, box // 2 + 1 ), dtype=np.float64 )
+    for i in range ( 0, len ( corners ), batch ) :
+        tiles = np.stack( [ image[y:y + box, x:x + box] for y, x in corners[i:i + batch] ] ).astype( np.float32 )
+        tiles -= tiles.mean( axis=( 1, 2 ), keepdims=True )
+        spectra = np.fft.rfft2( tiles )
+        total += ( spectra.real ** 2 + spectra.imag ** 2 ).sum( axis=0 )
+    return total / len ( corners ), box
+
+def smooth ( profile, width ) :
+    width = max ( 3, int ( width ) | 1 )
+    pad = width // 2
+    padded = np.concatenate( ( np.repeat( profile[:1], pad ), profile, np.repeat( profile[-1:], pad ) ) )
+    return np.convolve( padded, np.ones( width ) / width, mode='valid' )
+
+def radial_sums ( radius, values, nbins ) :
+    return np.bincount( radius.ravel(), values.ravel(), minlength=nbins )[:nbins]
+
+def flatten_spectrum ( spectrum, box ) :
+    ## background subtracted and locally normalised amplitude spectrum, plus the geometry
+    fy = np.fft.fftfreq( box )[:, None]
+    fx = np.fft.rfftfreq( box )[None, :]
+    freq = np.sqrt( fx ** 2 + fy ** 2 )
+    angle = np.arctan2( fy, fx ) + np.zeros_like( freq )
+    radius = np.rint( freq * box ).astype( np.int64 )
+    nbins = box // 2 + 1
+    radius = np.minimum( radius, nbins - 1 )
+    counts = np.maximum( radial_sums( radius, np.ones_like( freq ), nbins ), 1 )
+    amplitude = np.sqrt( spectrum )
+    background = smooth( radial_sums( radius, amplitude, nbins ) / counts, box / 20.0 )
+    flat = amplitude - background[radius]
+    rms = np.sqrt( smooth( radial_sums( radius, flat ** 2, nbins ) / counts, box / 20.0 ) )
+    flat = flat / np.maximum( rms[radius], 1e-12 )
+    return flat, freq, angle, radius
+
+def ctf_squared ( s2, azimuth, mean, diff, astig, wavelength, cs, phase ) :
+    ## rows: parameter sets, columns: pixels
+    defocus = mean[:, None] + diff[:, None] * np.cos( 2.0 * ( azimuth[None, :] - astig[:, None] ) )
+    chi = math.pi * wavelength * defocus * s2[None, :] - 0.5 * math.pi * cs * wavelength ** 3 * s2[None, :] ** 2
+    return np.sin( chi + phase ) ** 2
+
+def correlations ( data, s2, azimuth, mean, diff, astig, wavelength, cs, phase, batch=BATCH_MODELS ) :
+    ## normalised cross correlation of the spectrum with CTF^2 for every parameter set
+    data = data - data.mean()
+    data = data / max ( np.sqrt( ( data ** 2 ).sum() ), 1e-12 )
+    cc = np.empty( len ( mean ) )
+    for i in range ( 0, len ( mean ), batch ) :
+        j = slice ( i, i + batch )
+        model = ctf_squared( s2, azimuth, mean[j], diff[j], astig[j], wavelength, cs, phase )
+        model -= model.mean( axis=1, keepdims=True )
+        norm = np.sqrt( ( model ** 2 ).sum( axis=1 ) )
+        cc[j] = model.dot( data ) / np.maximum( norm, 1e-12 )
+    return cc
+
+def grid ( *axes ) :
+    mesh = np.meshgrid( *axes, indexing='ij' )
+    return [ m.ravel() for m in mesh ]
+
+def fit_resolution ( flat, freq, angle, radius, box, pixel_size, best, wavelength, cs, phase, first ) :
+    ## highest resolution where the fitted rings still correlate with the spectrum
+    mean, diff, astig = best
+    s2 = ( freq / pixel_size ) ** 2
+    model = ctf_squared( s2.ravel(), angle.ravel(), np.array( [ mean ] ), np.array( [ diff ] ), np.array( [ astig ] ), wavelength, cs, phase )[0]
+    data = flat.ravel()
+    r = radius.ravel()
+    nbins = box // 2 + 1
+    width = max ( 5, box // 32 )
+    kernel = np.ones( width )
+    n  = np.convolve( radial_sums( r, np.ones_like( data ), nbins ), kernel, mode='same' )
+    sd = np.convolve( radial_sums( r, data, nbins ), kernel, mode='same' )
+    sm = np.convolve( radial_sums( r, model, nbins ), kernel, mode='same' )
+    sdm = np.convolve( radial_sums( r, data * model, nbins ), kernel, mode='same' )
+    sdd = np.convolve( radial_sums( r, data * data, nbins ), kernel, mode='same' )
+    smm = np.convolve( radial_sums( r, model * model, nbins ), kernel, mode='same' )
+    n = np.maximum( n, 1 )
+    cov = sdm - sd * sm / n
+    var = np.maximum( ( sdd - sd ** 2 / n ) * ( smm - sm ** 2 / n ), 1e-12 )
+    cc = cov / np.sqrt( var )
+    last = first
+    for b in range ( first, nbins - width // 2 ) :
+        if cc[b] < FIT_CC_CUTOFF :
+            break
+        last = b
+    return box * pixel_size / max ( last, 1 )
+
+def estimate ( image, pixel_size, kv=300, cs=2.7, ac=0.07, box=BOX, res_low=RES_LOW, res_high=None,
+               defocus_min=DEFOCUS_MIN, defocus_max=DEFOCUS_MAX, defocus_step=DEFOCUS_STEP ) :
+    ## returns dict ( defocus_u, defocus_v, angle, cc, resolution ) in A / degrees
+    pixel_size = float ( pixel_size )
+    if res_high is None :
+        res_high = max ( 4.0, 2.0 * pixel_size )
+    wavelength = electron_wavelength( kv )
+    cs = float ( cs ) * 1e7
+    ac = float ( ac )
+    phase = math.atan2( ac, math.sqrt( 1.0 - ac * ac ) )
+
+    spectrum, box = power_spectrum( image, box )
+    flat, freq, angle, radius = flatten_spectrum( spectrum, box )
+    s = freq / pixel_size
+    ring = ( s >= 1.0 / res_low ) & ( s <= 1.0 / res_high )
+    data = flat[ring]
+    s2 = s[ring] ** 2
+    azimuth = angle[ring]
+
+    ## 1. rotational average, astigmatism ignored
+    first = int ( math.ceil( box * pixel_size / res_low ) )
+    last = int ( box * pixel_size / res_high )
+    nbins = box // 2 + 1
+    counts = np.maximum( radial_sums( radius, np.ones_like( flat ), nbins ), 1 )
+    profile = ( radial_sums( radius, flat, nbins ) / counts )[first:last + 1]
+    s2_1d = ( np.arange( first, last + 1 ) / ( box * pixel_size ) ) ** 2
+    means = np.arange( defocus_min, defocus_max + defocus_step, defocus_step )
+    zeros = np.zeros_like( means )
+    cc = correlations( profile, s2_1d, np.zeros_like( s2_1d ), means, zeros, zeros, wavelength, cs, phase )
+    mean = means[ np.argmax( cc ) ]
+
+    ## 2. coarse 2D grid
+    coarse_means = mean + np.arange( -2, 3 ) * defocus_step / 2.0
+    diffs = np.arange( 0.0, 1001.0, 100.0 )
+    astigs = np.radians( np.arange( 0.0, 180.0, 15.0 ) )
+    m, d, a = grid( coarse_means, diffs, astigs )
+    cc = correlations( data, s2, azimuth, m, d, a, wavelength, cs, phase )
+    k = np.argmax( cc )
+    mean, diff, astig = m[k], d[k], a[k]
+
+    ## 3. fine 2D grid around it
+    m, d, a = grid( mean + np.arange( -4, 5 ) * defocus_step / 16.0, np.maximum( 0.0, diff + np.arange( -4, 5 ) * 25.0 ), astig + np.radians( np.arange( -4, 5 ) * 2.5 ) )
+    cc = correlations( data, s2, azimuth, m, d, a, wavelength, cs, phase )
+    k = np.argmax( cc )
+    mean, diff, astig = m[k], d[k], a[k]
+
+    resolution = fit_resolution( flat, freq, angle, radius, box, pixel_size, ( mean, diff, astig ), wavelength, cs, phase, first )
+    return { 'defocus_u' : float ( mean + diff ), 'defocus_v' : float ( mean - diff ), 'angle' : math.degrees( astig ) % 180.0,
+             'cc' : float ( cc[k] ), 'resolution' : max ( resolution, 2.0 * pixel_size ), 'box' : box }
+
+def write_txt ( filename, micrograph, result, pixel_size, kv, cs, ac, res_low, res_high ) :
+    ## ctffind4 diagnostic text, the last line holds the values
+    out = open( filename + '.part', 'w' )
+    out.write( '# Output from makesum native CTF estimation\n' )
+    out.write( '# Input file: ' + micrograph + ' ; Number of micrographs: 1\n' )
+    out.write( '# Pixel size: %.3f Angstroms ; acceleration voltage: %.1f keV ; spherical aberration: %.2f mm ; amplitude contrast: %.2f\n' \
+               % ( float ( pixel_size ), float ( kv ), float ( cs ), float ( ac ) ) )
+    out.write( '# Box size: %d pixels ; min. res.: %.1f Angstroms ; max. res.: %.1f Angstroms\n' % ( result['box'], res_low, res_high ) )
+    out.write( '# Columns: #1 - micrograph number; #2 - defocus 1 [Angstroms]; #3 - defocus 2; #4 - azimuth of astigmatism; ' \
+               '#5 - additional phase shift [radians]; #6 - cross correlation; #7 - spacing (in Angstroms) up to which CTF rings were fit successfully\n' )
+    out.write( '%f %f %f %f %f %f %f\n' % ( 1.0, result['defocus_u'], result['defocus_v'], result['angle'], 0.0, result['cc'], result['resolution'] ) )
+    out.close()
+    os.rename( filename + '.part', filename )
+
+def _estimate_file ( job ) :
+    micrograph, output, kwargs = job
+    try :
+        result = estimate( mrcheader.read_image( micrograph ), **kwargs )
+    except ( IOError, OSError, ValueError ) as e :
+        return micrograph, None, str(e)
+    write_txt( output, micrograph, result, kwargs['pixel_size'], kwargs['kv'], kwargs['cs'], kwargs['ac'], kwargs['res_low'], kwargs['res_high'] )
+    return micrograph, result, None
+
+def output_name ( micrograph ) :
+    ## same name as ctffind4 uses: dir/name.mrc -> name.txt in the current directory
+    return ctfjobs.ctf_stem( micrograph ) + '.txt'
+
+def estimate_many ( micrographs, pixel_size, kv=300, cs=2.7, ac=0.07, processes=None, res_low=RES_LOW, res_high=None,
+                    label='Micrographs are done' ) :
+    ## one micrograph per pool task, returns { micrograph : result } of the ones that worked
+    if res_high is None :
+        res_high = max ( 4.0, 2.0 * float ( pixel_size ) )
+    kwargs = { 'pixel_size' : float ( pixel_size ), 'kv' : float ( kv ), 'cs' : float ( cs ), 'ac' : float ( ac ),
+               'res_low' : res_low, 'res_high' : res_high }
+    jobs = [ ( m, output_name( m ), kwargs ) for m in micrographs ]
+    if processes is None :
+        processes = multiprocessing.cpu_count()
+    processes = max ( 1, min ( int ( processes ), len ( jobs ) ) )
+    results = {}
+    done = 0
+    if processes == 1 :
+        finished = map( _estimate_file, jobs )
+        pool = None
+    else :
+        pool = multiprocessing.Pool( processes )
+        finished = pool.imap_unordered( _estimate_file, jobs )
+    try :
+        for micrograph, result, error in finished :
+            done += 1
+            if error is not None :
+                print ( micrograph, ':', error )
+            else :
+                results[micrograph] = result
+            print ( done, '/', len ( jobs ), label )
+    finally :
+        if pool is not None :
+            pool.close()
+            pool.join()
+    return results
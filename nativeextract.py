@@ -0,0 +1,209 @@
+## Particle extraction with NumPy ( instead of relion_preprocess_mpi --extract / --reextract_data_star )
+##
+## Every micrograph is memory mapped once and the boxes around the coordinates are cut as views of
+## it. Batches of boxes are rescaled in Fourier space ( --scale ), cleaned of dust, ramp and
+## background normalised outside bg_radius like relion --norm, contrast inverted, and written
+## straight into a preallocated memory mapped <micrograph>.mrcs. Each micrograph also gets a
+## <micrograph>_extract.star, and particles.star is put together from those with the CTF of every
+## particle taken from the micrographs star.
+
+import os, multiprocessing, zlib
+import numpy as np
+import mrcheader, relionstar
+
+BATCH_PARTICLES = 256
+EXTRACT_SUFFIX = '_extract.star'
+
+def stack_stem ( micrograph ) :
+    ## relion naming: dir/FoilHole_1.mrc -> FoilHole_1
+    return os.path.splitext( os.path.basename( micrograph ) )[0]
+
+def read_coordinates ( filename ) :
+    ## x, y ( pixels ) of a Gautomatch / relion coordinate file
+    if not os.path.exists( filename ) :
+        return np.zeros( 0 ), np.zeros( 0 )
+    table = relionstar.read_columns( filename, [ 'rlnCoordinateX', 'rlnCoordinateY' ] )
+    return table['rlnCoordinateX'].astype( np.float64 ), table['rlnCoordinateY'].astype( np.float64 )
+
+def picked_coordinates ( micrographs, coord_dir, coord_suffix ) :
+    ## { micrograph : ( x, y ) } from  coord_dir/<micrograph stem><coord_suffix>
+    return dict ( ( m, read_coordinates( os.path.join( coord_dir, stack_stem( m ) + coord_suffix ) ) ) for m in micrographs )
+
+def recentred_coordinates ( particles_star, pixel_size ) :
+    ## { micrograph : ( x, y ) } of the particles in a refinement star file, moved by their
+    ## rlnOriginX / Y. The origins are in the pixels of the particles, pixel_size is the micrograph one
+    table = relionstar.read_loop( particles_star )
+    x = table['rlnCoordinateX'].astype( np.float64 )
+    y = table['rlnCoordinateY'].astype( np.float64 )
+    if 'rlnOriginX' in table.dtype.names :
+        ratio = np.ones( len ( table ) )
+        if 'rlnMagnification' in table.dtype.names and 'rlnDetectorPixelSize' in table.dtype.names :
+            ratio = table['rlnDetectorPixelSize'] * 10000.0 / table['rlnMagnification'] / float ( pixel_size )
+        x = x - table['rlnOriginX'] * ratio
+        y = y - table['rlnOriginY'] * ratio
+    coordinates = {}
+    micrographs = table['rlnMicrographName']
+    for m in np.unique( micrographs ) :
+        rows = micrographs == m
+        coordinates[str ( m )] = ( x[rows], y[rows] )
+    return coordinates
+
+def windows ( image, x, y, box ) :
+    ## a ( y, x ) indexable view of every box of the micrograph and the corners of the wanted ones.
+    ## Parts of a box outside the micrograph read the micrograph mean
+    pad = box // 2 + 1
+    padded = np.pad( image, pad, mode='constant', constant_values=float ( image.mean() ) )
+    ny, nx = padded.shape
+    s0, s1 = padded.strides
+    view = np.lib.stride_tricks.as_strided( padded, shape=( ny - box + 1, nx - box + 1, box, box ), strides=( s0, s1, s0, s1 ) )
+    x0 = np.clip( np.rint( x ).astype( np.int64 ) - box // 2 + pad, 0, nx - box )
+    y0 = np.clip( np.rint( y ).astype( np.int64 ) - box // 2 + pad, 0, ny - box )
+    return view, x0, y0
+
+def rescale ( boxes, size ) :
+    ## Fourier crop ( or pad ) every box to size x size
+    box = boxes.shape[-1]
+    if size == box :
+        return boxes
+    spectra = np.fft.rfft2( boxes )
+    half = min ( box, size ) // 2
+    out = np.zeros( ( boxes.shape[0], size, size // 2 + 1 ), dtype=spectra.dtype )
+    out[:, :half, :half + 1] = spectra[:, :half, :half + 1]
+    out[:, -half:, :half + 1] = spectra[:, -half:, :half + 1]
+    return np.fft.irfft2( out, s=( size, size ) ).astype( np.float32 )
+
+def background ( size, radius ) :
+    ## the pixels outside radius and the least squares solver of a plane through them
+    y, x = np.mgrid[:size, :size] - size // 2
+    mask = x * x + y * y > float ( radius ) * float ( radius )
+    design = np.stack( ( x[mask], y[mask], np.ones( mask.sum() ) ), axis=1 ).astype( np.float64 )
+    return mask, np.linalg.pinv( design ), x.astype( np.float32 ), y.astype( np.float32 )
+
+def remove_dust ( boxes, white_dust, black_dust, rng ) :
+    ## pixels more than white / black sigma away from the box mean become noise, -1 switches it off
+    if white_dust <= 0 and black_dust <= 0 :
+        return
+    mean = boxes.mean( axis=( 1, 2 ), keepdims=True )
+    std = boxes.std( axis=( 1, 2 ), keepdims=True )
+    dust = np.zeros( boxes.shape, dtype=bool )
+    if white_dust > 0 :
+        dust |= boxes > mean + white_dust * std
+    if black_dust > 0 :
+        dust |= boxes < mean - black_dust * std
+    which = np.nonzero( dust )[0]
+    if len ( which ) :
+        boxes[dust] = mean[which, 0, 0] + std[which, 0, 0] * rng.standard_normal( len ( which ) ).astype( np.float32 )
+
+def normalise ( boxes, mask, solver, x, y ) :
+    ## subtract the plane through the background, then zero mean and unit sigma in the background
+    coefficients = boxes[:, mask].astype( np.float64 ).dot( solver.T ).astype( np.float32 )
+    boxes -= coefficients[:, 0, None, None] * x + coefficients[:, 1, None, None] * y + coefficients[:, 2, None, None]
+    bg = boxes[:, mask]
+    mean = bg.mean( axis=1 )
+    std = bg.std( axis=1 )
+    std[std == 0] = 1
+    boxes -= mean[:, None, None]
+    boxes /= std[:, None, None]
+
+def extract_micrograph ( micrograph, stack, x, y, box, size=0, bg_radius=-1, white_dust=-1, black_dust=-1, invert=True, pixel_size=1.0 ) :
+    ## writes the stack ( through stack.part ), returns the number of particles
+    size = int ( size ) or int ( box )
+    if bg_radius <= 0 :
+        bg_radius = int ( round ( size * 0.75 / 2 ) )
+    image = mrcheader.read_image( micrograph )
+    n = len ( x )
+    part = stack + '.part'
+    data = mrcheader.create_stack( part, n, size, size, float ( pixel_size ) * box / float ( size ) )
+    view, x0, y0 = windows( image, x, y, box )
+    mask, solver, gx, gy = background( size, bg_radius )
+    rng = np.random.RandomState( zlib.crc32( os.path.basename( micrograph ).encode() ) & 0x7fffffff )
+    for i in range ( 0, n, BATCH_PARTICLES ) :
+        boxes = view[ y0[i:i + BATCH_PARTICLES], x0[i:i + BATCH_PARTICLES] ].astype( np.float32 )
+        boxes = rescale( boxes, size )
+        remove_dust( boxes, white_dust, black_dust, rng )
+        normalise( boxes, mask, solver, gx, gy )
+        if invert :
+            boxes *= -1
+        data[i:i + len ( boxes )] = boxes
+    header = mrcheader.pack_header( size, size, n, float ( pixel_size ) * box / float ( size ), 2, float ( data.min() ), float ( data.max() ),
+                                    float ( data.mean( dtype=np.float64 ) ), float ( data.std( dtype=np.float64 ) ) )
+    data.flush()
+    del data
+    with open( part, 'r+b' ) as f :
+        f.write( header )
+    os.rename( part, stack )
+    return n
+
+def _extract_file ( job ) :
+    micrograph, stack, x, y, kwargs = job
+    try :
+        n = extract_micrograph( micrograph, stack, x, y, **kwargs )
+    except ( IOError, OSError, ValueError, KeyError, MemoryError ) as e :
+        return micrograph, 0, str ( e )
+    return micrograph, n, ''
+
+def particle_table ( micrograph, x, y, part_dir ) :
+    stack = part_dir + stack_stem( micrograph ) + '.mrcs'
+    return relionstar.make_table( [ ( 'rlnCoordinateX', np.asarray( x, dtype=np.float64 ) ),
+                                    ( 'rlnCoordinateY', np.asarray( y, dtype=np.float64 ) ),
+                                    ( 'rlnImageName', np.array( [ '%06d@%s' % ( i + 1, stack ) for i in range ( len ( x ) ) ], dtype=str ) ),
+                                    ( 'rlnMicrographName', np.array( [ micrograph ] * len ( x ), dtype=str ) ) ] )
+
+def extract ( micrographs_star, coordinates, output_dir, box, pixel_size, size=0, bg_radius=-1, white_dust=-1, black_dust=-1,
+              invert=True, processes=None, part_dir='../Particles/', particles_star='particles.star', label='Micrographs are extracted' ) :
+    ## coordinates: { rlnMicrographName : ( x, y ) } of the micrographs to ( re )extract, one process
+    ## per micrograph. particles.star covers every micrograph of the star with an _extract.star.
+    ## Returns { rlnMicrographName : stack } of the micrographs with particles
+    if processes is None :
+        processes = multiprocessing.cpu_count()
+    if os.path.isdir( output_dir ) != True :
+        os.makedirs( output_dir )
+    blocks = relionstar.read_star( micrographs_star )
+    micrographs = blocks[relionstar.default_block( blocks )]
+    size = int ( size ) or int ( box )
+    kwargs = dict ( box=int ( box ), size=size, bg_radius=float ( bg_radius ), white_dust=float ( white_dust ),
+                    black_dust=float ( black_dust ), invert=invert, pixel_size=float ( pixel_size ) )
+    jobs = []
+    for m in micrographs['rlnMicrographName'] :
+        m = str ( m )
+        if m not in coordinates :
+            continue
+        x, y = coordinates[m]
+        star = os.path.join( output_dir, stack_stem( m ) + EXTRACT_SUFFIX )
+        if len ( x ) == 0 :
+            relionstar.write_loop( star, particle_table( m, x, y, part_dir ) )
+            continue
+        jobs.append( ( m, os.path.join( output_dir, stack_stem( m ) + '.mrcs' ), x, y, kwargs ) )
+
+    if jobs :
+        pool = multiprocessing.Pool( max ( 1, min ( int ( processes ), len ( jobs ) ) ) )
+        try :
+            for done, ( m, n, error ) in enumerate ( pool.imap_unordered( _extract_file, jobs ) ) :
+                if error :
+                    print ( m, error )
+                else :
+                    x, y = coordinates[m]
+                    relionstar.write_loop( os.path.join( output_dir, stack_stem( m ) + EXTRACT_SUFFIX ), particle_table( m, x, y, part_dir ) )
+                print ( done + 1, '/', len ( jobs ), label )
+        finally :
+            pool.close()
+            pool.join()
+
+    tables = []
+    stacks = {}
+    for m in micrographs['rlnMicrographName'] :
+        m = str ( m )
+        star = os.path.join( output_dir, stack_stem( m ) + EXTRACT_SUFFIX )
+        if not os.path.exists( star ) :
+            continue
+        table = relionstar.read_loop( star )
+        if table is not None and len ( table ) :
+            tables.append( table )
+            stacks[m] = os.path.join( output_dir, stack_stem( m ) + '.mrcs' )
+    if tables :
+        particles = relionstar.join( relionstar.concatenate( tables ), micrographs, 'rlnMicrographName' )
+        if size != int ( box ) and 'rlnMagnification' in particles.dtype.names :
+            ## the pixel size of the particles follows the rescale
+            particles = relionstar.with_column( particles, 'rlnMagnification', particles['rlnMagnification'] * size / float ( box ) )
+        relionstar.write_loop( os.path.join( output_dir, particles_star ), particles )
+    return stacks
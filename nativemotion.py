@@ -0,0 +1,285 @@
+## Full frame motion correction on the CPU with NumPy ( no MotionCor2 / unblur / GPU needed )
+##
+## One pass over every movie: the frames are streamed from the memory mapped MRC / TIFF stack
+## ( the next batch is read while the current one is transformed ), gain corrected, and each frame
+## is aligned by cross-correlation against the running sum of the frames already aligned. The
+## correlation uses a low resolution crop of the spectrum, the shift is applied as a phase ramp to
+## the full spectrum and added to the plain and, with a dose per frame, the dose weighted sum.
+## Outputs follow MotionCor2:  <stem>.mrc  <stem>_DW.mrc  and  <stem>_shifts.txt  with the shifts.
+
+import os, math, mmap, struct
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import mrcheader, micdb
+
+BATCH_FRAMES = 2
+ALIGN_BOX = 512
+ALIGN_BFACTOR = 500.0
+## critical exposure of Grant & Grigorieff 2015 at 300 kV:  Ne = a * s^b + c
+CRITICAL_A = 0.245
+CRITICAL_B = -1.665
+CRITICAL_C = 2.81
+TIFF_DTYPES = { ( 1, 8 ) : 'u1', ( 1, 16 ) : 'u2', ( 1, 32 ) : 'u4', ( 2, 8 ) : 'i1', ( 2, 16 ) : 'i2',
+                ( 2, 32 ) : 'i4', ( 3, 32 ) : 'f4' }
+EM_DTYPES = { 1 : 'i1', 2 : 'i2', 4 : 'i4', 5 : 'f4' }
+
+class MrcFrames (object) :
+    def __init__ ( self, filename ) :
+        self.header = mrcheader.read_header( filename )
+        h = self.header
+        if h.error or h.truncated :
+            raise ValueError( mrcheader.describe( h ) )
+        if h.mode not in ( 0, 1, 2, 6, 12, 101 ) :
+            raise ValueError( filename + ': unsupported MRC mode ' + str ( h.mode ) )
+        self.shape = ( h.nz, h.ny, h.nx )
+        if h.mode == 101 :
+            self.data = np.memmap( filename, dtype='u1', mode='r', offset=h.offset, shape=( h.nz, h.ny, ( h.nx + 1 ) // 2 ) )
+        else :
+            self.data = np.memmap( filename, dtype=mrcheader.dtype( h ), mode='r', offset=h.offset, shape=self.shape )
+
+    def read ( self, z0, z1 ) :
+        if self.header.mode != 101 :
+            return np.array( self.data[z0:z1], dtype=np.float32 )
+        ## 4 bit data, low nibble first
+        packed = np.asarray( self.data[z0:z1] )
+        frames = np.empty( packed.shape[:2] + ( packed.shape[2] * 2, ), dtype=np.float32 )
+        frames[:, :, 0::2] = packed & 15
+        frames[:, :, 1::2] = packed >> 4
+        return frames[:, :, :self.shape[2]]
+
+    def close ( self ) :
+        self.data = None
+
+class TiffFrames (object) :
+    ## uncompressed strips only, which is what the cameras write unless told to compress
+    def __init__ ( self, filename ) :
+        self.file = open( filename, 'rb' )
+        self.buf = mmap.mmap( self.file.fileno(), 0, access=mmap.ACCESS_READ )
+        self.pages, order = mrcheader.tiff_pages( self.buf )
+        first = self.pages[0]
+        if first.get( mrcheader.TIFF_COMPRESSION, ( 1, ) )[0] != 1 :
+            raise ValueError( filename + ': compressed TIFF, use MotionCor2 for these movies' )
+        bits = first.get( mrcheader.TIFF_BITS, ( 8, ) )[0]
+        kind = first.get( mrcheader.TIFF_SAMPLE_FORMAT, ( 1, ) )[0]
+        if ( kind, bits ) not in TIFF_DTYPES :
+            raise ValueError( filename + ': unsupported TIFF sample format' )
+        self.dtype = np.dtype( order + TIFF_DTYPES[ ( kind, bits ) ] )
+        self.shape = ( len ( self.pages ), first[mrcheader.TIFF_LENGTH][0], first[mrcheader.TIFF_WIDTH][0] )
+
+    def frame ( self, z ) :
+        page = self.pages[z]
+        ny, nx = self.shape[1:]
+        frame = np.empty( ny * nx, dtype=np.float32 )
+        pos = 0
+        for offset, count in zip( page[mrcheader.TIFF_STRIP_OFFSETS], page[mrcheader.TIFF_STRIP_BYTES] ) :
+            strip = np.frombuffer( self.buf, dtype=self.dtype, count=count // self.dtype.itemsize, offset=offset )
+            frame[pos:pos + strip.size] = strip
+            pos += strip.size
+        return frame.reshape( ny, nx )
+
+    def read ( self, z0, z1 ) :
+        return np.stack( [ self.frame( z ) for z in range ( z0, z1 ) ] )
+
+    def close ( self ) :
+        self.buf.close()
+        self.file.close()
+
+def open_frames ( filename ) :
+    with open( filename, 'rb' ) as f :
+        magic = f.read( 4 )
+    if magic in ( b'II*\x00', b'MM\x00*' ) :
+        return TiffFrames( filename )
+    return MrcFrames( filename )
+
+def read_gain ( filename, rotgain=0 ) :
+    ## gain reference ( MRC or EM ), rotated counter-clockwise by rotgain * 90 degrees like MotionCor2 -RotGain
+    if filename.split('.')[-1] == 'dm4' :
+        raise ValueError( filename + ': convert the gain to mrc first ( dm2mrc )' )
+    if filename.split('.')[-1] == 'em' :
+        with open( filename, 'rb' ) as f :
+            head = f.read( 512 )
+        order = '>' if head[0] in ( 3, 5 ) else '<'
+        nx, ny, nz = struct.unpack_from( order + '3i', head, 4 )
+        if head[3] not in EM_DTYPES :
+            raise ValueError( filename + ': unsupported EM data type ' + str ( head[3] ) )
+        gain = np.fromfile( filename, dtype=order + EM_DTYPES[head[3]], count=nx * ny, offset=512 ).reshape( ny, nx )
+    else :
+        gain = MrcFrames( filename ).read( 0, 1 )[0]
+    ## MRC y runs up, numpy rows run down, so counter-clockwise on screen is a negative rot90
+    return np.ascontiguousarray( np.rot90( gain, -int ( rotgain ) ), dtype=np.float32 )
+
+def frequencies ( ny, nx ) :
+    ## ( ky, kx ) index grids of an rfft2 of ny x nx
+    return np.fft.fftfreq( ny ) * ny, np.arange( nx // 2 + 1, dtype=np.float64 )
+
+def crop_spectrum ( spectrum, ny, nx ) :
+    ## the low frequencies of an rfft2, as the rfft2 of an ny x nx image
+    return np.concatenate( ( spectrum[..., :ny // 2, :nx // 2 + 1], spectrum[..., -( ny // 2 ):, :nx // 2 + 1] ), axis=-2 )
+
+def phase_ramp ( ky, kx, dy, dx, ny, nx ) :
+    ## multiplying a spectrum by it moves the image by ( dy, dx ) pixels
+    return np.exp( -2j * math.pi * ky * dy / ny )[:, None] * np.exp( -2j * math.pi * kx * dx / nx )[None, :]
+
+def peak ( cc ) :
+    ## wrapped integer peak with a parabolic sub pixel correction
+    ny, nx = cc.shape
+    y, x = np.unravel_index( np.argmax( cc ), cc.shape )
+    shift = []
+    for axis, ( p, n ) in enumerate ( ( ( y, ny ), ( x, nx ) ) ) :
+        if axis == 0 :
+            a, b, c = cc[ ( p - 1 ) % n, x ], cc[p, x], cc[ ( p + 1 ) % n, x ]
+        else :
+            a, b, c = cc[y, ( p - 1 ) % n ], cc[y, p], cc[y, ( p + 1 ) % n ]
+        d = a - 2 * b + c
+        sub = 0.5 * ( a - c ) / d if d < 0 else 0.0
+        if p > n // 2 :
+            p -= n
+        shift.append( p + sub )
+    return shift
+
+def critical_exposure ( ny, nx, pixel_size, kv ) :
+    ky, kx = frequencies( ny, nx )
+    s = np.sqrt( ( ky[:, None] / ( ny * pixel_size ) ) ** 2 + ( kx[None, :] / ( nx * pixel_size ) ) ** 2 )
+    s[0, 0] = s[0, 1] if nx > 2 else 1.0
+    ne = CRITICAL_A * s ** CRITICAL_B + CRITICAL_C
+    if float ( kv ) < 250 :
+        ne *= 0.8
+    return ne
+
+def align_movie ( filename, output_dir, pixel_size, gain=None, dose=0.0, preexp=0.0, kv=300, binning=1 ) :
+    ## returns the shifts ( pixels ) of every frame relative to the first one
+    frames = open_frames( filename )
+    nz, ny, nx = frames.shape
+    ny -= ny % 2
+    nx -= nx % 2
+    if gain is not None and ( gain.shape[0] < ny or gain.shape[1] < nx ) :
+        raise ValueError( filename + ': gain is ' + str ( gain.shape ) + ' but the frames are ' + str ( frames.shape[1:] ) )
+    box = min ( ALIGN_BOX, ny, nx )
+    box -= box % 2
+    ky, kx = frequencies( ny, nx )
+    cky, ckx = frequencies( box, box )
+    ## B factor filter on the crop, its pixels are ny / box ( nx / box ) times the frame pixels
+    s2 = ( cky[:, None] / ( ny * pixel_size ) ) ** 2 + ( ckx[None, :] / ( nx * pixel_size ) ) ** 2
+    bfilter = np.exp( - ALIGN_BFACTOR * s2 / 4 )
+    bfilter[0, 0] = 0
+    if dose > 0 :
+        ne = critical_exposure( ny, nx, pixel_size, kv )
+        dw_sum = np.zeros( ( ny, nx // 2 + 1 ), dtype=np.complex128 )
+        w2_sum = np.zeros( ( ny, nx // 2 + 1 ), dtype=np.float64 )
+    plain = np.zeros( ( ny, nx // 2 + 1 ), dtype=np.complex128 )
+    reference = np.zeros( ( box, box // 2 + 1 ), dtype=np.complex128 )
+    shifts = []
+
+    def load ( z0 ) :
+        batch = frames.read( z0, min ( nz, z0 + BATCH_FRAMES ) )[:, :ny, :nx]
+        if gain is not None :
+            batch *= gain[:ny, :nx]
+        return batch
+
+    reader = ThreadPool( 1 )
+    try :
+        pending = reader.apply_async( load, ( 0, ) )
+        for z0 in range ( 0, nz, BATCH_FRAMES ) :
+            batch = pending.get()
+            if z0 + BATCH_FRAMES < nz :
+                pending = reader.apply_async( load, ( z0 + BATCH_FRAMES, ) )
+            spectra = np.fft.rfft2( batch )
+            del batch
+            for i in range ( spectra.shape[0] ) :
+                z = z0 + i
+                crop = crop_spectrum( spectra[i], box, box )
+                if z == 0 :
+                    dy, dx = 0.0, 0.0
+                else :
+                    cc = np.fft.irfft2( crop * bfilter * np.conj( reference * bfilter ), s=( box, box ) )
+                    cy, cx = peak( cc )
+                    dy, dx = cy * ny / float ( box ), cx * nx / float ( box )
+                shifts.append( ( dx, dy ) )
+                reference += crop * phase_ramp( cky, ckx, - dy * box / float ( ny ), - dx * box / float ( nx ), box, box )
+                aligned = spectra[i] * phase_ramp( ky, kx, - dy, - dx, ny, nx )
+                plain += aligned
+                if dose > 0 :
+                    w = np.exp( - ( float ( preexp ) + ( z + 1 ) * float ( dose ) ) / ( 2 * ne ) )
+                    dw_sum += aligned * w
+                    w2_sum += w * w
+            del spectra
+    finally :
+        reader.close()
+        reader.join()
+        frames.close()
+
+    stem = micdb.stem( filename )
+    write_sum( os.path.join( output_dir, stem + '.mrc' ), plain, ny, nx, pixel_size, binning )
+    if dose > 0 :
+        ## Grant & Grigorieff: restore the noise power of the unweighted sum
+        w2_sum[w2_sum == 0] = 1
+        dw_sum *= math.sqrt( nz ) / np.sqrt( w2_sum )
+        write_sum( os.path.join( output_dir, stem + '_DW.mrc' ), dw_sum, ny, nx, pixel_size, binning )
+    with open( os.path.join( output_dir, stem + '_shifts.txt' ), 'w' ) as f :
+        f.write( '# frame  dx  dy  ( pixels, unbinned )\n' )
+        for z, ( dx, dy ) in enumerate ( shifts ) :
+            f.write( '%d %.3f %.3f\n' % ( z + 1, dx, dy ) )
+    return shifts
+
+def write_sum ( filename, spectrum, ny, nx, pixel_size, binning=1 ) :
+    ## Fourier cropping for the binning, the mean pixel value is kept
+    binning = float ( binning )
+    if binning > 1 :
+        by = int ( ny / binning ) // 2 * 2
+        bx = int ( nx / binning ) // 2 * 2
+        spectrum = crop_spectrum( spectrum, by, bx )
+        image = np.fft.irfft2( spectrum, s=( by, bx ) ) * ( by * bx ) / float ( ny * nx )
+        pixel_size = float ( pixel_size ) * nx / float ( bx )
+    else :
+        image = np.fft.irfft2( spectrum, s=( ny, nx ) )
+    mrcheader.write_mrc( filename, image, pixel_size )
+
+_gain = None
+
+def _load_gain ( filename, rotgain ) :
+    global _gain
+    if filename :
+        _gain = read_gain( filename, rotgain )
+
+def _align_file ( job ) :
+    filename, output_dir, pixel_size, dose, preexp, kv, binning = job
+    try :
+        align_movie( filename, output_dir, pixel_size, _gain, dose, preexp, kv, binning )
+    except ( IOError, OSError, ValueError, MemoryError ) as e :
+        return filename, str ( e )
+    return filename, ''
+
+def worker_count ( movie, processes ) :
+    ## every worker holds a few complex frames, do not start more than the memory takes
+    h = mrcheader.read_header( movie )
+    need = 16.0 * h.ny * ( h.nx // 2 + 1 ) * ( BATCH_FRAMES + 4 )
+    try :
+        memory = os.sysconf( 'SC_PAGE_SIZE' ) * os.sysconf( 'SC_PHYS_PAGES' )
+    except ( ValueError, OSError, AttributeError ) :
+        return processes
+    return max ( 1, min ( processes, int ( 0.8 * memory / max ( need, 1 ) ) ) )
+
+def align_many ( movies, output_dir, pixel_size, gain='', rotgain=0, dose=0.0, preexp=0.0, kv=300, binning=1,
+                 processes=None, label='Movies are aligned' ) :
+    ## one movie per process, returns { movie : error message } of the failed ones
+    if processes is None :
+        processes = multiprocessing.cpu_count()
+    if len ( movies ) == 0 :
+        return {}
+    if gain :
+        read_gain( gain, rotgain )
+    processes = worker_count( movies[0], min ( processes, len ( movies ) ) )
+    jobs = [ ( m, output_dir, float ( pixel_size ), float ( dose ), float ( preexp ), float ( kv ), float ( binning ) ) for m in movies ]
+    failed = {}
+    pool = multiprocessing.Pool( processes, _load_gain, ( gain, rotgain ) )
+    try :
+        for n, ( movie, error ) in enumerate ( pool.imap_unordered( _align_file, jobs ) ) :
+            if error :
+                failed[movie] = error
+                print ( movie, error )
+            print ( n + 1, '/', len ( movies ), label )
+    finally :
+        pool.close()
+        pool.join()
+    return failed
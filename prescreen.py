@@ -0,0 +1,146 @@
+## Pixel level pre-screen of the micrographs / movies before any CTF or motion correction
+##
+## Truncated transfers, blank exposures over a grid bar and frames with hot readout cost a GPU
+## job each and then pull the histograms of the summary around. Every file gets its header
+## checked ( mrcheader ) and a sparse grid of its pixels, every n-th row and column of a few
+## frames read through a memory map, gives its mean, std and the fraction of saturated pixels.
+## The files are sampled by a pool of processes, about SAMPLE_PIXELS pixels each. A file is left
+## out when
+##   its header is broken or the file is shorter than the header says
+##   its pixels are not all finite numbers
+##   its pixels are all the same ( blank )
+##   more than SATURATED of its pixels sit at the top of the range of the detector
+##   its mean is OUTLIER_Z robust standard deviations ( median / MAD of the files screened
+##   together ) below or above the others ( grid bar, no ice )
+## The files left out and why are written to a report, they can also be moved to a quarantine
+## directory so the next run does not see them.
+
+import os, collections, multiprocessing
+import numpy as np
+import mrcheader
+
+SAMPLE_PIXELS = 65536
+SAMPLE_FRAMES = 3
+SATURATED = 0.01
+OUTLIER_Z = 8.0
+## the mean of a file is only compared with the others when there are this many
+OUTLIER_MIN = 8
+QUARANTINE = 'quarantine'
+## full scale of the usual 8, 12, 14 and 16 bit converters, float data saturates at these too
+CEILINGS = ( 255.0, 4095.0, 16383.0, 32767.0, 65535.0 )
+
+Screen = collections.namedtuple( 'Screen', [ 'filename', 'mean', 'std', 'saturated', 'reason' ] )
+
+def ceilings ( h ) :
+    top = set ( CEILINGS )
+    kind = np.dtype( mrcheader.dtype( h ) )
+    if kind.kind in 'iu' :
+        top.add( float ( np.iinfo( kind ).max ) )
+    return top
+
+def sample ( h ) :
+    ## every n-th pixel of SAMPLE_FRAMES frames spread over the stack, as float64
+    frames = sorted ( set ( np.linspace( 0, h.nz - 1, min ( SAMPLE_FRAMES, h.nz ) ).astype( int ) ) )
+    per_frame = max ( 1, SAMPLE_PIXELS // len ( frames ) )
+    step = max ( 1, int ( np.sqrt( h.nx * h.ny / float ( per_frame ) ) ) )
+    data = np.memmap( h.filename, dtype=mrcheader.dtype( h ), mode='r', offset=h.offset, shape=( h.nz, h.ny, h.nx ) )
+    try :
+        return np.concatenate( [ np.asarray( data[z, step // 2::step, step // 2::step], dtype=np.float64 ).ravel() for z in frames ] )
+    finally :
+        del data
+
+def screen_file ( filename ) :
+    ## Screen of one file, reason is '' when nothing is wrong with it
+    h = mrcheader.read_header( filename )
+    if h.error or h.truncated :
+        return Screen( filename, float ( 'nan' ), float ( 'nan' ), 0.0, 'truncated or unreadable, ' + mrcheader.describe( h ).split( ' : ', 1 )[-1] )
+    if h.mode not in mrcheader.REAL_MODES :
+        ## tiff movies ( compressed ) and packed modes only get the header check
+        return Screen( filename, float ( 'nan' ), float ( 'nan' ), 0.0, '' )
+    try :
+        pixels = sample( h )
+    except ( IOError, OSError, ValueError ) as e :
+        return Screen( filename, float ( 'nan' ), float ( 'nan' ), 0.0, 'unreadable, ' + str ( e ) )
+    if not np.isfinite( pixels ).all() :
+        return Screen( filename, float ( 'nan' ), float ( 'nan' ), 0.0, 'pixels that are not numbers ( nan / inf )' )
+    mean = float ( pixels.mean() )
+    std = float ( pixels.std() )
+    top = float ( pixels.max() )
+    saturated = np.count_nonzero( pixels == top ) / float ( pixels.size ) if top in ceilings( h ) else 0.0
+    reason = ''
+    if std == 0 :
+        reason = 'blank, every pixel is %g' % mean
+    elif saturated > SATURATED :
+        reason = 'saturated, %.1f %% of the pixels at %g' % ( 100 * saturated, top )
+    return Screen( filename, mean, std, saturated, reason )
+
+def outliers ( screens ) :
+    ## the files whose mean is far from the others, robust z from the median and MAD
+    means = np.array( [ s.mean for s in screens if not s.reason and np.isfinite( s.mean ) ] )
+    if len ( means ) < OUTLIER_MIN :
+        return screens
+    median = np.median( means )
+    mad = 1.4826 * np.median( np.abs( means - median ) )
+    if mad == 0 :
+        return screens
+    checked = []
+    for s in screens :
+        z = ( s.mean - median ) / mad if np.isfinite( s.mean ) else 0.0
+        if not s.reason and abs ( z ) > OUTLIER_Z :
+            s = s._replace( reason='%s, mean %g where the median is %g ( %.0f MAD )' % ( 'dark' if z < 0 else 'bright', s.mean, median, z ) )
+        checked.append( s )
+    return checked
+
+def screen ( files, processes=None ) :
+    ## Screen of every file, in the given order
+    files = list ( files )
+    processes = min ( processes or multiprocessing.cpu_count(), len ( files ) )
+    if processes < 2 :
+        screens = [ screen_file( f ) for f in files ]
+    else :
+        pool = multiprocessing.Pool( processes )
+        try :
+            screens = pool.map( screen_file, files, chunksize=max ( 1, min ( 16, len ( files ) // ( 4 * processes ) ) ) )
+        finally :
+            pool.close()
+            pool.join()
+    return outliers( screens )
+
+def write_report ( rejected, total, filename ) :
+    ## one line per file left out, with the numbers it was judged on
+    with open( filename, 'w' ) as f :
+        f.write( '## %d of %d files left out by the pre-screen\n' % ( len ( rejected ), total ) )
+        f.write( '## file mean std saturated reason\n' )
+        for s in rejected :
+            f.write( '%s %.4g %.4g %.4f %s\n' % ( s.filename, s.mean, s.std, s.saturated, s.reason ) )
+
+def quarantine ( rejected, directory ) :
+    ## move the files left out to directory ( next to them, one rename each ), returns the moved ones
+    moved = []
+    for s in rejected :
+        target = os.path.join( directory, os.path.basename( s.filename ) )
+        try :
+            if not os.path.isdir( directory ) :
+                os.makedirs( directory )
+            os.rename( s.filename, target )
+            moved.append( target )
+        except OSError as e :
+            print ( '  cannot move', s.filename, 'to', directory, ':', e )
+    return moved
+
+def check_micrographs ( files, report='', quarantine_dir='', processes=None ) :
+    ## screens the files, prints and reports the ones left out ( and moves them to quarantine_dir ).
+    ## Returns the files that are fine and the Screen of the others
+    files = list ( files )
+    screens = screen( files, processes )
+    rejected = [ s for s in screens if s.reason ]
+    if rejected :
+        print ('\n' + str ( len ( rejected ) ) + ' of ' + str ( len ( files ) ) + ' files fail the pre-screen, I will skip them:' )
+        for s in rejected :
+            print ( '  ' + s.filename + ' : ' + s.reason )
+        if report :
+            write_report( rejected, len ( files ), report )
+            print ('The list is in', report )
+        if quarantine_dir :
+            print ( len ( quarantine( rejected, quarantine_dir ) ), 'files moved to', quarantine_dir )
+    return [ s.filename for s in screens if not s.reason ], rejected
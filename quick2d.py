@@ -12,6 +12,7 @@ import numpy as np
 import numpy.random as rnd
 from matplotlib import cm as CM
 import subprocess as subp
+import jobwatch, gpudispatch, micdb, relionstar, mrcheader, nativemotion, nativeextract, ctflog, discover, staging, gpulease, prescreen, ctfjobs, ctfcache, triage
 
 ## Create a general dictionary of script parameters. Easy to expand later
 author = 'test@test.com'
@@ -44,10 +45,13 @@ quick2d_parameters['timestamp'] =  'QUICK2D_' + quick2d_parameters['time']
 quick2d_parameters['workdir'] = os.getcwd() + '/' + quick2d_parameters['timestamp'] + '/'
 quick2d_parameters['power_users'] = 0
 quick2d_parameters['write_movies'] = 'NO'
+quick2d_parameters['align'] = 'motioncor2'
+quick2d_parameters['extract'] = 'native'
 quick2d_parameters['ngpu'] = 0
 quick2d_parameters['bin'] = 1
 quick2d_parameters['ncpu'] = 0
 quick2d_parameters['gain'] = ' '
+quick2d_parameters['rotgain'] = 0
 quick2d_parameters['input_commands'] = ' '.join(sys.argv)
 quick2d_parameters['rescut'] = 0
 quick2d_parameters['dose_filter'] = 'NO' 
@@ -57,6 +61,9 @@ quick2d_parameters['3dmodel'] = ''
 quick2d_parameters['3dmodelpix'] = '' 
 quick2d_parameters['lavgmin'] = ' --lave_min -1 '
 quick2d_parameters['lavgmax'] = ' --lave_max 1.2 '
+quick2d_parameters['resume'] = ''
+quick2d_parameters['prescreen'] = 1
+quick2d_parameters['triage'] = triage.OUTLIER_Z
 
 
 
@@ -117,6 +124,8 @@ select = optparse.OptionGroup(parser, 'Micrograph Selection')
 select.add_option("--mic",             dest="pattern",           help="Common unique pattern in the micrograph name ( to identify/select)  eg  --m=_frames default all mrc files in the directory")
 select.add_option("--exc",             dest="exclude_pattern",   help="Micrograph name that you want to exclude    eg  --exc=_DW No default ")
 select.add_option("--suf",             dest="suffix",            help="Micrograph suffix  eg --suf=mrc  default mrcs or mrc ")
+select.add_option("--noscreen",        dest="noscreen",          action="store_true", default=False,  help="Do not pre-screen the movies, by default empty, truncated and saturated ones are skipped")
+select.add_option("--notriage",        dest="notriage",          action="store_true", default=False,  help="Pick and extract every micrograph, by default those with a ctf fit far off the others are left out")
 parser.add_option_group(select)
 
 movie = optparse.OptionGroup(parser, 'Movies')
@@ -125,6 +134,8 @@ movie.add_option("--gain",             dest="gain",              help="Camera ga
 movie.add_option("--bin",              dest="bin",               help="Binning factor for micrographs default - no binning")
 movie.add_option("--stack",            dest="stack",             action="store_true", default=False,  help="Write alinged movie stacks eg --stack Default false")
 movie.add_option("--preexp",           dest="preexposure",       help=" Pre Exposure per frame e/A^2 No default")
+movie.add_option("--rotgain",          dest="rotgain",           help=" Gain rotation No default")
+movie.add_option("--align",            dest="align",             help="Movie alignment program motioncor2 or native ( CPU only ) eg --align=native default motioncor2")
 parser.add_option_group(movie)
 
 picking = optparse.OptionGroup(parser, 'Particle picking')
@@ -150,6 +161,8 @@ computing.add_option("--cpu",          dest="ncpu",              help="Number of
 computing.add_option("--gpu",          dest="ngpu",              help="Number of gpus to use eg --gpu=2 defaults use all available")
 computing.add_option("--devel",        dest="power",             action="store_true", default=False, help="For developers....")
 computing.add_option("--rcut",         dest="rescut",            help="only works with --devel")
+computing.add_option("--extract",      dest="extract",           help="Particle extraction native ( numpy, all cpus ) or relion ( relion_preprocess_mpi ) eg --extract=relion default native")
+computing.add_option("--resume",       dest="resume",            help="Continue an earlier run in its directory, only the missing steps are done eg --resume=QUICK2D_01_Jan_2018_10_00_00AM")
 parser.add_option_group(computing)
 
 (options, args) = parser.parse_args()
@@ -214,6 +227,12 @@ if options.exclude_pattern :
 if options.gain :
     quick2d_parameters['gain'] = options.gain
 
+if options.rotgain :
+    quick2d_parameters['rotgain'] = options.rotgain
+
+if options.align :
+    quick2d_parameters['align'] = options.align
+
 if options.bin :
     quick2d_parameters['bin'] = options.bin
 
@@ -229,6 +248,24 @@ if options.ngpu :
 if options.rescut :
     quick2d_parameters['rescut'] = options.rescut
 
+if options.extract :
+    quick2d_parameters['extract'] = options.extract
+
+if options.resume :
+    quick2d_parameters['resume'] = options.resume
+    quick2d_parameters['timestamp'] = os.path.basename( os.path.normpath( options.resume ) )
+    quick2d_parameters['workdir'] = os.path.abspath( options.resume ) + '/'
+
+## work directories of earlier runs whose background removal was cut short
+if staging.reclaim( os.path.dirname( os.path.normpath( quick2d_parameters['workdir'] ) ) ) :
+    print ('\nRemoving the work directories left by earlier runs in the background')
+
+if str(options.notriage) == "True" :
+    quick2d_parameters['triage'] = float ( 'inf' )
+
+if str(options.noscreen) == "True" :
+    quick2d_parameters['prescreen'] = 0
+
 if str(options.stack) == "True" :
     quick2d_parameters['write_movies'] = 'YES'
 
@@ -307,7 +344,17 @@ if quick2d_parameters['dose'] != 0 :
 ## CHECK FOR THE PRESENSE OF EXECUTABLES
 def check_execs() :
 
-    exec_list = ['header', 'Gctf', 'relion_refine_mpi', 'relion_preprocess_mpi', 'MotionCor2', 'Gautomatch','e2proc2d.py','relion_display']
+    exec_list = ['Gctf', 'relion_refine_mpi', 'relion_preprocess_mpi', 'MotionCor2', 'Gautomatch','e2proc2d.py','relion_display']
+    if quick2d_parameters['align'] == 'native' :
+        exec_list.remove('MotionCor2')
+    elif quick2d_parameters['align'] != 'motioncor2' :
+        print ('\n--align can be motioncor2 or native')
+        quit ()
+    if quick2d_parameters['extract'] == 'native' :
+        exec_list.remove('relion_preprocess_mpi')
+    elif quick2d_parameters['extract'] != 'relion' :
+        print ('\n--extract can be native or relion')
+        quit ()
 
     for i in range (len(exec_list)):
         if not check_for_executables(exec_list[i]) :
@@ -349,12 +396,10 @@ sg = bcolors.OKGREEN
 eb = bcolors.ENDC
 
 
-def count_micrographs(pattern, micdir, exclude, printflag) :
-    micrographs_list = glob.glob(os.path.join(micdir,pattern ))
- 
-    for name in glob.glob(os.path.join(micdir,pattern )) :
-        if exclude in name :
-            micrographs_list.remove(name)
+def count_micrographs(patterns, micdir, exclude, printflag) :
+    ## sorted, so a resumed run takes the same micrographs. The first of the patterns with
+    ## files is used, the directory is listed once for all of them
+    pattern, micrographs_list = discover.micrographs( micdir, patterns, exclude )
     micrographs_total = len( micrographs_list )
 
     if micrographs_total != 0 :
@@ -364,10 +409,12 @@ def count_micrographs(pattern, micdir, exclude, printflag) :
             micrographs_total = len( micrographs_list )
             print ('\nI have taken only',micrographs_total, 'micrographs ( quick 2d )')
         
-    return micrographs_total,micrographs_list
+    return micrographs_total,micrographs_list,pattern
 
 def number_of_gpu( micrographs_list ) :
-    gpus = len(glob.glob('/proc/driver/nvidia/gpus/*'))
+    ## the GPUs are leased from the other runs on this host ( see gpulease ), the dispatchers
+    ## only use the ids of the lease
+    gpus = len ( gpulease.devices() )
     if gpus == 0 :
         print ('I cant find any usable GPU')
         print ('I will quit')
@@ -377,17 +424,21 @@ def number_of_gpu( micrographs_list ) :
         quick2d_parameters['ngpu']  = len (micrographs_list)
 
     quick2d_parameters['ngpu']  = int( quick2d_parameters['ngpu'] )
-    if quick2d_parameters['ngpu'] == 0 :
-        print (' Available GPUS: ',gpus )
-    else :
-        if ( gpus != 0 ) :
-            print (' Available GPUS: ',gpus )
-            print (' Using ', quick2d_parameters['ngpu'], 'GPUS' )
-            gpus = quick2d_parameters['ngpu']
-    return gpus
+    lease = gpulease.acquire( quick2d_parameters['ngpu'], int( quick2d_parameters['ncpu'] ), 'quick2d' )
+    quick2d_parameters['lease'] = lease
+    quick2d_parameters['gpu_ids'] = lease.gpus
+    print (' Available GPUS: ',gpus )
+    if len ( lease.gpus ) != gpus :
+        print (' Using GPUS', ' '.join( str ( g ) for g in lease.gpus ), '( the others are in use or not asked for )' )
+    return len ( lease.gpus )
 
 def number_of_cpu() :
     cpus = multiprocessing.cpu_count()
+    if 'lease' in quick2d_parameters :
+        cores = quick2d_parameters['lease'].cores
+        if cores != cpus :
+            print (' Using ', cores, 'of', cpus, 'CPUS' )
+        return cores
     quick2d_parameters['ncpu']  = int (quick2d_parameters['ncpu'] )
     if quick2d_parameters['ncpu'] == 0 :
         print (' Available CPUS: ',cpus )
@@ -397,12 +448,22 @@ def number_of_cpu() :
             print (' Using ', quick2d_parameters['ncpu'], 'CPUS' )
     return cpus
 
-def get_movie_frame_number ( micrographs_list ) :
-    args = 'header -size -i ' + micrographs_list[0] 
-    proc = subp.Popen( args,  shell = True,  stdout=subp.PIPE ) 
-    proc.wait
-    z  =  int ( proc.communicate()[0].decode("utf-8").split()[2] )
-    return z
+def check_movie_headers ( micrographs_list ) :
+    ## every header is read before any GPU job, truncated files and odd shapes are left out
+    headers = mrcheader.check_movies( micrographs_list )
+    if len ( headers ) != 0 and quick2d_parameters['prescreen'] == 1 :
+        ## and then the empty and saturated ones ( see prescreen )
+        report = os.path.join( quick2d_parameters['datadir'], quick2d_parameters['timestamp'] + '_prescreen.txt' )
+        kept = set ( prescreen.check_micrographs( [ h.filename for h in headers ], report, '', int( quick2d_parameters['ncpu'] ) )[0] )
+        headers = [ h for h in headers if h.filename in kept ]
+    if len ( headers ) == 0 :
+        print ('None of the movies can be read')
+        print ('I will quit')
+        quit ()
+    return [ h.filename for h in headers ], headers
+
+def get_movie_frame_number ( headers ) :
+    return headers[0].nz
 
 def grep(pattern,fileObj):
     r=[]
@@ -419,47 +480,31 @@ def round_up_to_even(f):
 def make_dir_soft_links ( workdir, micrographs_list) :
     dest_dir  = workdir + '/'
     mic_dir  = workdir + '/micrographs'
-    os.makedirs(workdir)
-    os.makedirs(mic_dir)
+    if os.path.isdir (mic_dir) != True :
+        os.makedirs(mic_dir)
     #for file in glob.glob (pattern) :
      #   if exclude not in file :
       #      file_with_dir = micdir + '/' + file
        #     file_with_mic_dir = mic_dir + '/' + file
         #    os.symlink ( file_with_dir, file_with_mic_dir )
-    for file in micrographs_list :
-        micname =  file.split('/')[-1]
-        file_with_mic_dir = mic_dir + '/' + micname
-        os.symlink ( file, file_with_mic_dir )
+    staging.link_many( micrographs_list, mic_dir )
 
     os.chdir ( mic_dir )
 
-def make_dir_soft_links1 ( workdir, micrographs_list ) :
-    dest_dir  = workdir + '/'
-    movie_dir  = workdir + '/movies'
-    os.makedirs(workdir)
-    os.makedirs(movie_dir)
-    number_of_gpus = quick2d_parameters['ngpu']
-    split_by_gpu = np.array_split(micrographs_list,number_of_gpus)
-    i = 0
-    while ( i < number_of_gpus ) :
-        gpu_dir = movie_dir + '/gpu' + str(i)
-        os.makedirs(gpu_dir)
-        for file in split_by_gpu[i] :
-            micname =  file.split('/')[-1]
-            file_with_gpu_dir = gpu_dir + '/' + micname
-            os.symlink ( file, file_with_gpu_dir )
-        i += 1
-
 def write_unblur_input ( micname, frames, pixel_size , dose_filter, exposure, kv, preexposure, movies ) :
-    name = ''.join ( micname.split('.')[:-1] )
+    name = os.path.splitext( micname )[0]
     suf = micname.split('.')[-1]
-    real = '../../' + micname
-    dest = name + '_in.mrc' 
-    os.symlink ( real, dest )
+    ## unblur reads an .mrc movie where it is, only the other formats get an _in.mrc link
+    if suf == 'mrc' :
+        movie = '../../' + micname
+    else :
+        movie = name + '_in.mrc'
+        if not os.path.lexists ( movie ) :
+            os.symlink ( '../../' + micname, movie )
     unblur_input = []
     unblur_input.append ( '#!/usr/bin/csh -f' )
     unblur_input.append ('unblur  > ' +  name + '.unblur.log << EOF' )
-    unblur_input.append ( name + '_in.mrc' )
+    unblur_input.append ( movie )
     unblur_input.append ( frames )
     unblur_input.append ( '../unblur_sum/' + name + '.mrc' )
     unblur_input.append ( name + '_shifts.txt' )
@@ -525,28 +570,26 @@ def unblur_align ( micrographs_list) :
         ps.append(proc)
 
     #Keep the user informed
-    #shifts.txt = len(glob.glob("*_shifts.txt" ))
-    b = len (micrographs_list )
-    c = 0
-    a = 0 
     print ('\n Aligning using Unblur \n')
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'dat file are converted to mrc(s)' )
-            c = a
-        a = len(glob.glob("*_shifts.txt" ))
-
-    for p in ps:
-        p.wait()
+    jobwatch.wait_for_outputs( "*_shifts.txt", len (micrographs_list ), ps, label='dat file are converted to mrc(s)' )
 
 def MotionCor2_align ( number_of_gpus ) :
     output_dir = quick2d_parameters['workdir'] + '/aligned/'
-    os.makedirs(output_dir)
+    if os.path.isdir (output_dir) != True :
+        os.makedirs(output_dir)
     os.chdir (output_dir)
+    todo = set ( micdb.pending( manifest, micrograph_names, 'align' ) )
+    if len (todo) == 0 :
+        print (sg + '\nAll movies are already aligned')
+        print (eb)
+        return
+    movies = [ m for m, n in zip( micrographs_list, micrograph_names ) if n in todo ]
     if quick2d_parameters['gain'] != "":
         gain = ' -Gain ' + quick2d_parameters['gain'] + ' '
     else :
         gain = ""
+    if quick2d_parameters['rotgain'] != 0 :
+        gain = gain + ' -RotGain ' + str ( quick2d_parameters['rotgain'] ) + ' '
 
     if quick2d_parameters['micrograph_name_suffix'] == "tif":
         input_stem = ' -InTiff '
@@ -554,41 +597,30 @@ def MotionCor2_align ( number_of_gpus ) :
         input_stem = ' -InMrc '
 
     output = open("MotionCor2.log", 'w')
-    ps = []
-    for i in range(number_of_gpus) :
-        input_dir  = quick2d_parameters['workdir'] + '/movies/gpu' + str (i) + '/'
-        outlog = 'gpu' + str (i) + '.log'
-        output = open(outlog, 'w')
-        args = 'MotionCor2 ' + input_stem  + input_dir  + ' -OutMrc ' + output_dir + ' -patch 5 5  -Tol 0.5 -Serial 1  -Gpu ' + str (i )  \
+
+    ## one MotionCor2 call per movie, chained per batch so the GPUs share one queue
+    def motioncor2_command ( batch, gpu, number ) :
+        args = []
+        for movie in batch :
+            k = micdb.stem( movie )
+            args.append ( 'MotionCor2 ' + input_stem  + movie  + ' -OutMrc ' + output_dir + k + '.mrc' + ' -patch 5 5  -Tol 0.5 -Gpu ' + str (gpu )  \
                  + ' -FtBin ' + str(quick2d_parameters['bin']) + gain + ' -InitDose ' + str (quick2d_parameters['preexposure'])  + ' -FmDose ' + str(quick2d_parameters['dose']) \
-                 + ' -PixSize '+ str (quick2d_parameters['pixel_size']) + ' -kV ' + str (quick2d_parameters['kv']) + ' -Throw 1 '
-        output.writelines ( str(args ) + '\n' )
-        proc = subp.Popen( args,  shell = True,  stdout = output)
-        #print (args)
-        ps.append(proc)
+                 + ' -PixSize '+ str (quick2d_parameters['pixel_size']) + ' -kV ' + str (quick2d_parameters['kv']) + ' -Throw 1 ' )
+        return ' ; '.join(args)
+
+    ps = gpudispatch.dispatch( movies, quick2d_parameters['gpu_ids'][:number_of_gpus], motioncor2_command, output )
 
     #Keep the user informed       
     if quick2d_parameters['dose'] == 0 :
         #list = output_dir + '/*' + quick2d_parameters['micrograph_name_suffix']
         list = output_dir + '/*.mrc'
+        expected = [ n + '.mrc' for n in todo ]
     else :
         #list = output_dir + '/*_DW.' + quick2d_parameters['micrograph_name_suffix']
         list = output_dir + '/*_DW.mrc'
-    a = len(glob.glob(list))
-    b = len (micrographs_list )
-    c = 0
+        expected = [ n + '_DW.mrc' for n in todo ]
     print ('\nAligning the frames using MotionCor2\n')
-    while ( a < b ) :
-        if ( a > c ) :
-            #pbar = ProgressBar(maxval=b).start()
-            #time.sleep(0.01)
-            #pbar.update(a+1)
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob(list ))
-    #pbar.finish()
-    for p in ps:
-        p.wait()
+    jobwatch.wait_for_outputs( list, len (movies ), ps, expected=expected )
 
     if quick2d_parameters ['micrograph_name_suffix'] == 'mrcs' :
         mrcs_dir_name = output_dir + '/*mrcs'
@@ -597,69 +629,131 @@ def MotionCor2_align ( number_of_gpus ) :
             name = mrcs.replace('mrcs','')
             mrc = name + 'mrc'
             os.rename ( mrcs, mrc)
+
+    record_aligned( output_dir, todo )
+    print (sg + '\nMovie alignment done')
+    print (eb)
+
+def native_align () :
+    output_dir = quick2d_parameters['workdir'] + '/aligned/'
+    if os.path.isdir (output_dir) != True :
+        os.makedirs(output_dir)
+    os.chdir (output_dir)
+    todo = set ( micdb.pending( manifest, micrograph_names, 'align' ) )
+    if len (todo) == 0 :
+        print (sg + '\nAll movies are already aligned')
+        print (eb)
+        return
+    movies = [ m for m, n in zip( micrographs_list, micrograph_names ) if n in todo ]
+    gain = quick2d_parameters['gain'].strip()
+    if gain != '' :
+        gain = os.path.join( quick2d_parameters['datadir'], gain )
+    print ('\nAligning the frames on the CPU ( native )\n')
+    try :
+        nativemotion.align_many( movies, output_dir, quick2d_parameters['pixel_size'], gain, quick2d_parameters['rotgain'], \
+                 quick2d_parameters['dose'], quick2d_parameters['preexposure'], quick2d_parameters['kv'], quick2d_parameters['bin'], number_of_cpu() )
+    except ( IOError, ValueError ) as e :
+        print (e)
+        print ('I will quit')
+        quit ()
+    record_aligned( output_dir, todo )
     print (sg + '\nMovie alignment done')
     print (eb)
 
+def record_aligned ( output_dir, todo ) :
+    ## aligned sums into the manifest, a movie is done once its sums are there
+    aligned = {}
+    dw = {}
+    for n in todo :
+        if os.path.exists( output_dir + n + '.mrc' ) :
+            aligned[n] = output_dir + n + '.mrc'
+        if os.path.exists( output_dir + n + '_DW.mrc' ) :
+            dw[n] = output_dir + n + '_DW.mrc'
+    micdb.update_many( manifest, 'aligned', aligned )
+    micdb.update_many( manifest, 'dw', dw )
+    if quick2d_parameters['dose'] == 0 :
+        done = [ n for n in todo if n in aligned ]
+    else :
+        done = [ n for n in todo if n in aligned and n in dw ]
+    micdb.mark( manifest, done, 'align' )
+    micdb.mark( manifest, [ n for n in todo if n not in done ], 'align', 'failed' )
+
+def record_gctf ( micrographs_list, names, todo ) :
+    ## Gctf results of this run into the manifest, every log is read once
+    stems = dict ( ( os.path.splitext( os.path.basename(mic) )[0], name ) for mic, name in zip( micrographs_list, names ) if name in todo )
+    logs = [ stem + '_gctf.log' for stem in stems if os.path.exists( stem + '_gctf.log' ) ]
+    results = ctflog.parse_logs( logs, 'gctf', number_of_cpu() )
+    found = [ stems[str ( m )] for m in results['micrograph'] ]
+    for field in ( 'defocus_u', 'defocus_v', 'defocus_angle', 'ccc', 'resolution' ) :
+        micdb.update_many( manifest, field, dict ( zip( found, results[field].tolist() ) ) )
+    micdb.update_many( manifest, 'ctf_log', dict ( zip( found, [ os.path.abspath( str ( l ) ) for l in results['log'] ] ) ) )
+    micdb.mark( manifest, found, 'ctf' )
+    micdb.mark( manifest, [ n for n in stems.values() if n not in found ], 'ctf', 'failed' )
+
+def write_ctf_star ( micrographs_list, names, pixel_size, kv, cs, ac ) :
+    ## micrographs_ctf.star straight from the manifest ( was relion_run_ctffind --only_make_star )
+    fields = ( 'defocus_u', 'defocus_v', 'defocus_angle', 'ccc', 'resolution' )
+    values = dict ( ( field, micdb.column( manifest, field, names ) ) for field in fields )
+    rows = [ ( mic.split('/')[-1], name ) for mic, name in zip( micrographs_list, names ) if all ( name in values[field] for field in fields ) ]
+    mics = [ mic for mic, name in rows ]
+    columns = [ [ values[field][name] for mic, name in rows ] for field in fields ]
+    ctflog.write_micrographs_star( 'micrographs_ctf.star', mics, columns[0], columns[1], columns[2], columns[3], columns[4], pixel_size, kv, cs, ac )
+
+def triage_micrographs () :
+    ## micrographs_selected.star and micrographs_rejected.star from the ctf fits ( see triage ),
+    ## returns the names of the selected micrographs, None without a micrographs_ctf.star
+    if not os.path.exists( 'micrographs_ctf.star' ) :
+        return None
+    selected, rejected = triage.triage_star( 'micrographs_ctf.star', z=quick2d_parameters['triage'] )
+    triage.report( rejected, len ( selected ) + len ( rejected ) )
+    names = micdb.names_for( manifest, selected )
+    micdb.mark( manifest, names, 'triage' )
+    micdb.mark( manifest, micdb.names_for( manifest, [ m for m, reason in rejected ] ), 'triage', 'rejected' )
+    return set ( names )
+
 def GCTF ( pixel_size, cs, kv, micrographs_list, negative ) :
     #output_dir = quick2d_parameters['workdir'] + '/ctf_Gctf/'
     #os.makedirs(output_dir)
     #os.chdir (output_dir) 
     number_of_gpus = quick2d_parameters['ngpu']
-    split_by_gpu = np.array_split(micrographs_list,number_of_gpus)
-    import subprocess as subp
     import time
-    if float (pixel_size)  > 3 :
-        resH = 2 * float (pixel_size)
-        B_resH = 9.00
-    else :
-        resH = 4  
-        B_resH = 7.00
     if ( negative == 1 ) :
-        box = ' '
         ac = ' --ac 0.35 '
     else :
-        box = ' --boxsize 512 ' 
         ac = ' --ac 0.07 '
-    output = open("gctf.log", 'w')
-    ps = []
-    for i in range(number_of_gpus) :
-        star = 'gpu' + str (i) + '.star'
-        args = 'Gctf --apix '+ str(pixel_size)+ ' --kV ' + str(kv) +' --cs ' + str(cs) + ' ' + ' '.join(split_by_gpu[i]) \
-               + ' --gid ' + str(i) + ' --do_validation' + ' --resH ' + str(resH) + ' --B_resH ' + str(B_resH) \
-               + box + ac + ' --ctfstar ' + star
-               #+ ' --ac 0.07 --do_EPA  --boxsize 512 --do_Hres_ref --Href_resL 20'  
-        #print (args)
-        proc = subp.Popen( args,  shell = True,  stdout = output)
-        ps.append(proc)
+    names = micdb.names_for( manifest, micrographs_list )
+    todo = set ( micdb.pending( manifest, names, 'ctf' ) )
+    ctf_list = [ m for m, n in zip( micrographs_list, names ) if n in todo ]
+    output = open("gctf.log", 'a')
+
+    ## the same Gctf command as makesum.py, so the two share their results ( see ctfcache )
+    gctf_command = ctfjobs.gctf_commands ( pixel_size, cs, kv, negative )
+    cache_key = ctfcache.command_key ( gctf_command )
+    cached = set ( ctfcache.restore ( ctf_list, cache_key ) )
+    if cached :
+        print ('\n', len (cached), 'micrographs have a Gctf result of an earlier run ( ctf cache )')
+        ctf_list = [ m for m in ctf_list if m not in cached ]
+
+    if ctf_list :
+        ps = gpudispatch.dispatch( ctf_list, quick2d_parameters['gpu_ids'][:number_of_gpus], gctf_command, output )
+
+        #Keep the user informed       
+        print ('\nCalculate CTF for your micrographs using Gctf\n')
+        expected = [ os.path.splitext( os.path.basename(m) )[0] + '_gctf.log' for m in ctf_list ]
+        jobwatch.wait_for_outputs( "*gctf.log", len (ctf_list ), ps, expected=expected )
+        ctfcache.store ( ctf_list, cache_key )
+    else :
+        print ('\nCTF of all micrographs is already known\n')
+    output.close()
+
+    record_gctf( micrographs_list, names, todo )
 
-    #Keep the user informed       
-    a = len(glob.glob("*gctf.log" ))
-    b = len (micrographs_list )
-    c = 0
-    print ('\nCalculate CTF for your micrographs using Gctf\n')
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob("*gctf.log" ))
-
-    for p in ps:
-        p.wait()
-         
     star = 'micrographs.star'
-    g = open (star, "w")
-    g.writelines ( '\n' + 'data_' + '\n\n' + 'loop_' + '\n' + '_rlnMicrographName #1' + '\n' )
-    for mic in micrographs_list :
-        mic = mic.split('/')[-1] 
-        g.writelines (  mic + '\n' )
-    g.close()
+    mics = [ mic.split('/')[-1] for mic in micrographs_list ]
+    relionstar.write_loop( star, relionstar.make_table( [ ( 'rlnMicrographName', mics ) ] ) )
     
 
-    output = open("star.log", 'w')
-    args = 'relion_run_ctffind --i micrographs.star --only_make_star --use_gctf --o . '
-    proc = subp.Popen( args,  shell = True, stdout = output  )
-    proc.wait
-    output.close()
+    write_ctf_star( micrographs_list, names, pixel_size, kv, cs, float ( ac.split()[-1] ) )
 
     #input_star  = open ("micrographs_ctf.star", 'r' )
     #output_star = open ("micrographs_DW.star",  'w' )
@@ -667,28 +761,11 @@ def GCTF ( pixel_size, cs, kv, micrographs_list, negative ) :
         #output_star.write(line.replace('.mrc', '_DW.mrc')) 
     #    print (line)
 
-    defocus1_list = []
-    defocus2_list = []
-    defocus_angle_list = []
-    CCC_list = []
-    resolution_list = []
-    for file in glob.glob("*_gctf.log") :
-        myfile = open (file, "r" )
-        b  =  ' '.join(grep("Final",myfile ))
-        defocus1_list.append(b.split()[0])
-        defocus2_list.append(b.split()[1])
-        defocus_angle_list.append(b.split()[2])
-        CCC_list.append(b.split()[3])
-    for file in glob.glob("*_gctf.log") :
-        myfile = open (file, "r" )
-        b  =  ' '.join(grep("RES_LIMIT",myfile ))
-        resolution_list.append(b.split()[-1])
-    defocus1_list = list(map(float, defocus1_list))
-    defocus2_list = list(map(float, defocus2_list))
-    defocus_angle_list = list(map(float, defocus_angle_list))
-    CCC_list = list(map(float, CCC_list))
-    resolution_list = list(map(float, resolution_list))
-    myfile.close()
+    defocus1_list = list ( micdb.column( manifest, 'defocus_u', names ).values() )
+    defocus2_list = list ( micdb.column( manifest, 'defocus_v', names ).values() )
+    defocus_angle_list = list ( micdb.column( manifest, 'defocus_angle', names ).values() )
+    CCC_list = list ( micdb.column( manifest, 'ccc', names ).values() )
+    resolution_list = list ( micdb.column( manifest, 'resolution', names ).values() )
     mean_defocus1 = round ( sum (defocus1_list) / len (defocus1_list), 1 )
     mean_defocus2 = round ( sum (defocus2_list) / len (defocus2_list), 1 )
     mean_defocus_angle = round ( sum (defocus_angle_list) / len (defocus_angle_list), 1 )
@@ -715,46 +792,85 @@ def Gautomatch ( miccrographs_list, pixel_size, diameter, cccutoff, contrast, te
     #os.makedirs(output_dir)
     #os.chdir (output_dir) 
     number_of_gpus = quick2d_parameters['ngpu']
-    split_by_gpu = np.array_split(micrographs_list,number_of_gpus)
-    import subprocess as subp
     import time
-    output = open("gautomatch.log", 'w')
-    ps = []
-    for i in range(number_of_gpus) :
+    names = micdb.names_for( manifest, micrographs_list )
+    todo = set ( micdb.pending( manifest, names, 'pick' ) )
+    pick_list = [ m for m, n in zip( micrographs_list, names ) if n in todo ]
+    output = open("gautomatch.log", 'a')
+
+    def gautomatch_command ( batch, gpu, number ) :
         args = 'Gautomatch --apixM ' +  str(pixel_size)+ ' --diameter ' + str(diameter)  + ' --speed 1 ' + ' --lsigma_cutoff 1.2 ' + lavgmin + ' ' +  lavgmax + ' ' \
-               + ' --cc_cutoff ' + str(cccutoff) + ' '  + ' '.join(split_by_gpu[i]) + ' --gid ' + str (i) + ' ' + contrast + ' ' + template
-        #print (args )
-        proc = subp.Popen( args,  shell = True,  stdout = output)
-        ps.append(proc)
+               + ' --cc_cutoff ' + str(cccutoff) + ' '  + ' '.join(batch) + ' --gid ' + str (gpu) + ' ' + contrast + ' ' + template
+        return args
 
-    #Keep the user informed       
-    a = len(glob.glob("*_automatch.star" ))
-    b = len (micrographs_list )
-    c = 0
-    print ('\nPicking particles using Gautomatch\n')
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob("*_automatch.star" ))
-
-    for p in ps:
-        p.wait()
-   
-    particles = 0 
-    for file in (glob.glob("*_automatch.box" )) :
-        particles = particles +  sum(1 for line in open(file))
+    if pick_list :
+        ps = gpudispatch.dispatch( pick_list, quick2d_parameters['gpu_ids'][:number_of_gpus], gautomatch_command, output )
+
+        #Keep the user informed       
+        print ('\nPicking particles using Gautomatch\n')
+        expected = [ os.path.splitext( os.path.basename(m) )[0] + '_automatch.star' for m in pick_list ]
+        jobwatch.wait_for_outputs( "*_automatch.star", len (pick_list ), ps, expected=expected )
+    output.close()
+
+    for mic, name in zip( micrographs_list, names ) :
+        if name not in todo :
+            continue
+        box = os.path.splitext( os.path.basename(mic) )[0] + '_automatch.box'
+        star = os.path.splitext( os.path.basename(mic) )[0] + '_automatch.star'
+        if not os.path.exists(star) :
+            micdb.mark( manifest, [ name ], 'pick', 'failed' )
+            continue
+        picked = 0
+        if os.path.exists(box) :
+            picked = sum(1 for line in open(box))
+        micdb.update( manifest, name, pick_star=os.path.abspath(star), pick_box=os.path.abspath(box), nparticles=picked )
+        micdb.mark( manifest, [ name ], 'pick' )
+
+    particles = sum ( micdb.column( manifest, 'nparticles', names ).values() )
     print (sg + '\nTotal number of picked particles:', particles  )
     print (eb )
 
+def native_particles_extract (  box_size, contrast, starfile, diameter, pixel_size, scale ) :
+    output_dir = quick2d_parameters['workdir'] + 'Particles/'
+    if scale != "" :
+        bgradius =  36
+        size = int ( scale.split()[-1] )
+    else :
+        bgradius = int ( round ( (float (box_size) * 0.75) / 2  ) ) 
+        size = 0
+    blocks = relionstar.read_star( starfile )
+    mics = [ str ( m ) for m in blocks[relionstar.default_block( blocks )]['rlnMicrographName'] ]
+    names = micdb.names_for( manifest, mics )
+    todo = set ( micdb.pending( manifest, names, 'extract' ) )
+    if len ( todo ) == 0 and os.path.exists( output_dir + 'particles.star' ) :
+        print (sg + '\nParticles are already extracted')
+        print (eb)
+        return
+    coordinates = nativeextract.picked_coordinates( [ m for m, n in zip( mics, names ) if n in todo ], './', '_automatch.star' )
+    print ('\nExtracting particles ( native )\n')
+    stacks = nativeextract.extract( starfile, coordinates, output_dir, int ( box_size ), pixel_size, size, bgradius, -1, -1, \
+                 contrast.strip() != '', number_of_cpu(), '../Particles/' )
+    micdb.update_many( manifest, 'particles', dict ( ( n, stacks[m] ) for m, n in zip( mics, names ) if m in stacks ) )
+    done = [ n for m, n in zip( mics, names ) if n in todo and os.path.exists( output_dir + nativeextract.stack_stem( m ) + nativeextract.EXTRACT_SUFFIX ) ]
+    micdb.mark( manifest, done, 'extract' )
+    micdb.mark( manifest, [ n for n in todo if n not in done ], 'extract', 'failed' )
+    print (sg + '\nParticle Extraction done')
+    print (eb)
+
 def relion_particles_extract (  box_size, contrast, starfile, diameter, pixel_size, scale ) :
     output_dir = quick2d_parameters['workdir'] + 'Particles/'
     if scale != "" :
         bgradius =  36
     else :
         bgradius = int ( round ( (float (box_size) * 0.75) / 2  ) ) 
-    os.makedirs(output_dir)
-    args = 'mpirun -np 16 relion_preprocess_mpi --i  ' + starfile +' --coord_dir ./ --coord_suffix _automatch.star --part_star ' + output_dir + 'particles.star --part_dir ../Particles/ --extract --extract_size ' \
+    names = micdb.names_for( manifest, micrographs_list )
+    if len ( micdb.pending( manifest, names, 'extract' ) ) == 0 and os.path.exists( output_dir + 'particles.star' ) :
+        print (sg + '\nParticles are already extracted')
+        print (eb)
+        return
+    if os.path.isdir (output_dir) != True :
+        os.makedirs(output_dir)
+    args = 'mpirun -np ' + str ( number_of_cpu() ) + ' relion_preprocess_mpi --i  ' + starfile +' --coord_dir ./ --coord_suffix _automatch.star --part_star ' + output_dir + 'particles.star --part_dir ../Particles/ --extract --extract_size ' \
             + str(box_size) +  ' --norm --bg_radius ' +  str(bgradius) + ' --white_dust -1 --black_dust -1 ' + contrast + ' ' +  scale
     #print (args)
     print ('\nExtracting particles using Relion\n')
@@ -763,24 +879,29 @@ def relion_particles_extract (  box_size, contrast, starfile, diameter, pixel_si
     proc = subp.Popen( args,  shell = True,  stdout = output)
 
     #Keep the user informed       
-    a = len(glob.glob("../Particles/*_extract.star" ))
-    b = len (micrographs_list )
-    c = 0
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob("../Particles/*_extract.star" ))
+    jobwatch.wait_for_outputs( "../Particles/*_extract.star", len (micrographs_list ), [ proc ] )
+    output.close()
+    extracted = {}
+    for mic, name in zip( micrographs_list, names ) :
+        stack = output_dir + os.path.splitext( os.path.basename(mic) )[0] + '.mrcs'
+        if os.path.exists( stack ) :
+            extracted[name] = stack
+    micdb.update_many( manifest, 'particles', extracted )
+    micdb.mark( manifest, [ n for n in names if n in extracted ], 'extract' )
+    micdb.mark( manifest, [ n for n in names if n not in extracted ], 'extract', 'failed' )
     print (sg + '\nParticle Extraction done')
     print (eb)
-    proc.wait()
 
 def relion_2dclass ( diameter, nclasses, ignorectf, Tval, run_number, particles  ) :
     output_dir = quick2d_parameters['workdir'] + 'Class2D/'
     if os.path.isdir (output_dir) != True :
         os.makedirs(output_dir)
     os.chdir(output_dir)
-    args = 'mpirun -np 9 relion_refine_mpi --o ./run' + str(run_number) + ' --i ' + particles + ' --dont_combine_weights_via_disc --pool 100 --ctf  --pad 1  --iter 25 --tau2_fudge ' + str(Tval) + ' --K ' + str(nclasses)  \
+    if os.path.exists( 'run' + str(run_number) + '_it025_model.star' ) :
+        print (sg + '\n2D Classification is already done')
+        print (eb)
+        return
+    args = gpulease.visible( quick2d_parameters['gpu_ids'] ) + 'mpirun -np 9 relion_refine_mpi --o ./run' + str(run_number) + ' --i ' + particles + ' --dont_combine_weights_via_disc --pool 100 --ctf  --pad 1  --iter 25 --tau2_fudge ' + str(Tval) + ' --K ' + str(nclasses)  \
            + ' --particle_diameter ' + str (diameter) + ' --flatten_solvent  --zero_mask  --oversampling 1 --psi_step 10 --offset_range 5 --offset_step 2  --dont_check_norm --scale  --j 2 --gpu ' + ignorectf
     #print (args)
     output = open("relion2d.log", 'w')
@@ -789,16 +910,8 @@ def relion_2dclass ( diameter, nclasses, ignorectf, Tval, run_number, particles
 
     #Keep the user informed       
     name = 'run' + str(run_number) + '*model.star'
-    a = len(glob.glob( name ))
     b = 26
-    c = 0
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b-1, 'Iterations are done' )
-            c = a
-        a = len(glob.glob(name ))
-
-    proc.wait()
+    jobwatch.wait_for_outputs( name, b, [ proc ], label='Iterations are done', shown_total=b-1 )
 
 def resize_3dmodel ( inpix, outpix, outbox, inmrc ) :
     ratio = float (inpix) / float (outpix)
@@ -825,43 +938,59 @@ def make_clean ( datadir, workdir ) :
     
 
         
-pattern = '*'+quick2d_parameters['micrograph_name_pattern'] +'*'+ quick2d_parameters['micrograph_name_suffix']
-micrographs_total, micrographs_list = count_micrographs(pattern, quick2d_parameters['datadir'], quick2d_parameters['micrograph_name_exclude'], 1  )
+## the given suffix, then mrc
+suffixes = [ quick2d_parameters['micrograph_name_suffix'] ] + [ s for s in ( 'mrc', ) if s != quick2d_parameters['micrograph_name_suffix'] ]
+patterns = [ '*'+quick2d_parameters['micrograph_name_pattern'] +'*'+ suffix for suffix in suffixes ]
+micrographs_total, micrographs_list, pattern = count_micrographs(patterns, quick2d_parameters['datadir'], quick2d_parameters['micrograph_name_exclude'], 1  )
 if micrographs_total == 0 :
-    quick2d_parameters['micrograph_name_suffix'] = 'mrc'
-    pattern = '*'+quick2d_parameters['micrograph_name_pattern'] +'*'+ quick2d_parameters['micrograph_name_suffix']
-    micrographs_total, micrographs_list = count_micrographs(pattern, quick2d_parameters['datadir'], quick2d_parameters['micrograph_name_exclude'], 1  )
-    if micrographs_total == 0 :
-        print ('I cant find the micrographs in the directory')
-        print ('I will quit')
-        quit ()
+    print ('I cant find the micrographs in the directory')
+    print ('I will quit')
+    quit ()
+quick2d_parameters['micrograph_name_suffix'] = suffixes[ patterns.index( pattern ) ]
 
     
-quick2d_parameters['z'] = get_movie_frame_number ( micrographs_list )
+micrographs_list, movie_headers = check_movie_headers ( micrographs_list )
+micrographs_total = len ( micrographs_list )
+quick2d_parameters['z'] = get_movie_frame_number ( movie_headers )
 quick2d_parameters['ngpu'] = number_of_gpu ( micrographs_list  )
 
+manifest = micdb.open_manifest( quick2d_parameters['workdir'] )
+micrograph_names = micdb.register( manifest, micrographs_list )
+if quick2d_parameters['resume'] != '' :
+    print ('\nResuming ' + quick2d_parameters['timestamp'] )
+    for stage, status, count in micdb.summary( manifest ) :
+        print ( ' ', stage, status, count )
+
 if quick2d_parameters['z'] == 1 :
     print ('\nYou have given micrographs rather than movies.. I wil start with CTF estimation')
     #make_dir_soft_links(quick2d_parameters['workdir'],quick2d_parameters['datadir'] , pattern, quick2d_parameters['micrograph_name_exclude']    )
     make_dir_soft_links(quick2d_parameters['workdir'], micrographs_list )
-    micrographs_total = len(glob.glob(os.path.join(quick2d_parameters['workdir'],'micrographs','*' )))
-    micrographs_list = glob.glob(os.path.join(quick2d_parameters['workdir'],'micrographs','*' ))
+    micrographs_list = [ os.path.join(quick2d_parameters['workdir'],'micrographs', os.path.basename(m) ) for m in micrographs_list ]
+    micrographs_total = len(micrographs_list)
+    micdb.update_many( manifest, 'aligned', dict ( zip ( micrograph_names, micrographs_list ) ) )
 else :
-    make_dir_soft_links1 ( quick2d_parameters['workdir'], micrographs_list )
-    MotionCor2_align (quick2d_parameters['ngpu'] )
-    aligned_micrographs_dir = quick2d_parameters['workdir'] + '/aligned/' 
-    aligned_micrographs_suf = 'mrc'
-    pattern = '*'+quick2d_parameters['micrograph_name_pattern'] +'*'+ aligned_micrographs_suf
-    micrographs_total, micrographs_list = count_micrographs( pattern , aligned_micrographs_dir, 'DW', 0 )
+    if quick2d_parameters['align'] == 'native' :
+        native_align ()
+    else :
+        MotionCor2_align (quick2d_parameters['ngpu'] )
+    aligned = micdb.column( manifest, 'aligned', micrograph_names )
+    micrographs_list = [ aligned[n] for n in micrograph_names if n in aligned ]
+    micrographs_total = len(micrographs_list)
     if quick2d_parameters['bin'] != 1 :
         quick2d_parameters['pixel_size'] = float ( quick2d_parameters['pixel_size'] ) * float ( quick2d_parameters['bin'] )
 
 GCTF( quick2d_parameters['pixel_size'], quick2d_parameters['cs'], quick2d_parameters['kv'], micrographs_list, quick2d_parameters['negative'])
 
 if quick2d_parameters['dose'] != 0 :
-    pattern = '*'+quick2d_parameters['micrograph_name_pattern'] +'*DW*'+ aligned_micrographs_suf
-    print (pattern)
-    micrographs_total, micrographs_list = count_micrographs( pattern , aligned_micrographs_dir, quick2d_parameters['micrograph_name_exclude'], 0 )
+    dw = micdb.column( manifest, 'dw', micrograph_names )
+    micrographs_list = [ dw[n] for n in micrograph_names if n in dw ]
+    micrographs_total = len(micrographs_list)
+
+## picking and extraction only get the micrographs the triage selects
+selected = triage_micrographs ()
+if selected is not None :
+    micrographs_list = [ m for m, n in zip( micrographs_list, micdb.names_for( manifest, micrographs_list ) ) if n in selected ]
+    micrographs_total = len(micrographs_list)
 
 #if quick2d_parameters['template'] != '' :
 #    template = ' --T ' + quick2d_parameters['datadir'] + '/' + quick2d_parameters['template']
@@ -875,23 +1004,29 @@ elif quick2d_parameters['template'] == '' :
 
 Gautomatch ( micrographs_list, quick2d_parameters['pixel_size'] , quick2d_parameters['diameter'], quick2d_parameters['cccutoff'], quick2d_parameters['pickcontrast'], template, quick2d_parameters['lavgmin'], quick2d_parameters['lavgmax'] )
 
+ctf_star = triage.SELECTED if selected is not None else 'micrographs_ctf.star'
 if quick2d_parameters['dose'] != 0 :
-    input_star  = open ("micrographs_ctf.star", 'r' )
-    output_star = open ("micrographs_ctf_DW.star",  'w' )
-    for line in input_star:
-        output_star.write(line.replace('.mrc', '_DW.mrc')) 
+    ## same ctf, the DW sum of each micrograph from the manifest
+    blocks = relionstar.read_star( ctf_star )
+    block = relionstar.default_block( blocks )
+    mics = blocks[block]['rlnMicrographName']
+    dw = micdb.column( manifest, 'dw' )
+    dw_mics = [ os.path.basename( dw[n] ) if n in dw else m for n, m in zip( micdb.names_for( manifest, mics ), mics ) ]
+    blocks[block] = relionstar.with_column( blocks[block], 'rlnMicrographName', dw_mics )
+    relionstar.write_star( 'micrographs_ctf_DW.star', blocks )
     starfile = 'micrographs_ctf_DW.star'
-    output_star.close()
-    input_star.close()
 else :
-    starfile = 'micrographs_ctf.star'
+    starfile = ctf_star
 
 if quick2d_parameters['box'] == 0 :
     quick2d_parameters['box'] =  round_up_to_even ( ( float ( quick2d_parameters['diameter'])   * 1.8 ) / float ( quick2d_parameters['pixel_size'] ) )
 
 if quick2d_parameters['mask'] == 0 :
     quick2d_parameters['mask'] = float ( quick2d_parameters['diameter'] ) * 1.1
-relion_particles_extract ( quick2d_parameters['box'], quick2d_parameters['contrast'], starfile, quick2d_parameters['diameter'], quick2d_parameters['pixel_size'], quick2d_parameters['partbin'] )
+if quick2d_parameters['extract'] == 'native' :
+    native_particles_extract ( quick2d_parameters['box'], quick2d_parameters['contrast'], starfile, quick2d_parameters['diameter'], quick2d_parameters['pixel_size'], quick2d_parameters['partbin'] )
+else :
+    relion_particles_extract ( quick2d_parameters['box'], quick2d_parameters['contrast'], starfile, quick2d_parameters['diameter'], quick2d_parameters['pixel_size'], quick2d_parameters['partbin'] )
 
 run_number = 1
 particles = '../Particles/particles.star'
@@ -12,6 +12,7 @@ import numpy as np
 import numpy.random as rnd
 from matplotlib import cm as CM
 import subprocess as subp
+import jobwatch, gpudispatch, micdb, relionstar, mrcheader, nativemotion, nativeextract, ctflog, discover, staging, gpulease, prescreen, ctfcache, triage
 
 ## Create a general dictionary of script parameters. Easy to expand later
 author = 'test@test.com'
@@ -44,6 +45,8 @@ quick3d_parameters['timestamp'] =  'processing_' + quick3d_parameters['time']
 quick3d_parameters['workdir'] = os.getcwd() + '/' + quick3d_parameters['timestamp'] + '/'
 quick3d_parameters['power_users'] = 0
 quick3d_parameters['write_movies'] = 'NO'
+quick3d_parameters['align'] = 'motioncor2'
+quick3d_parameters['extract'] = 'native'
 quick3d_parameters['ngpu'] = 0
 quick3d_parameters['bin'] = 0
 quick3d_parameters['ncpu'] = 0
@@ -77,6 +80,9 @@ quick3d_parameters['auto_2d_iter'] = 2
 quick3d_parameters['relion_2d_iter'] = 25
 quick3d_parameters['relion_3d_iter'] = 25
 quick3d_parameters['number_of_3dclasses'] = 3
+quick3d_parameters['resume'] = ''
+quick3d_parameters['prescreen'] = 1
+quick3d_parameters['triage'] = triage.OUTLIER_Z
 
 mail_author = 'echo " " | mail -s QUICK3D ' + author
 os.system( mail_author )
@@ -146,6 +152,8 @@ select = optparse.OptionGroup(parser, 'Micrograph Selection')
 select.add_option("--mic",             dest="pattern",           help="Common unique pattern in the micrograph name ( to identify/select)  eg  --m=_frames default all mrc files in the directory")
 select.add_option("--exc",             dest="exclude_pattern",   help="Micrograph name that you want to exclude    eg  --exc=_DW No default ")
 select.add_option("--suf",             dest="suffix",            help="Micrograph suffix  eg --suf=mrc  default mrcs or mrc ")
+select.add_option("--noscreen",        dest="noscreen",          action="store_true", default=False,  help="Do not pre-screen the movies, by default empty, truncated and saturated ones are skipped")
+select.add_option("--notriage",        dest="notriage",          action="store_true", default=False,  help="Pick and extract every micrograph, by default those with a ctf fit far off the others are left out")
 select.add_option("--list",            dest="list",              help="Micrograph list file  eg --list=file1.list ")
 parser.add_option_group(select)
 
@@ -156,6 +164,7 @@ movie.add_option("--bin",              dest="bin",               help="Binning f
 movie.add_option("--stack",            dest="stack",             action="store_true", default=False,  help="Write alinged movie stacks eg --stack Default false")
 movie.add_option("--preexp",           dest="preexposure",       help=" Pre Exposure per frame e/A^2 No default")
 movie.add_option("--rotgain",          dest="rotgain",           help=" Gain rotation No default")
+movie.add_option("--align",            dest="align",             help="Movie alignment program motioncor2 or native ( CPU only ) eg --align=native default motioncor2")
 parser.add_option_group(movie)
 
 picking = optparse.OptionGroup(parser, 'Particle picking')
@@ -191,6 +200,8 @@ computing.add_option("--sparx",        dest="sparx",             action="store_t
 computing.add_option("--rel2sparx",    dest="rel2sparx",         action="store_true", default=False, help="For developers....")
 computing.add_option("--auto",         dest="auto",              action='store_true', default=False,  help="auto pilot mode")
 computing.add_option("--rcut",         dest="rescut",            help="only works with --devel")
+computing.add_option("--extract",      dest="extract",           help="Particle extraction native ( numpy, all cpus ) or relion ( relion_preprocess_mpi ) eg --extract=relion default native")
+computing.add_option("--resume",       dest="resume",            help="Continue an earlier run in its directory, only the missing steps are done eg --resume=processing_01_Jan_2018_10_00_00AM")
 parser.add_option_group(computing)
 
 (options, args) = parser.parse_args()
@@ -250,6 +261,9 @@ if options.mask :
 if options.rotgain :
     quick3d_parameters['rotgain'] = options.rotgain
 
+if options.align :
+    quick3d_parameters['align'] = options.align
+
 if options.diameter :
     quick3d_parameters['diameter'] = options.diameter
 
@@ -286,6 +300,24 @@ if options.ngpu :
 if options.rescut :
     quick3d_parameters['rescut'] = options.rescut
 
+if options.extract :
+    quick3d_parameters['extract'] = options.extract
+
+if options.resume :
+    quick3d_parameters['resume'] = options.resume
+    quick3d_parameters['timestamp'] = os.path.basename( os.path.normpath( options.resume ) )
+    quick3d_parameters['workdir'] = os.path.abspath( options.resume ) + '/'
+
+## work directories of earlier runs whose background removal was cut short
+if staging.reclaim( os.path.dirname( os.path.normpath( quick3d_parameters['workdir'] ) ) ) :
+    print ('\nRemoving the work directories left by earlier runs in the background')
+
+if str(options.notriage) == "True" :
+    quick3d_parameters['triage'] = float ( 'inf' )
+
+if str(options.noscreen) == "True" :
+    quick3d_parameters['prescreen'] = 0
+
 if str(options.stack) == "True" :
     quick3d_parameters['write_movies'] = 'YES'
 
@@ -410,7 +442,17 @@ if quick3d_parameters['dose'] != 0 :
 ## CHECK FOR THE PRESENSE OF EXECUTABLES
 def check_execs() :
 
-    exec_list = ['header', 'Gctf', 'relion_refine_mpi', 'relion_preprocess_mpi', 'MotionCor2', 'Gautomatch','e2proc2d.py','relion_display']
+    exec_list = ['Gctf', 'relion_refine_mpi', 'relion_preprocess_mpi', 'MotionCor2', 'Gautomatch','e2proc2d.py','relion_display']
+    if quick3d_parameters['align'] == 'native' :
+        exec_list.remove('MotionCor2')
+    elif quick3d_parameters['align'] != 'motioncor2' :
+        print ('\n--align can be motioncor2 or native')
+        quit ()
+    if quick3d_parameters['extract'] == 'native' :
+        exec_list.remove('relion_preprocess_mpi')
+    elif quick3d_parameters['extract'] != 'relion' :
+        print ('\n--extract can be native or relion')
+        quit ()
 
     for i in range (len(exec_list)):
         if not check_for_executables(exec_list[i]) :
@@ -452,12 +494,10 @@ sg = bcolors.OKGREEN
 eb = bcolors.ENDC
 
 
-def count_micrographs(pattern, micdir, exclude, printflag) :
-    micrographs_list = glob.glob(os.path.join(micdir,pattern ))
- 
-    for name in glob.glob(os.path.join(micdir,pattern )) :
-        if exclude in name :
-            micrographs_list.remove(name)
+def count_micrographs(patterns, micdir, exclude, printflag) :
+    ## sorted, so a resumed run takes the same micrographs. The first of the patterns with
+    ## files is used, the directory is listed once for all of them
+    pattern, micrographs_list = discover.micrographs( micdir, patterns, exclude )
     micrographs_total = len( micrographs_list )
 
     if micrographs_total != 0 :
@@ -466,17 +506,23 @@ def count_micrographs(pattern, micdir, exclude, printflag) :
         #quit ()
     #elif printflag == 1 :
         print ('\nYou have',micrographs_total, 'micrographs')
-    return micrographs_total,micrographs_list
+    return micrographs_total,micrographs_list,pattern
 
 def count_micrographs_list(listfile) :
-    micrographs_list = open(listfile).read().splitlines()
+    micrographs_list = [ line.strip() for line in open(listfile).read().splitlines() if line.strip() ]
+    found = discover.existing( micrographs_list )
+    if len ( found ) < len ( micrographs_list ) :
+        print ('\n' + str ( len ( micrographs_list ) - len ( found ) ), 'micrographs of', listfile, 'are not there, I will skip them' )
+    micrographs_list = found
     micrographs_total = len( micrographs_list )
     print ('\nYou have',micrographs_total, 'micrographs')
     return micrographs_total,micrographs_list
 
 
 def number_of_gpu( micrographs_list ) :
-    gpus = len(glob.glob('/proc/driver/nvidia/gpus/*'))
+    ## the GPUs are leased from the other runs on this host ( see gpulease ), the dispatchers
+    ## only use the ids of the lease
+    gpus = len ( gpulease.devices() )
     if gpus == 0 :
         print ('I cant find any usable GPU')
         print ('I will quit')
@@ -486,17 +532,21 @@ def number_of_gpu( micrographs_list ) :
         quick3d_parameters['ngpu']  = len (micrographs_list)
 
     quick3d_parameters['ngpu']  = int( quick3d_parameters['ngpu'] )
-    if quick3d_parameters['ngpu'] == 0 :
-        print (' Available GPUS: ',gpus )
-    else :
-        if ( gpus != 0 ) :
-            print (' Available GPUS: ',gpus )
-            print (' Using ', quick3d_parameters['ngpu'], 'GPUS' )
-            gpus = quick3d_parameters['ngpu']
-    return gpus
+    lease = gpulease.acquire( quick3d_parameters['ngpu'], int( quick3d_parameters['ncpu'] ), 'quick3d' )
+    quick3d_parameters['lease'] = lease
+    quick3d_parameters['gpu_ids'] = lease.gpus
+    print (' Available GPUS: ',gpus )
+    if len ( lease.gpus ) != gpus :
+        print (' Using GPUS', ' '.join( str ( g ) for g in lease.gpus ), '( the others are in use or not asked for )' )
+    return len ( lease.gpus )
 
 def number_of_cpu() :
     cpus = multiprocessing.cpu_count()
+    if 'lease' in quick3d_parameters :
+        cores = quick3d_parameters['lease'].cores
+        if cores != cpus :
+            print (' Using ', cores, 'of', cpus, 'CPUS' )
+        return cores
     quick3d_parameters['ncpu']  = int (quick3d_parameters['ncpu'] )
     if quick3d_parameters['ncpu'] == 0 :
         print (' Available CPUS: ',cpus )
@@ -506,19 +556,25 @@ def number_of_cpu() :
             print (' Using ', quick3d_parameters['ncpu'], 'CPUS' )
     return cpus
 
-def get_pixel_size ( micrographs_list ) :
-    args = 'header -pixel -i ' + micrographs_list[0]
-    proc = subp.Popen( args,  shell = True,  stdout=subp.PIPE )
-    proc.wait
-    p  =  float ( proc.communicate()[0].decode("utf-8").split()[2] )
-    return p
+def get_pixel_size ( headers ) :
+    return headers[0].pixel_size
+
+def check_movie_headers ( micrographs_list ) :
+    ## every header is read before any GPU job, truncated files and odd shapes are left out
+    headers = mrcheader.check_movies( micrographs_list )
+    if len ( headers ) != 0 and quick3d_parameters['prescreen'] == 1 :
+        ## and then the empty and saturated ones ( see prescreen )
+        report = os.path.join( quick3d_parameters['datadir'], quick3d_parameters['timestamp'] + '_prescreen.txt' )
+        kept = set ( prescreen.check_micrographs( [ h.filename for h in headers ], report, '', int( quick3d_parameters['ncpu'] ) )[0] )
+        headers = [ h for h in headers if h.filename in kept ]
+    if len ( headers ) == 0 :
+        print ('None of the movies can be read')
+        print ('I will quit')
+        quit ()
+    return [ h.filename for h in headers ], headers
 
-def get_movie_frame_number ( micrographs_list ) :
-    args = 'header -size -i ' + micrographs_list[0] 
-    proc = subp.Popen( args,  shell = True,  stdout=subp.PIPE ) 
-    proc.wait
-    z  =  int ( proc.communicate()[0].decode("utf-8").split()[2] )
-    return z
+def get_movie_frame_number ( headers ) :
+    return headers[0].nz
 
 def make_qsub ( name, wdir, command ) :
     output_dir = quick3d_parameters['workdir'] + 'logs'
@@ -576,10 +632,7 @@ def make_dir_soft_links ( workdir, micrographs_list) :
       #      file_with_dir = micdir + '/' + file
        #     file_with_mic_dir = mic_dir + '/' + file
         #    os.symlink ( file_with_dir, file_with_mic_dir )
-    for file in micrographs_list :
-        micname =  file.split('/')[-1]
-        file_with_mic_dir = mic_dir + '/' + micname
-        os.symlink ( file, file_with_mic_dir )
+    staging.link_many( micrographs_list, mic_dir )
     command = workdir + 'input'
     output = open(command, 'w')
     output.writelines ( quick3d_parameters['input_commands'] + '\n' )
@@ -588,23 +641,6 @@ def make_dir_soft_links ( workdir, micrographs_list) :
 
     os.chdir ( mic_dir )
 
-def make_dir_soft_links1 ( workdir, micrographs_list ) :
-    dest_dir  = workdir + '/'
-    movie_dir  = workdir + '/movies'
-    os.makedirs(workdir)
-    os.makedirs(movie_dir)
-    number_of_gpus = quick3d_parameters['ngpu']
-    split_by_gpu = np.array_split(micrographs_list,number_of_gpus)
-    i = 0
-    while ( i < number_of_gpus ) :
-        gpu_dir = movie_dir + '/gpu' + str(i)
-        os.makedirs(gpu_dir)
-        for file in split_by_gpu[i] :
-            micname =  file.split('/')[-1]
-            file_with_gpu_dir = gpu_dir + '/' + micname
-            os.symlink ( file, file_with_gpu_dir )
-        i += 1
-
 def micrographs_list_nodir_name (micrographs_list ) :
     micrographs_list_simple = []
     for file in micrographs_list :
@@ -613,15 +649,19 @@ def micrographs_list_nodir_name (micrographs_list ) :
     return micrographs_list_simple
  
 def write_unblur_input ( micname, frames, pixel_size , dose_filter, exposure, kv, preexposure, movies ) :
-    name = ''.join ( micname.split('.')[:-1] )
+    name = os.path.splitext( micname )[0]
     suf = micname.split('.')[-1]
-    real = '../../' + micname
-    dest = name + '_in.mrc' 
-    os.symlink ( real, dest )
+    ## unblur reads an .mrc movie where it is, only the other formats get an _in.mrc link
+    if suf == 'mrc' :
+        movie = '../../' + micname
+    else :
+        movie = name + '_in.mrc'
+        if not os.path.lexists ( movie ) :
+            os.symlink ( '../../' + micname, movie )
     unblur_input = []
     unblur_input.append ( '#!/usr/bin/csh -f' )
     unblur_input.append ('unblur  > ' +  name + '.unblur.log << EOF' )
-    unblur_input.append ( name + '_in.mrc' )
+    unblur_input.append ( movie )
     unblur_input.append ( frames )
     unblur_input.append ( '../unblur_sum/' + name + '.mrc' )
     unblur_input.append ( name + '_shifts.txt' )
@@ -687,27 +727,40 @@ def unblur_align ( micrographs_list) :
         ps.append(proc)
 
     #Keep the user informed
-    #shifts.txt = len(glob.glob("*_shifts.txt" ))
-    b = len (micrographs_list )
-    c = 0
-    a = 0 
     print ('\n Aligning using Unblur \n')
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'dat file are converted to mrc(s)' )
-            c = a
-        a = len(glob.glob("*_shifts.txt" ))
-
-    for p in ps:
-        p.wait()
+    jobwatch.wait_for_outputs( "*_shifts.txt", len (micrographs_list ), ps, label='dat file are converted to mrc(s)' )
+
+def record_aligned ( output_dir, todo ) :
+    ## MotionCor2 outputs into the manifest, a movie is done once its sums are there
+    aligned = {}
+    dw = {}
+    for n in todo :
+        if os.path.exists( output_dir + n + '.mrc' ) :
+            aligned[n] = output_dir + n + '.mrc'
+        if os.path.exists( output_dir + n + '_DW.mrc' ) :
+            dw[n] = output_dir + n + '_DW.mrc'
+    micdb.update_many( manifest, 'aligned', aligned )
+    micdb.update_many( manifest, 'dw', dw )
+    if quick3d_parameters['dose'] == 0 :
+        done = [ n for n in todo if n in aligned ]
+    else :
+        done = [ n for n in todo if n in aligned and n in dw ]
+    micdb.mark( manifest, done, 'align' )
+    micdb.mark( manifest, [ n for n in todo if n not in done ], 'align', 'failed' )
 
 def MotionCor2_align_script ( number_of_gpus, suffix, gain, gainrot, micrographs_list ) :
     output_dir = quick3d_parameters['workdir'] + '/aligned/'
-    os.makedirs(output_dir)
+    if os.path.isdir (output_dir) != True :
+        os.makedirs(output_dir)
     os.chdir (output_dir) 
-    output = open("MotionCor2.log", 'w')
-    jobs = number_of_gpus * int(quick3d_parameters['gfact'])
-    split_by_jobs = np.array_split(micrographs_list, jobs)
+    names = micdb.names_for( manifest, micrographs_list )
+    todo = set ( micdb.pending( manifest, names, 'align' ) )
+    if len (todo) == 0 :
+        print (sg + '\nAll movies are already aligned')
+        print (eb)
+        return
+    micrographs_list = [ m for m, n in zip( micrographs_list, names ) if n in todo ]
+    output = open("MotionCor2.log", 'a')
     if quick3d_parameters['gain'] != "" :
         k2gain = ' -Gain ' + gain + ' '
     else :
@@ -735,52 +788,29 @@ def MotionCor2_align_script ( number_of_gpus, suffix, gain, gainrot, micrographs
         proc.wait
         k2gain = ' -Gain ../' + g + '.mrc '
 
-    for i in range(jobs) :
-        gpuid = int ( i / quick3d_parameters['gfact'] )
-        out = 'motioncor2_gpu' + str(i) + '.sh'
-        com = open (out, "w")
-        com.write("#!/bin/bash \n"  )
-        for j in (split_by_jobs[i]) :
-            k =  os.path.basename(j).split('.')[0]
-            args = 'MotionCor2 ' + input_stem  + j  + ' -OutMrc ' + output_dir + k + '.mrc' + ' -patch 5 5  -Tol 0.5 -Iter 10  -Gpu ' + str (gpuid)  \
+    def motioncor2_command ( batch, gpu, number ) :
+        args = []
+        for j in batch :
+            k = micdb.stem( j )
+            args.append ( 'MotionCor2 ' + input_stem  + j  + ' -OutMrc ' + output_dir + k + '.mrc' + ' -patch 5 5  -Tol 0.5 -Iter 10  -Gpu ' + str (gpu)  \
                  + binning  + k2gain + rotgain + ' -InitDose ' + str (quick3d_parameters['preexposure'])  + ' -FmDose ' + str(quick3d_parameters['dose']) \
-                 + ' -PixSize '+ str (quick3d_parameters['pixel_size']) + ' -kV ' + str (quick3d_parameters['kv']) + ' -Throw 1 '
-            com.write(str(args))
-            com.write("\n")
-        st = os.stat(out)
-        os.chmod(out, st.st_mode | stat.S_IEXEC)
-        com.close()
-    ps = []
-    for i in range(jobs) :
-        args = 'motioncor2_gpu'+ str (i) + '.sh'
-        proc = subp.Popen( args,  shell = True,  stdout = output)
-        time.sleep(0.1)
-        ps.append(proc)
+                 + ' -PixSize '+ str (quick3d_parameters['pixel_size']) + ' -kV ' + str (quick3d_parameters['kv']) + ' -Throw 1 ' )
+        return ' ; '.join(args)
+
+    ps = gpudispatch.dispatch( micrographs_list, quick3d_parameters['gpu_ids'][:number_of_gpus], motioncor2_command, output, quick3d_parameters['gfact'] )
 
 
     #Keep the user informed       
     if quick3d_parameters['dose'] == 0 :
         #list = output_dir + '/*' + quick3d_parameters['micrograph_name_suffix']
         list = output_dir + '/*.mrc'
+        expected = [ n + '.mrc' for n in todo ]
     else :
         #list = output_dir + '/*_DW.' + quick3d_parameters['micrograph_name_suffix']
         list = output_dir + '/*_DW.mrc'
-    a = len(glob.glob(list))
-    b = len (micrographs_list )
-    c = 0
+        expected = [ n + '_DW.mrc' for n in todo ]
     print ('\nAligning the frames using MotionCor2\n')
-    while ( a < b ) :
-        if ( a > c ) :
-            #pbar = ProgressBar(maxval=b).start()
-            #time.sleep(0.01)
-            #pbar.update(a+1)
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob(list ))
-    #pbar.finish()
-
-    for p in ps:
-        p.wait()
+    jobwatch.wait_for_outputs( list, len (micrographs_list ), ps, expected=expected )
 
     if quick3d_parameters ['micrograph_name_suffix'] == 'mrcs' :
         mrcs_dir_name = output_dir + '/*mrcs'
@@ -789,15 +819,57 @@ def MotionCor2_align_script ( number_of_gpus, suffix, gain, gainrot, micrographs
             name = mrcs.replace('mrcs','')
             mrc = name + 'mrc'
             os.rename ( mrcs, mrc)
+    record_aligned( output_dir, todo )
     print (sg + '\nMovie alignment done')
     print (eb)
 
 
 
+def native_align_script ( gain, gainrot, micrographs_list ) :
+    output_dir = quick3d_parameters['workdir'] + '/aligned/'
+    if os.path.isdir (output_dir) != True :
+        os.makedirs(output_dir)
+    os.chdir (output_dir) 
+    names = micdb.names_for( manifest, micrographs_list )
+    todo = set ( micdb.pending( manifest, names, 'align' ) )
+    if len (todo) == 0 :
+        print (sg + '\nAll movies are already aligned')
+        print (eb)
+        return
+    micrographs_list = [ m for m, n in zip( micrographs_list, names ) if n in todo ]
+    if gain.split('.')[-1] == 'dm4' :
+        g =  os.path.basename(gain)
+        args = 'dm2mrc ' + gain + ' ../' +  g + '.mrc'
+        proc = subp.Popen( args,  shell = True )
+        proc.wait()
+        gain = '../' + g + '.mrc'
+    if quick3d_parameters['bin'] != 0 :
+        binning = quick3d_parameters['bin']
+    else :
+        binning = 1
+    print ('\nAligning the frames on the CPU ( native )\n')
+    try :
+        nativemotion.align_many( micrographs_list, output_dir, quick3d_parameters['pixel_size'], gain, gainrot, \
+                 quick3d_parameters['dose'], quick3d_parameters['preexposure'], quick3d_parameters['kv'], binning, number_of_cpu() )
+    except ( IOError, ValueError ) as e :
+        print (e)
+        print ('I will quit')
+        quit ()
+    record_aligned( output_dir, todo )
+    print (sg + '\nMovie alignment done')
+    print (eb)
+
 def MotionCor2_align ( number_of_gpus ) :
     output_dir = quick3d_parameters['workdir'] + '/aligned/'
-    os.makedirs(output_dir)
+    if os.path.isdir (output_dir) != True :
+        os.makedirs(output_dir)
     os.chdir (output_dir) 
+    todo = set ( micdb.pending( manifest, micrograph_names, 'align' ) )
+    if len (todo) == 0 :
+        print (sg + '\nAll movies are already aligned')
+        print (eb)
+        return
+    movies = [ m for m, n in zip( micrographs_list, micrograph_names ) if n in todo ]
     if quick3d_parameters['gain'] != "":
         gain = ' -Gain ' + quick3d_parameters['gain'] + ' '
     else :
@@ -809,42 +881,30 @@ def MotionCor2_align ( number_of_gpus ) :
         input_stem = ' -InMrc '
 
     output = open("MotionCor2.log", 'w')
-    ps = []
-    for i in range(number_of_gpus) :
-        input_dir  = quick3d_parameters['workdir'] + '/movies/gpu' + str (i) + '/'
-        outlog = 'gpu' + str (i) + '.log'
-        output = open(outlog, 'w')
-        args = 'MotionCor2 ' + input_stem  + input_dir  + ' -OutMrc ' + output_dir + ' -patch 5 5 20  -Tol 0.5 -Serial 1  -Gpu ' + str (i )  \
+
+    ## one MotionCor2 call per movie, chained per batch so the GPUs share one queue
+    def motioncor2_command ( batch, gpu, number ) :
+        args = []
+        for movie in batch :
+            k = micdb.stem( movie )
+            args.append ( 'MotionCor2 ' + input_stem  + movie  + ' -OutMrc ' + output_dir + k + '.mrc' + ' -patch 5 5 20  -Tol 0.5 -Gpu ' + str (gpu )  \
                  + ' -FtBin ' + str(quick3d_parameters['bin']) + gain + ' -InitDose ' + str (quick3d_parameters['preexposure'])  + ' -FmDose ' + str(quick3d_parameters['dose']) \
-                 + ' -PixSize '+ str (quick3d_parameters['pixel_size']) + ' -kV ' + str (quick3d_parameters['kv']) + ' -Throw 1 '
-        output.writelines ( str(args ) + '\n' )
-        proc = subp.Popen( args,  shell = True,  stdout = output)
-        #print (args)
-        ps.append(proc)
+                 + ' -PixSize '+ str (quick3d_parameters['pixel_size']) + ' -kV ' + str (quick3d_parameters['kv']) + ' -Throw 1 ' )
+        return ' ; '.join(args)
+
+    ps = gpudispatch.dispatch( movies, quick3d_parameters['gpu_ids'][:number_of_gpus], motioncor2_command, output )
 
     #Keep the user informed       
     if quick3d_parameters['dose'] == 0 :
         #list = output_dir + '/*' + quick3d_parameters['micrograph_name_suffix']
         list = output_dir + '/*.mrc'
+        expected = [ n + '.mrc' for n in todo ]
     else :
         #list = output_dir + '/*_DW.' + quick3d_parameters['micrograph_name_suffix']
         list = output_dir + '/*_DW.mrc' 
-    a = len(glob.glob(list))
-    b = len (micrographs_list )
-    c = 0
+        expected = [ n + '_DW.mrc' for n in todo ]
     print ('\nAligning the frames using MotionCor2\n')
-    while ( a < b ) :
-        if ( a > c ) :
-            #pbar = ProgressBar(maxval=b).start()
-            #time.sleep(0.01)
-            #pbar.update(a+1)
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob(list ))
-    #pbar.finish()
-
-    for p in ps:
-        p.wait()
+    jobwatch.wait_for_outputs( list, len (movies ), ps, expected=expected )
 
     if quick3d_parameters ['micrograph_name_suffix'] == 'mrcs' :
         mrcs_dir_name = output_dir + '/*mrcs'
@@ -853,20 +913,49 @@ def MotionCor2_align ( number_of_gpus ) :
             name = mrcs.replace('mrcs','')
             mrc = name + 'mrc'
             os.rename ( mrcs, mrc)    
+    record_aligned( output_dir, todo )
     print (sg + '\nMovie alignment done')
     print (eb)
 
+def record_gctf ( micrographs_list, names, todo ) :
+    ## Gctf results of this run into the manifest, every log is read once
+    stems = dict ( ( os.path.splitext( os.path.basename(mic) )[0], name ) for mic, name in zip( micrographs_list, names ) if name in todo )
+    logs = [ stem + '_gctf.log' for stem in stems if os.path.exists( stem + '_gctf.log' ) ]
+    results = ctflog.parse_logs( logs, 'gctf', number_of_cpu() )
+    found = [ stems[str ( m )] for m in results['micrograph'] ]
+    for field in ( 'defocus_u', 'defocus_v', 'defocus_angle', 'ccc', 'resolution' ) :
+        micdb.update_many( manifest, field, dict ( zip( found, results[field].tolist() ) ) )
+    micdb.update_many( manifest, 'ctf_log', dict ( zip( found, [ os.path.abspath( str ( l ) ) for l in results['log'] ] ) ) )
+    micdb.mark( manifest, found, 'ctf' )
+    micdb.mark( manifest, [ n for n in stems.values() if n not in found ], 'ctf', 'failed' )
+
+def write_ctf_star ( micrographs_list, names, pixel_size, kv, cs, ac ) :
+    ## micrographs_ctf.star straight from the manifest ( was relion_run_ctffind --only_make_star )
+    fields = ( 'defocus_u', 'defocus_v', 'defocus_angle', 'ccc', 'resolution' )
+    values = dict ( ( field, micdb.column( manifest, field, names ) ) for field in fields )
+    rows = [ ( mic.split('/')[-1], name ) for mic, name in zip( micrographs_list, names ) if all ( name in values[field] for field in fields ) ]
+    mics = [ mic for mic, name in rows ]
+    columns = [ [ values[field][name] for mic, name in rows ] for field in fields ]
+    ctflog.write_micrographs_star( 'micrographs_ctf.star', mics, columns[0], columns[1], columns[2], columns[3], columns[4], pixel_size, kv, cs, ac )
+
+def triage_micrographs () :
+    ## micrographs_selected.star and micrographs_rejected.star from the ctf fits ( see triage ),
+    ## returns the names of the selected micrographs, None without a micrographs_ctf.star
+    if not os.path.exists( 'micrographs_ctf.star' ) :
+        return None
+    selected, rejected = triage.triage_star( 'micrographs_ctf.star', z=quick3d_parameters['triage'] )
+    triage.report( rejected, len ( selected ) + len ( rejected ) )
+    names = micdb.names_for( manifest, selected )
+    micdb.mark( manifest, names, 'triage' )
+    micdb.mark( manifest, micdb.names_for( manifest, [ m for m, reason in rejected ] ), 'triage', 'rejected' )
+    return set ( names )
+
 def GCTF ( pixel_size, cs, kv, micrographs_list, negative ) :
     #output_dir = quick3d_parameters['workdir'] + '/ctf_Gctf/'
     #os.makedirs(output_dir)
     #os.chdir (output_dir) 
     number_of_gpus = quick3d_parameters['ngpu']
-    jobs = number_of_gpus * int(quick3d_parameters['gfact'])
-    split_by_jobs = np.array_split(micrographs_list, jobs)
 
-
-    #split_by_gpu = np.array_split(micrographs_list,number_of_gpus)
-    import subprocess as subp
     import time
     if float (pixel_size)  > 3 :
         resH = 2 * float (pixel_size)
@@ -880,49 +969,45 @@ def GCTF ( pixel_size, cs, kv, micrographs_list, negative ) :
     else :
         box = ' --boxsize 512 ' 
         ac = ' --ac 0.1  '
-    output = open("gctf.log", 'w')
-    ps = []
-    #for i in range(number_of_gpus) :
-    for i in range(jobs) :
-        gpuid = int ( i / quick3d_parameters['gfact'] )
-        star = 'gpu' + str (i) + '.star'
-        args = 'Gctf --apix '+ str(pixel_size)+ ' --kV ' + str(kv) +' --cs ' + str(cs) + ' ' + ' '.join(split_by_jobs[i]) \
-               + ' --gid ' + str(gpuid) + ' --do_validation --do_EPA --astm 100  --resL 30 ' + ' --resH ' + str(resH) + ' --B_resH ' + str(B_resH) \
+    names = micdb.names_for( manifest, micrographs_list )
+    todo = set ( micdb.pending( manifest, names, 'ctf' ) )
+    ctf_list = [ m for m, n in zip( micrographs_list, names ) if n in todo ]
+    output = open("gctf.log", 'a')
+
+    def gctf_command ( batch, gpu, number ) :
+        star = 'gpu' + str (gpu) + '_' + str (number) + '.star'
+        args = 'Gctf --apix '+ str(pixel_size)+ ' --kV ' + str(kv) +' --cs ' + str(cs) + ' ' + ' '.join(batch) \
+               + ' --gid ' + str(gpu) + ' --do_validation --do_EPA --astm 100  --resL 30 ' + ' --resH ' + str(resH) + ' --B_resH ' + str(B_resH) \
                + box + ac + ' --ctfstar ' + star
                #+ ' --ac 0.07 --do_EPA  --boxsize 512 --do_Hres_ref --Href_resL 20'  
-        #print (args)
-        output.writelines ( str(args ) + '\n' )
-        proc = subp.Popen( args,  shell = True,  stdout = output)
-        ps.append(proc)
+        return args
 
-    #Keep the user informed       
-    a = len(glob.glob("*gctf.log" ))
-    b = len (micrographs_list )
-    c = 0
-    print ('\nCalculate CTF for your micrographs using Gctf\n')
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob("*gctf.log" ))
-
-    for p in ps:
-        p.wait()
+    ## results of earlier runs with the same arguments ( see ctfcache )
+    cache_key = ctfcache.command_key ( gctf_command )
+    cached = set ( ctfcache.restore ( ctf_list, cache_key ) )
+    if cached :
+        print ('\n', len (cached), 'micrographs have a Gctf result of an earlier run ( ctf cache )')
+        ctf_list = [ m for m in ctf_list if m not in cached ]
+
+    if ctf_list :
+        ps = gpudispatch.dispatch( ctf_list, quick3d_parameters['gpu_ids'][:number_of_gpus], gctf_command, output, quick3d_parameters['gfact'] )
+
+        #Keep the user informed       
+        print ('\nCalculate CTF for your micrographs using Gctf\n')
+        expected = [ os.path.splitext( os.path.basename(m) )[0] + '_gctf.log' for m in ctf_list ]
+        jobwatch.wait_for_outputs( "*gctf.log", len (ctf_list ), ps, expected=expected )
+        ctfcache.store ( ctf_list, cache_key )
+    else :
+        print ('\nCTF of all micrographs is already known\n')
+    output.close()
+    record_gctf( micrographs_list, names, todo )
          
     star = 'micrographs.star'
-    g = open (star, "w")
-    g.writelines ( '\n' + 'data_' + '\n\n' + 'loop_' + '\n' + '_rlnMicrographName #1' + '\n' )
-    for mic in micrographs_list :
-        mic = mic.split('/')[-1] 
-        g.writelines (   mic + '\n' )
-    g.close()
+    mics = [ mic.split('/')[-1] for mic in micrographs_list ]
+    relionstar.write_loop( star, relionstar.make_table( [ ( 'rlnMicrographName', mics ) ] ) )
 	    
 
-    output = open("star.log", 'w')
-    args = 'relion_run_ctffind --i micrographs.star --only_make_star --use_gctf --o .'
-    proc = subp.Popen( args,  shell = True, stdout = output  )
-    proc.wait
-    output.close()
+    write_ctf_star( micrographs_list, names, pixel_size, kv, cs, float ( ac.split()[-1] ) )
 
     #input_star  = open ("micrographs_ctf.star", 'r' )
     #output_star = open ("micrographs_DW.star",  'w' )
@@ -930,28 +1015,11 @@ def GCTF ( pixel_size, cs, kv, micrographs_list, negative ) :
         #output_star.write(line.replace('.mrc', '_DW.mrc')) 
     #    print (line)
 
-    defocus1_list = []
-    defocus2_list = []
-    defocus_angle_list = []
-    CCC_list = []
-    resolution_list = []
-    for file in glob.glob("*_gctf.log") :
-        myfile = open (file, "r" )
-        b  =  ' '.join(grep("Final",myfile ))
-        defocus1_list.append(b.split()[0])
-        defocus2_list.append(b.split()[1])
-        defocus_angle_list.append(b.split()[2])
-        CCC_list.append(b.split()[3])
-    for file in glob.glob("*_gctf.log") :
-        myfile = open (file, "r" )
-        b  =  ' '.join(grep("RES_LIMIT",myfile ))
-        resolution_list.append(b.split()[-1])
-    defocus1_list = list(map(float, defocus1_list))
-    defocus2_list = list(map(float, defocus2_list))
-    defocus_angle_list = list(map(float, defocus_angle_list))
-    CCC_list = list(map(float, CCC_list))
-    resolution_list = list(map(float, resolution_list))
-    myfile.close()
+    defocus1_list = list ( micdb.column( manifest, 'defocus_u', names ).values() )
+    defocus2_list = list ( micdb.column( manifest, 'defocus_v', names ).values() )
+    defocus_angle_list = list ( micdb.column( manifest, 'defocus_angle', names ).values() )
+    CCC_list = list ( micdb.column( manifest, 'ccc', names ).values() )
+    resolution_list = list ( micdb.column( manifest, 'resolution', names ).values() )
     mean_defocus1 = round ( sum (defocus1_list) / len (defocus1_list), 1 )
     mean_defocus2 = round ( sum (defocus2_list) / len (defocus2_list), 1 )
     mean_defocus_angle = round ( sum (defocus_angle_list) / len (defocus_angle_list), 1 )
@@ -976,20 +1044,10 @@ def sparx_ctf ( pixel_size, cs, kv, micrographs_list, negative, cpu ) :
     else :
         proc = subp.Popen( args,  shell = True,  stdout = output)
         #Keep the user informed       
-        a = len(glob.glob("ctf/pwrot/*txt" ))
-        b = len (micrographs_list )
-        c = 0
         print ('\nCalculating CTF using sxcter\n')
-        while ( a < b ) :
-            if ( a > c ) :
-                print ( a,'/',b, 'Micrographs are done' )
-                c = a
-            a = len(glob.glob("ctf/pwrot/*txt" ))
-
+        jobwatch.wait_for_outputs( "ctf/pwrot/*txt", len (micrographs_list ), [ proc ] )
         print (sg + '\nCTF Estimation done')
         print (eb)
-
-        proc.wait
         output.close()
 
 def make_template_from3D ( model ) :
@@ -1008,48 +1066,86 @@ def Gautomatch ( micrographs_list, pixel_size, diameter, cccutoff, contrast, tem
     #os.makedirs(output_dir)
     #os.chdir (output_dir) 
     number_of_gpus = quick3d_parameters['ngpu']
-    split_by_gpu = np.array_split(micrographs_list,number_of_gpus)
-    import subprocess as subp
     import time
-    output = open("gautomatch.log", 'w')
-    ps = []
-    for i in range(number_of_gpus) :
+    names = micdb.names_for( manifest, micrographs_list )
+    todo = set ( micdb.pending( manifest, names, 'pick' ) )
+    pick_list = [ m for m, n in zip( micrographs_list, names ) if n in todo ]
+    output = open("gautomatch.log", 'a')
+
+    def gautomatch_command ( batch, gpu, number ) :
         args = 'Gautomatch --apixM ' +  str(pixel_size)+ ' --diameter ' + str(diameter)  + ' --speed 2 ' + \
-                ' --cc_cutoff ' + str(cccutoff) + ' '  + ' '.join(split_by_gpu[i]) + ' --gid ' + str (i) + ' ' + contrast + ' ' + template
+                ' --cc_cutoff ' + str(cccutoff) + ' '  + ' '.join(batch) + ' --gid ' + str (gpu) + ' ' + contrast + ' ' + template
            # ' --lsigma_cutoff 1.3 ' + lavgmin + ' ' +  lavgmax + ' ' \
-        #print (args )
-        output.writelines ( str(args ) + '\n' )
-        proc = subp.Popen( args,  shell = True,  stdout = output)
-        ps.append(proc)
+        return args
 
-    #Keep the user informed       
-    a = len(glob.glob("*_automatch.star" ))
-    b = len (micrographs_list )
-    c = 0
-    print ('\nPicking particles using Gautomatch\n')
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob("*_automatch.star" ))
-
-    for p in ps:
-        p.wait()
-   
-    particles = 0 
-    for file in (glob.glob("*_automatch.box" )) :
-        particles = particles +  sum(1 for line in open(file))
+    if pick_list :
+        ps = gpudispatch.dispatch( pick_list, quick3d_parameters['gpu_ids'][:number_of_gpus], gautomatch_command, output )
+
+        #Keep the user informed       
+        print ('\nPicking particles using Gautomatch\n')
+        expected = [ os.path.splitext( os.path.basename(m) )[0] + '_automatch.star' for m in pick_list ]
+        jobwatch.wait_for_outputs( "*_automatch.star", len (pick_list ), ps, expected=expected )
+    output.close()
+
+    for mic, name in zip( micrographs_list, names ) :
+        if name not in todo :
+            continue
+        box = os.path.splitext( os.path.basename(mic) )[0] + '_automatch.box'
+        star = os.path.splitext( os.path.basename(mic) )[0] + '_automatch.star'
+        if not os.path.exists(star) :
+            micdb.mark( manifest, [ name ], 'pick', 'failed' )
+            continue
+        picked = 0
+        if os.path.exists(box) :
+            picked = sum(1 for line in open(box))
+        micdb.update( manifest, name, pick_star=os.path.abspath(star), pick_box=os.path.abspath(box), nparticles=picked )
+        micdb.mark( manifest, [ name ], 'pick' )
+
+    particles = sum ( micdb.column( manifest, 'nparticles', names ).values() )
     print (sg + '\nTotal number of picked particles:', particles  )
     print (eb )
 
+def native_particles_extract (  box_size, contrast, starfile, diameter, pixel_size, scale ) :
+    output_dir = quick3d_parameters['workdir'] + 'Particles/'
+    if scale != "" :
+        bgradius =  36
+        size = int ( scale.split()[-1] )
+    else :
+        bgradius = int ( round ( (float (box_size) * 0.75) / 2  ) ) 
+        size = 0
+    blocks = relionstar.read_star( starfile )
+    mics = [ str ( m ) for m in blocks[relionstar.default_block( blocks )]['rlnMicrographName'] ]
+    names = micdb.names_for( manifest, mics )
+    todo = set ( micdb.pending( manifest, names, 'extract' ) )
+    if len ( todo ) == 0 and os.path.exists( output_dir + 'particles.star' ) :
+        print (sg + '\nParticles are already extracted')
+        print (eb)
+        return
+    coordinates = nativeextract.picked_coordinates( [ m for m, n in zip( mics, names ) if n in todo ], './', '_automatch.star' )
+    print ('\nExtracting particles ( native )\n')
+    stacks = nativeextract.extract( starfile, coordinates, output_dir, int ( box_size ), pixel_size, size, bgradius, 3, 3, \
+                 contrast.strip() != '', number_of_cpu(), '../Particles/' )
+    micdb.update_many( manifest, 'particles', dict ( ( n, stacks[m] ) for m, n in zip( mics, names ) if m in stacks ) )
+    done = [ n for m, n in zip( mics, names ) if n in todo and os.path.exists( output_dir + nativeextract.stack_stem( m ) + nativeextract.EXTRACT_SUFFIX ) ]
+    micdb.mark( manifest, done, 'extract' )
+    micdb.mark( manifest, [ n for n in todo if n not in done ], 'extract', 'failed' )
+    print (sg + '\nParticle Extraction done')
+    print (eb)
+
 def relion_particles_extract (  box_size, contrast, starfile, diameter, pixel_size, scale ) :
     output_dir = quick3d_parameters['workdir'] + 'Particles/'
     if scale != "" :
         bgradius =  36
     else :
         bgradius = int ( round ( (float (box_size) * 0.75) / 2  ) ) 
-    os.makedirs(output_dir)
-    args = 'mpirun -np 16 relion_preprocess_mpi --i  ' + starfile +' --coord_dir ./ --coord_suffix _automatch.star --part_star ' + output_dir + 'particles.star --part_dir ../Particles/ --extract --extract_size ' \
+    names = micdb.names_for( manifest, micrographs_list )
+    if len ( micdb.pending( manifest, names, 'extract' ) ) == 0 and os.path.exists( output_dir + 'particles.star' ) :
+        print (sg + '\nParticles are already extracted')
+        print (eb)
+        return
+    if os.path.isdir (output_dir) != True :
+        os.makedirs(output_dir)
+    args = 'mpirun -np ' + str ( number_of_cpu() ) + ' relion_preprocess_mpi --i  ' + starfile +' --coord_dir ./ --coord_suffix _automatch.star --part_star ' + output_dir + 'particles.star --part_dir ../Particles/ --extract --extract_size ' \
             + str(box_size) +  ' --norm --bg_radius ' +  str(bgradius) + ' --white_dust 3 --black_dust 3 ' + contrast + ' ' +  scale
     #print (args)
     print ('\nExtracting particles using Relion\n')
@@ -1059,27 +1155,41 @@ def relion_particles_extract (  box_size, contrast, starfile, diameter, pixel_si
     proc = subp.Popen( args,  shell = True,  stdout = output)
 
     #Keep the user informed       
-    a = len(glob.glob("../Particles/*_extract.star" ))
-    b = len (micrographs_list )
-    c = 0
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b, 'Micrographs are done' )
-            c = a
-        a = len(glob.glob("../Particles/*_extract.star" ))
+    jobwatch.wait_for_outputs( "../Particles/*_extract.star", len (micrographs_list ), [ proc ] )
+    output.close()
+    extracted = {}
+    for mic, name in zip( micrographs_list, names ) :
+        stack = output_dir + os.path.splitext( os.path.basename(mic) )[0] + '.mrcs'
+        if os.path.exists( stack ) :
+            extracted[name] = stack
+    micdb.update_many( manifest, 'particles', extracted )
+    micdb.mark( manifest, [ n for n in names if n in extracted ], 'extract' )
+    micdb.mark( manifest, [ n for n in names if n not in extracted ], 'extract', 'failed' )
     print (sg + '\nParticle Extraction done')
     print (eb)
-    proc.wait()
+
+def native_particles_reextract (  box_size, contrast, diameter, run_number, dose ) :
+    output_dir = quick3d_parameters['workdir'] + 'reextract/'
+    bgradius = int ( round ( (float (box_size) * 0.75) / 2  ) )
+    if dose == 0 :
+        micrographs = triage.SELECTED if os.path.exists( triage.SELECTED ) else 'micrographs_ctf.star'
+    else :
+        micrographs = 'micrographs_ctf_DW.star'
+    ## the 2D shifts are in the binned pixels of the particles, the new boxes are centred on the micrographs
+    coordinates = nativeextract.recentred_coordinates( '../Class2D/particles' + str(run_number) + '.star', quick3d_parameters['pixel_size'] )
+    print ('\nRe-extracting particles ( native )\n')
+    nativeextract.extract( micrographs, coordinates, output_dir, int ( box_size ), quick3d_parameters['pixel_size'], 0, bgradius, 3, 3, \
+                 contrast.strip() != '', number_of_cpu(), '../reextract/' )
 
 def relion_particles_reextract (  box_size, contrast, diameter, run_number, dose ) :
     output_dir = quick3d_parameters['workdir'] + 'reextract/'
     bgradius = int ( round ( (float (box_size) * 0.75) / 2  ) )
     os.makedirs(output_dir)
     if dose == 0 :
-        micrographs = 'micrographs_ctf.star'
+        micrographs = triage.SELECTED if os.path.exists( triage.SELECTED ) else 'micrographs_ctf.star'
     else :
         micrographs = 'micrographs_ctf_DW.star'
-    args = 'mpirun -np 40 relion_preprocess_mpi --i ' +  micrographs + ' --reextract_data_star ../Class2D/particles' + str(run_number) + '.star --recenter --part_star ' + output_dir + 'particles.star --part_dir ../reextract/ --extract --extract_size ' \
+    args = 'mpirun -np ' + str ( number_of_cpu() ) + ' relion_preprocess_mpi --i ' +  micrographs + ' --reextract_data_star ../Class2D/particles' + str(run_number) + '.star --recenter --part_star ' + output_dir + 'particles.star --part_dir ../reextract/ --extract --extract_size ' \
             + str(box_size) +  ' --norm --bg_radius ' +  str(bgradius) + ' --white_dust 3 --black_dust 3 ' + contrast
     print ('\nRe-extracting particles using Relion\n')
     output = open("reextract.log", 'w')
@@ -1109,17 +1219,9 @@ def sparx_particles_extract (  box_size, contrast, cpu ) :
             if ( sum(1 for line in open(file)) ) != 0 :
                 b = b + 1
 
-        a = len(glob.glob("extract/mpi_proc_*" ))
-        #b = len (micrographs_list )
-        c = 0
-        while ( a < b ) :
-            if ( a > c ) :
-                print ( a,'/',b, 'Micrographs are done' )
-                c = a
-            a = len(glob.glob("extract/mpi_proc_*" ))
+        jobwatch.wait_for_outputs( "extract/mpi_proc_*", b, [ proc ] )
         print (sg + '\nParticle Extraction done')
         print (eb)
-        proc.wait()
         
     args = 'e2bdb.py  extract/mpi_proc_*  --makevstack=bdb:particles#data'
     if quick3d_parameters['qcpu'] != 0 :
@@ -1194,7 +1296,7 @@ def relion_2dclass ( diameter, nclasses, ignorectf, Tval, run_number, particles
     if os.path.isdir (output_dir) != True :
         os.makedirs(output_dir)
     os.chdir(output_dir)
-    args = 'mpirun -np 17 relion_refine_mpi --o ./run' + str(run_number) + ' --i ' + particles + ' --dont_combine_weights_via_disc --pool 100 --ctf  --pad 2 --fast_subsets --iter ' + str(quick3d_parameters['relion_2d_iter']) + ' --tau2_fudge ' + str(Tval) + ' --K ' + str(nclasses)  \
+    args = gpulease.visible( quick3d_parameters['gpu_ids'] ) + 'mpirun -np 17 relion_refine_mpi --o ./run' + str(run_number) + ' --i ' + particles + ' --dont_combine_weights_via_disc --pool 100 --ctf  --pad 2 --fast_subsets --iter ' + str(quick3d_parameters['relion_2d_iter']) + ' --tau2_fudge ' + str(Tval) + ' --K ' + str(nclasses)  \
            + ' --particle_diameter ' + str (diameter) + ' --flatten_solvent  --zero_mask  --oversampling 1 --psi_step 10 --offset_range 5 --offset_step 2  --dont_check_norm --scale  --j 4 --gpu ' + ignorectf
     #print (args)
     output = open("relion2d.log", 'w')
@@ -1204,16 +1306,8 @@ def relion_2dclass ( diameter, nclasses, ignorectf, Tval, run_number, particles
 
     #Keep the user informed       
     name = 'run' + str(run_number) + '*model.star'
-    a = len(glob.glob( name ))
     b = quick3d_parameters['relion_2d_iter'] + 1
-    c = 0
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b-1, 'Iterations are done' )
-            c = a
-        a = len(glob.glob(name ))
-
-    proc.wait()
+    jobwatch.wait_for_outputs( name, b, [ proc ], label='Iterations are done', shown_total=b-1 )
 
 def resize_3dmodel ( inpix, outpix, outbox, inmrc ) :
     output_dir = quick3d_parameters['workdir'] + 'Class3D/'
@@ -1244,7 +1338,7 @@ def relion_inital ( diameter, particles ) :
         os.makedirs(output_dir)
     os.chdir(output_dir)
 
-    args = 'mpirun -np 9 relion_refine_mpi --o ./run1 --sgd  --subset_size 200 --strict_highres_sgd 20 --write_subsets 10 --denovo_3dref  \
+    args = gpulease.visible( quick3d_parameters['gpu_ids'] ) + 'mpirun -np 9 relion_refine_mpi --o ./run1 --sgd  --subset_size 200 --strict_highres_sgd 20 --write_subsets 10 --denovo_3dref  \
             --i ' + particles + ' --ctf --sym C1 --zero_mask --dont_combine_weights_via_disc --pool 100 --iter 1 --particle_diameter ' + str(diameter) + \
              ' --oversampling 1 --healpix_order 1 --offset_range 10 --offset_step 4 --j 2 --gpu '
     output = open("relion-model.log", 'w')
@@ -1255,18 +1349,23 @@ def relion_inital ( diameter, particles ) :
     proc.wait()
 
 def relion_auto_select ( modelstar, datastar, run_number, maxp ) :
-    ### should write more pythonic.. I am in a hurry.. sorry
-    args = 'awk \'{if (NF>2 && $5 > 0 && $5 < 30 && $3 < 5 && $6 < 5 ) print $0}\' ' + modelstar + '| awk -F@ \'{print $1+0 }\' > list' + str(run_number)
-    os.system ( args )
-    #time.sleep(5) 
+    ## good classes: 0 < resolution < 30 A, rotation accuracy < 5 deg ( the cuts of the old awk script )
+    classes = relionstar.read_star( modelstar )['model_classes']
+    res = classes['rlnEstimatedResolution']
+    good = ( res > 0 ) & ( res < 30 ) & ( classes['rlnAccuracyRotations'] < 5 ) & ( classes['rlnOverallFourierCompleteness'] < 5 )
+    selected = [ int ( ref.split('@')[0] ) for ref in classes['rlnReferenceImage'][good] ]
+    np.savetxt( 'list' + str(run_number), selected, fmt='%d' )
     if maxp != 0 :
-        args = 'class.com -i ' + datastar + ' -o maxp_particles.star -l list' + str(run_number) + ' -m '  + str(maxp)
+        ## at most maxp particles per class, the ones with the highest max probability
         outpart = 'maxp_particles.star'
+        columns = [ 'rlnClassNumber', 'rlnMaxValueProbDistribution' ]
+        data = relionstar.read_columns( datastar, columns )
+        keep = relionstar.isin( data['rlnClassNumber'], selected ) & relionstar.top_per_group( data['rlnClassNumber'], data['rlnMaxValueProbDistribution'], maxp )
+        kept, total = relionstar.filter_star( datastar, outpart, keep )
     else :
-        args = 'class.com -i ' + datastar + ' -o particles' + str(run_number) + '.star -l list' + str(run_number)   
         outpart = 'particles' + str(run_number) + '.star' 
-    os.system ( args )
-    #time.sleep(5) 
+        kept, total = relionstar.filter_star( datastar, outpart, lambda t : relionstar.isin( t['rlnClassNumber'], selected ), columns=[ 'rlnClassNumber' ] )
+    print ( '\nSelected', len (selected), 'classes,', kept, 'of', total, 'particles' )
     return outpart
 
 def relion_3dclass ( diameter, nclasses, ignorectf, Tval, run_number, particles, model3d, mask ) :
@@ -1278,7 +1377,7 @@ def relion_3dclass ( diameter, nclasses, ignorectf, Tval, run_number, particles,
         mask = ' --solvent_mask ' + mask
     else :
         mask = ''
-    args = 'mpirun -np 17 relion_refine_mpi --o ./run' + str(run_number) + ' --i ' + particles + ' --ref ' + model3d + ' --firstiter_cc --ini_high 40 --dont_combine_weights_via_disc --pool 100 --ctf  --pad 2 --fast_subsets  --iter ' + str(quick3d_parameters['relion_2d_iter']) + ' --tau2_fudge ' + str(Tval) + ' --K ' + str(nclasses)  \
+    args = gpulease.visible( quick3d_parameters['gpu_ids'] ) + 'mpirun -np 17 relion_refine_mpi --o ./run' + str(run_number) + ' --i ' + particles + ' --ref ' + model3d + ' --firstiter_cc --ini_high 40 --dont_combine_weights_via_disc --pool 100 --ctf  --pad 2 --fast_subsets  --iter ' + str(quick3d_parameters['relion_2d_iter']) + ' --tau2_fudge ' + str(Tval) + ' --K ' + str(nclasses)  \
            + ' --particle_diameter ' + str (diameter) + ' --flatten_solvent  --zero_mask  --oversampling 1 --healpix_order 2  --offset_range 5 --offset_step 2 --sym C1 --norm --scale  --j 4 --gpu ' + ignorectf + mask
     #print (args)
     output = open("relion3d.log", 'w')
@@ -1288,16 +1387,8 @@ def relion_3dclass ( diameter, nclasses, ignorectf, Tval, run_number, particles,
 
     #Keep the user informed       
     name = 'run' + str(run_number) + '*model.star'
-    a = len(glob.glob( name ))
     b = quick3d_parameters['relion_3d_iter'] + 1
-    c = 0
-    while ( a < b ) :
-        if ( a > c ) :
-            print ( a,'/',b-1, 'Iterations are done' )
-            c = a
-        a = len(glob.glob(name ))
-
-    proc.wait()
+    jobwatch.wait_for_outputs( name, b, [ proc ], label='Iterations are done', shown_total=b-1 )
 
 
 def make_clean ( datadir, workdir ) :
@@ -1312,37 +1403,37 @@ def make_clean ( datadir, workdir ) :
     
 
 if quick3d_parameters['listfile'] == '' :
-    pattern = '*'+quick3d_parameters['micrograph_name_pattern'] +'*'+ quick3d_parameters['micrograph_name_suffix']
-    micrographs_total, micrographs_list = count_micrographs(pattern, quick3d_parameters['datadir'], quick3d_parameters['micrograph_name_exclude'], 1  )
+    ## the given suffix, then tif and mrc
+    suffixes = [ quick3d_parameters['micrograph_name_suffix'] ] + [ s for s in ( 'tif', 'mrc' ) if s != quick3d_parameters['micrograph_name_suffix'] ]
+    patterns = [ '*'+quick3d_parameters['micrograph_name_pattern'] +'*'+ suffix for suffix in suffixes ]
+    micrographs_total, micrographs_list, pattern = count_micrographs(patterns, quick3d_parameters['datadir'], quick3d_parameters['micrograph_name_exclude'], 1  )
     if micrographs_total == 0 :
-        quick3d_parameters['micrograph_name_suffix'] = 'tif'
-        pattern = '*'+quick3d_parameters['micrograph_name_pattern'] +'*'+ quick3d_parameters['micrograph_name_suffix']
-        micrographs_total, micrographs_list = count_micrographs(pattern, quick3d_parameters['datadir'], quick3d_parameters['micrograph_name_exclude'], 1  )
-        if micrographs_total == 0 :
-            print ('I cant find the micrographs in the directory')
-            print ('I will quit')
-            quit ()
-    if micrographs_total == 0 :
-        quick3d_parameters['micrograph_name_suffix'] = 'mrc'
-        pattern = '*'+quick3d_parameters['micrograph_name_pattern'] +'*'+ quick3d_parameters['micrograph_name_suffix']
-        micrographs_total, micrographs_list = count_micrographs(pattern, quick3d_parameters['datadir'], quick3d_parameters['micrograph_name_exclude'], 1  )
-        if micrographs_total == 0 :
-            print ('I cant find the micrographs in the directory')
-            print ('I will quit')
-            quit ()
+        print ('I cant find the micrographs in the directory')
+        print ('I will quit')
+        quit ()
+    quick3d_parameters['micrograph_name_suffix'] = suffixes[ patterns.index( pattern ) ]
 else :
     micrographs_total, micrographs_list = count_micrographs_list(quick3d_parameters['listfile'] )
 
     
-quick3d_parameters['z'] = get_movie_frame_number ( micrographs_list )
+micrographs_list, movie_headers = check_movie_headers ( micrographs_list )
+micrographs_total = len ( micrographs_list )
+quick3d_parameters['z'] = get_movie_frame_number ( movie_headers )
 if quick3d_parameters['ask_pixel_size'] == 0 and quick3d_parameters['pixel_size'] == 0:
-    quick3d_parameters['pixel_size'] = float ( get_pixel_size ( micrographs_list ) )
+    quick3d_parameters['pixel_size'] = float ( get_pixel_size ( movie_headers ) )
     if quick3d_parameters['pixel_size'] == 1 :
         print ( 'The pixel size from the header is 1.0, I hope thats the correct one')
         print (' If not please rerun the script with correct pixel size --pixel=1.63 for example')
 
 quick3d_parameters['ngpu'] = number_of_gpu ( micrographs_list  )
 
+manifest = micdb.open_manifest( quick3d_parameters['workdir'] )
+micrograph_names = micdb.register( manifest, micrographs_list )
+if quick3d_parameters['resume'] != '' :
+    print ('\nResuming ' + quick3d_parameters['timestamp'] )
+    for stage, status, count in micdb.summary( manifest ) :
+        print ( ' ', stage, status, count )
+
 quick3d_parameters['ncpu'] = number_of_cpu ()
 if quick3d_parameters['ncpu'] > len ( micrographs_list) :
     quick3d_parameters['sparxcpu'] = len ( micrographs_list)
@@ -1359,23 +1450,25 @@ if quick3d_parameters['z'] == 1 :
     #make_dir_soft_links(quick3d_parameters['workdir'],quick3d_parameters['datadir'] , pattern, quick3d_parameters['micrograph_name_exclude']    )
     make_dir_soft_links(quick3d_parameters['workdir'], micrographs_list )
     raw_list = micrographs_list
-    micrographs_total = len(glob.glob(os.path.join(quick3d_parameters['workdir'],'micrographs','*' )))
-    micrographs_list = glob.glob(os.path.join(quick3d_parameters['workdir'],'micrographs','*' ))
+    micrographs_list = [ os.path.join(quick3d_parameters['workdir'],'micrographs', os.path.basename(m) ) for m in raw_list ]
+    micrographs_total = len(micrographs_list)
+    micdb.update_many( manifest, 'aligned', dict ( zip ( micrograph_names, micrographs_list ) ) )
     if quick3d_parameters['dwcombi'] == 1 :
         quick3d_parameters['dose'] = 1
         dw_list = [x.replace('.mrc', '_DW.mrc') for x in raw_list]
         make_dir_soft_links(quick3d_parameters['workdir'], dw_list )
-        aligned_micrographs_suf = 'mrc'
-        aligned_micrographs_dir = quick3d_parameters['workdir'] + '/micrographs/' 
+        dw_links = [ os.path.join(quick3d_parameters['workdir'],'micrographs', os.path.basename(m) ) for m in dw_list ]
+        micdb.update_many( manifest, 'dw', dict ( zip ( micrograph_names, dw_links ) ) )
 else :
-    make_dir_soft_links1 ( quick3d_parameters['workdir'], micrographs_list )
     #MotionCor2_align_script (quick3d_parameters['ngpu'], micrographs_list )
-    MotionCor2_align_script (quick3d_parameters['ngpu'], quick3d_parameters['micrograph_name_suffix'], quick3d_parameters['gain'],  quick3d_parameters['rotgain'], micrographs_list )
+    if quick3d_parameters['align'] == 'native' :
+        native_align_script ( quick3d_parameters['gain'],  quick3d_parameters['rotgain'], micrographs_list )
+    else :
+        MotionCor2_align_script (quick3d_parameters['ngpu'], quick3d_parameters['micrograph_name_suffix'], quick3d_parameters['gain'],  quick3d_parameters['rotgain'], micrographs_list )
     #MotionCor2_align (quick3d_parameters['ngpu']  )
-    aligned_micrographs_dir = quick3d_parameters['workdir'] + '/aligned/' 
-    aligned_micrographs_suf = 'mrc'
-    pattern = '*'+quick3d_parameters['micrograph_name_pattern'] +'*'+ aligned_micrographs_suf
-    micrographs_total, micrographs_list = count_micrographs( pattern , aligned_micrographs_dir, 'DW', 0 )
+    aligned = micdb.column( manifest, 'aligned', micrograph_names )
+    micrographs_list = [ aligned[n] for n in micrograph_names if n in aligned ]
+    micrographs_total = len(micrographs_list)
     if quick3d_parameters['bin'] != 0 :
         quick3d_parameters['pixel_size'] = float ( quick3d_parameters['pixel_size'] ) * float ( quick3d_parameters['bin'] )
 
@@ -1387,11 +1480,16 @@ else :
     GCTF( quick3d_parameters['pixel_size'], quick3d_parameters['cs'], quick3d_parameters['kv'], micrographs_list_simple, quick3d_parameters['negative'])
 
 if quick3d_parameters['dose'] != 0 :
-    pattern = '*'+quick3d_parameters['micrograph_name_pattern'] +'*DW*'+ aligned_micrographs_suf
-    #print (pattern)
-    if quick3d_parameters['dwcombi'] == 1 :
-        quick3d_parameters['micrograph_name_exclude'] = '\#'
-    micrographs_total, micrographs_list = count_micrographs( pattern , aligned_micrographs_dir, quick3d_parameters['micrograph_name_exclude'], 0 )
+    dw = micdb.column( manifest, 'dw', micrograph_names )
+    micrographs_list = [ dw[n] for n in micrograph_names if n in dw ]
+    micrographs_total = len(micrographs_list)
+    micrographs_list_simple = micrographs_list_nodir_name(micrographs_list)
+
+## picking and extraction only get the micrographs the triage selects
+selected = triage_micrographs ()
+if selected is not None :
+    micrographs_list = [ m for m, n in zip( micrographs_list, micdb.names_for( manifest, micrographs_list ) ) if n in selected ]
+    micrographs_total = len(micrographs_list)
     micrographs_list_simple = micrographs_list_nodir_name(micrographs_list)
 
 #if quick3d_parameters['template'] != '' :
@@ -1406,16 +1504,19 @@ elif quick3d_parameters['template'] == '' :
 
 Gautomatch ( micrographs_list_simple, quick3d_parameters['pixel_size'] , quick3d_parameters['diameter'], quick3d_parameters['cccutoff'], quick3d_parameters['pickcontrast'], template, quick3d_parameters['lavgmin'], quick3d_parameters['lavgmax'] )
 
+ctf_star = triage.SELECTED if selected is not None else 'micrographs_ctf.star'
 if quick3d_parameters['dose'] != 0 :
-    input_star  = open ("micrographs_ctf.star", 'r' )
-    output_star = open ("micrographs_ctf_DW.star",  'w' )
-    for line in input_star:
-        output_star.write(line.replace('.mrc', '_DW.mrc')) 
+    ## same ctf, the DW sum of each micrograph from the manifest
+    blocks = relionstar.read_star( ctf_star )
+    block = relionstar.default_block( blocks )
+    mics = blocks[block]['rlnMicrographName']
+    dw = micdb.column( manifest, 'dw' )
+    dw_mics = [ os.path.basename( dw[n] ) if n in dw else m for n, m in zip( micdb.names_for( manifest, mics ), mics ) ]
+    blocks[block] = relionstar.with_column( blocks[block], 'rlnMicrographName', dw_mics )
+    relionstar.write_star( 'micrographs_ctf_DW.star', blocks )
     starfile = 'micrographs_ctf_DW.star'
-    output_star.close()
-    input_star.close()
 else :
-    starfile = 'micrographs_ctf.star'
+    starfile = ctf_star
 
 if quick3d_parameters['box'] == 0 :
     quick3d_parameters['box'] =  round_up_to_even ( ( float ( quick3d_parameters['diameter'])   * 1.5 ) / float ( quick3d_parameters['pixel_size'] ) )
@@ -1427,7 +1528,10 @@ if quick3d_parameters['mask'] == 0 :
 if quick3d_parameters['sparx'] == 1 :
     sparx_particles_extract ( quick3d_parameters['box'], quick3d_parameters['contrast'], quick3d_parameters['sparxcpu'] )
 else :
-    relion_particles_extract ( quick3d_parameters['box'], quick3d_parameters['contrast'], starfile, quick3d_parameters['diameter'], quick3d_parameters['pixel_size'], quick3d_parameters['partbin'] )
+    if quick3d_parameters['extract'] == 'native' :
+        native_particles_extract ( quick3d_parameters['box'], quick3d_parameters['contrast'], starfile, quick3d_parameters['diameter'], quick3d_parameters['pixel_size'], quick3d_parameters['partbin'] )
+    else :
+        relion_particles_extract ( quick3d_parameters['box'], quick3d_parameters['contrast'], starfile, quick3d_parameters['diameter'], quick3d_parameters['pixel_size'], quick3d_parameters['partbin'] )
 
 run_number = 1
 particles = '../Particles/particles.star'
@@ -1581,7 +1685,10 @@ if user_input == 'reextract' :
         quick3d_parameters['box'] = quick3d_parameters['full_box']
         run_number = quick3d_parameters['auto_2d_iter']  
 
-    relion_particles_reextract ( quick3d_parameters['box'], quick3d_parameters['contrast'], quick3d_parameters['diameter'], run_number, quick3d_parameters['dose']  )
+    if quick3d_parameters['extract'] == 'native' :
+        native_particles_reextract ( quick3d_parameters['box'], quick3d_parameters['contrast'], quick3d_parameters['diameter'], run_number, quick3d_parameters['dose']  )
+    else :
+        relion_particles_reextract ( quick3d_parameters['box'], quick3d_parameters['contrast'], quick3d_parameters['diameter'], run_number, quick3d_parameters['dose']  )
     quick3d_parameters['reextract'] = 1
 
 if quick3d_parameters['reextract'] == 1 :
@@ -1608,7 +1715,7 @@ if user_input == '3d' :
     if quick3d_parameters['auto'] == 0 :
         if quick3d_parameters['3d'] != '' :
             quick3d_parameters['3dmodel'] = quick3d_parameters['3d']
-            #quick3d_parameters['3dmodelpix'] = get_pixel_size ([ quick3d_parameters['datadir'] + '/' + quick3d_parameters['3dmodel']] )
+            #quick3d_parameters['3dmodelpix'] = get_pixel_size ([ mrcheader.read_header( quick3d_parameters['datadir'] + '/' + quick3d_parameters['3dmodel'] ) ])
         if quick3d_parameters['3dmodel'] != '' :
             if quick3d_parameters['3d'] != '' :
                 quick3d_parameters['3dmodel'] = quick3d_parameters['datadir'] + '/' + quick3d_parameters['3dmodel']
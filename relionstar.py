@@ -0,0 +1,286 @@
+## Relion STAR files as NumPy structured arrays
+##
+## A loop_ becomes a structured array with one field per label ( without the leading '_' ),
+## a key/value block becomes an OrderedDict. Big files ( run*_data.star ) are streamed in
+## chunks of rows: only the chunk is parsed, and filtered rows are written back as the
+## original text lines, so selecting from millions of particles keeps memory bounded and
+## never reformats the numbers.
+
+import os, collections
+import numpy as np
+import numpy.lib.recfunctions as rfn
+
+CHUNK_ROWS = 200000
+NUMBER_START = frozenset( '0123456789-+.' )
+
+def column_array ( values ) :
+    ## int if every value is an int, float if every value is a number, text otherwise
+    for kind in ( np.int64, np.float64 ) :
+        try :
+            return np.array( values, dtype=kind )
+        except ( ValueError, OverflowError ) :
+            pass
+    return np.array( values, dtype=str )
+
+def make_table ( columns ) :
+    ## columns: [ ( label, values ) ... ] -> structured array
+    arrays = []
+    for label, values in columns :
+        values = np.asarray( values )
+        if values.dtype.kind == 'O' :
+            values = column_array( [ str(v) for v in values ] )
+        arrays.append( ( label.lstrip('_'), values ) )
+    n = len ( arrays[0][1] ) if arrays else 0
+    table = np.empty( n, dtype=[ ( label, values.dtype ) for label, values in arrays ] )
+    for label, values in arrays :
+        table[label] = values
+    return table
+
+def rows_to_table ( labels, rows, columns=None ) :
+    ## rows are the split data lines, columns limits the parsed fields to these labels
+    if columns is None :
+        columns = labels
+    index = [ labels.index( c ) for c in columns ]
+    return make_table( [ ( c, column_array( [ r[i] for r in rows ] ) ) for c, i in zip( columns, index ) ] )
+
+def _block_name ( line ) :
+    return line.strip()[len('data_'):]
+
+def _label ( line ) :
+    return line.split()[0][1:]
+
+def _is_row ( line ) :
+    if line[:1] in NUMBER_START :
+        return True
+    s = line.strip()
+    return s != '' and s[0] not in '#_' and s != 'loop_' and not s.startswith('data_')
+
+def read_star ( filename ) :
+    ## { block name : structured array ( loop ) or OrderedDict ( key / value pairs ) }
+    blocks = collections.OrderedDict()
+    name = None
+    labels = None
+    rows = None
+    pairs = None
+
+    def close () :
+        if name is None :
+            return
+        if labels is not None :
+            blocks[name] = rows_to_table( labels, rows )
+        else :
+            blocks[name] = pairs
+
+    with open( filename ) as f :
+        for line in f :
+            s = line.strip()
+            if s.startswith('data_') :
+                close()
+                name = _block_name( s )
+                labels = None
+                rows = []
+                pairs = collections.OrderedDict()
+            elif name is None or s == '' or s.startswith('#') :
+                continue
+            elif s == 'loop_' :
+                labels = []
+            elif s.startswith('_') :
+                if labels is not None and not rows :
+                    labels.append( _label( s ) )
+                else :
+                    words = s.split()
+                    pairs[ words[0][1:] ] = ' '.join( words[1:] )
+            elif labels is not None :
+                rows.append( s.split() )
+    close()
+    return blocks
+
+def default_block ( blocks ) :
+    ## the particles / micrographs loop: the last block with a loop ( relion 3.1 puts optics first )
+    loops = [ k for k, v in blocks.items() if isinstance ( v, np.ndarray ) ]
+    if not loops :
+        raise ValueError( 'no loop_ in the STAR file' )
+    return loops[-1]
+
+def read_loop ( filename, block=None ) :
+    blocks = read_star( filename )
+    if block is None :
+        block = default_block( blocks )
+    return blocks[block]
+
+def loop_blocks ( filename ) :
+    ## names of the blocks with a loop_, without parsing any row
+    names = []
+    name = None
+    with open( filename ) as f :
+        for line in f :
+            if line[:1] in NUMBER_START :
+                continue
+            s = line.strip()
+            if s.startswith('data_') :
+                name = _block_name( s )
+            elif s == 'loop_' and name is not None :
+                names.append( name )
+    return names
+
+def iter_chunks ( filename, block=None, chunk_rows=CHUNK_ROWS, columns=None, passthrough=None ) :
+    ## yields ( table, lines ) for chunk_rows rows of one loop at a time. lines are the original
+    ## text lines of the rows. Everything else in the file is handed to passthrough ( line ) in order
+    if block is None :
+        names = loop_blocks( filename )
+        if not names :
+            raise ValueError( 'no loop_ in ' + filename )
+        block = names[-1]
+    name = None
+    labels = None
+    lines = []
+    inside = False
+
+    def table () :
+        ## split each row only up to the last column we need
+        if columns is None :
+            return rows_to_table( labels, [ l.split() for l in lines ] )
+        last = max ( labels.index( c ) for c in columns ) + 1
+        return rows_to_table( labels, [ l.split( None, last ) for l in lines ], columns )
+
+    with open( filename ) as f :
+        for line in f :
+            if inside and _is_row( line ) :
+                lines.append( line )
+                if len ( lines ) >= chunk_rows :
+                    yield table(), lines
+                    lines = []
+                continue
+            if lines :
+                yield table(), lines
+                lines = []
+            s = line.strip()
+            if s.startswith('data_') :
+                name = _block_name( s )
+                inside = False
+                labels = None
+            elif name == block and s == 'loop_' :
+                labels = []
+                inside = True
+            elif inside and s.startswith('_') :
+                labels.append( _label( s ) )
+            if passthrough is not None :
+                passthrough( line )
+    if lines :
+        yield table(), lines
+
+def read_columns ( filename, columns, block=None, chunk_rows=CHUNK_ROWS ) :
+    ## only these columns of a big loop, the rest of every row is dropped chunk by chunk
+    parts = [ table for table, lines in iter_chunks( filename, block, chunk_rows, columns ) ]
+    if not parts :
+        return make_table( [ ( c, np.array( [] ) ) for c in columns ] )
+    return concatenate( parts )
+
+def filter_star ( infile, outfile, keep, block=None, chunk_rows=CHUNK_ROWS, columns=None ) :
+    ## write the rows of the loop for which keep is True, the rest of the file unchanged.
+    ## keep is a boolean array over all rows or a function ( chunk table ) -> boolean array.
+    ## Returns ( rows kept, rows read )
+    kept = 0
+    total = 0
+    tmp = outfile + '.part'
+    with open( tmp, 'w' ) as out :
+        for table, lines in iter_chunks( infile, block, chunk_rows, columns, out.write ) :
+            if callable ( keep ) :
+                mask = np.asarray( keep( table ), dtype=bool )
+            else :
+                mask = np.asarray( keep[ total:total + len ( lines ) ], dtype=bool )
+            for i in np.nonzero( mask )[0] :
+                out.write( lines[i] )
+            kept += int ( mask.sum() )
+            total += len ( lines )
+    os.rename( tmp, outfile )
+    return kept, total
+
+def _format ( values ) :
+    if values.dtype.kind == 'f' :
+        return [ '%.6f' % v for v in values ]
+    return [ str(v) for v in values ]
+
+def _write_block ( f, name, block ) :
+    f.write( '\ndata_' + name + '\n\n' )
+    if isinstance ( block, np.ndarray ) :
+        f.write( 'loop_\n' )
+        for i, label in enumerate ( block.dtype.names ) :
+            f.write( '_' + label + ' #' + str(i + 1) + '\n' )
+        columns = [ _format( block[label] ) for label in block.dtype.names ]
+        for row in zip( *columns ) :
+            f.write( ' '.join( row ) + '\n' )
+    else :
+        for key, value in block.items() :
+            f.write( '_' + key + ' ' + str(value) + '\n' )
+    f.write( '\n' )
+
+def write_star ( filename, blocks ) :
+    ## blocks: OrderedDict { name : structured array or dict }, written through a temporary file
+    tmp = filename + '.part'
+    with open( tmp, 'w' ) as f :
+        for name, block in blocks.items() :
+            _write_block( f, name, block )
+    os.rename( tmp, filename )
+
+def write_loop ( filename, table, block='' ) :
+    write_star( filename, collections.OrderedDict( [ ( block, table ) ] ) )
+
+def concatenate ( tables ) :
+    ## chunks can have different text widths, widen to the largest before stacking
+    if len ( tables ) == 1 :
+        return tables[0]
+    labels = tables[0].dtype.names
+    return make_table( [ ( label, np.concatenate( [ t[label] for t in tables ] ) ) for label in labels ] )
+
+def with_column ( table, label, values ) :
+    ## add or replace a column, text columns get as wide as they need to be
+    label = label.lstrip('_')
+    columns = [ ( name, table[name] ) for name in table.dtype.names if name != label ]
+    if label in table.dtype.names :
+        position = table.dtype.names.index( label )
+    else :
+        position = len ( columns )
+    columns.insert( position, ( label, np.asarray( values ) ) )
+    return make_table( columns )
+
+def rename ( table, mapping ) :
+    return rfn.rename_fields( table, dict ( ( k.lstrip('_'), v.lstrip('_') ) for k, v in mapping.items() ) )
+
+def drop ( table, labels ) :
+    labels = [ l.lstrip('_') for l in labels ]
+    return make_table( [ ( name, table[name] ) for name in table.dtype.names if name not in labels ] )
+
+def join ( left, right, on, right_on=None ) :
+    ## inner join on a key column ( e.g. rlnMicrographName ), the row order of left is kept.
+    ## Columns of right that left already has are skipped
+    right_on = on if right_on is None else right_on
+    keys = right[right_on]
+    order = np.argsort( keys, kind='mergesort' )
+    sorted_keys = keys[order]
+    pos = np.searchsorted( sorted_keys, left[on] )
+    pos = np.clip( pos, 0, max ( 0, len ( sorted_keys ) - 1 ) )
+    if len ( sorted_keys ) :
+        found = sorted_keys[pos] == left[on]
+    else :
+        found = np.zeros( len ( left ), dtype=bool )
+    rows = order[ pos[found] ]
+    columns = [ ( name, left[name][found] ) for name in left.dtype.names ]
+    for name in right.dtype.names :
+        if name != right_on and name not in left.dtype.names :
+            columns.append( ( name, right[name][rows] ) )
+    return make_table( columns )
+
+def isin ( values, selection ) :
+    return np.isin( values, np.asarray( list ( selection ) ) )
+
+def top_per_group ( groups, scores, n ) :
+    ## boolean mask keeping the n highest scores of every group ( e.g. per rlnClassNumber )
+    groups = np.asarray( groups )
+    order = np.lexsort( ( -np.asarray( scores ), groups ) )
+    ordered = groups[order]
+    first = np.searchsorted( ordered, ordered, side='left' )
+    rank = np.arange( len ( ordered ) ) - first
+    mask = np.zeros( len ( groups ), dtype=bool )
+    mask[ order[ rank < n ] ] = True
+    return mask
@@ -0,0 +1,187 @@
+## Putting the inputs where the programs want them
+##
+## Only Gctf needs its micrographs in the work directory ( it writes the .ctf and the log next
+## to them ), ctffind4, the native CTF and MotionCor2 are given the paths of the data directly.
+## The links that are still needed are made by a thread pool in batches, the names already
+## there are skipped after one listing of the directory. With --scratch ( or $EM_SCRATCH ) the
+## work directory, and so the links and every temporary file, is on node local disk instead of
+## the shared file system.
+##
+## Removing a work directory is left to a reaper in the background: the directory is renamed
+## to a tombstone ( .reap.<pid>.<host>@<name> next to it, one rename ) and a detached process
+## deletes it with a few threads, so the scripts return as soon as their outputs are written.
+## A reaper that is killed ( end of the batch job, reboot ) leaves its tombstone behind, the
+## next run in that directory finds it and starts a new reaper.
+
+import os, sys, shutil, socket, subprocess, time
+from multiprocessing.pool import ThreadPool
+
+SCRATCH = os.environ.get( 'EM_SCRATCH', '' )
+LINK_THREADS = 16
+LINK_BATCH = 256
+REAP_THREADS = 8
+REAP_BATCH = 256
+TOMBSTONE = '.reap.'
+## between the host and the name of a tombstone, a host name has dots but never this
+TOMBSTONE_HOST = '@'
+## a tombstone of another host is taken over when it has not changed for this long ( s )
+REAP_AGE = 6 * 3600
+
+def work_directory ( datadir, name, scratch='' ) :
+    ## datadir/name/ or scratch/name/ when there is a scratch disk
+    if scratch :
+        return os.path.join( os.path.abspath( scratch ), name ) + '/'
+    return os.path.join( datadir, name ) + '/'
+
+def _link_batch ( job ) :
+    directory, targets = job
+    for target in targets :
+        try :
+            os.symlink( target, os.path.join( directory, os.path.basename( target ) ) )
+        except FileExistsError :
+            pass
+    return len ( targets )
+
+def link_many ( targets, directory, threads=LINK_THREADS ) :
+    ## directory/<name of target> -> target for every target, returns the links in the same order
+    if os.path.isdir( directory ) != True :
+        os.makedirs( directory )
+    present = set ( entry.name for entry in os.scandir( directory ) )
+    todo = [ t for t in targets if os.path.basename( t ) not in present ]
+    jobs = [ ( directory, todo[i:i + LINK_BATCH] ) for i in range ( 0, len ( todo ), LINK_BATCH ) ]
+    if len ( jobs ) > 1 :
+        pool = ThreadPool( min ( threads, len ( jobs ) ) )
+        try :
+            pool.map( _link_batch, jobs )
+        finally :
+            pool.close()
+            pool.join()
+    else :
+        for job in jobs :
+            _link_batch( job )
+    return [ os.path.join( directory, os.path.basename( t ) ) for t in targets ]
+
+def remove_tree ( directory ) :
+    ## the work directory with its links, rmtree removes a link and never what it points to
+    shutil.rmtree( directory, ignore_errors=True )
+
+def tombstone_name ( name, pid=None ) :
+    return TOMBSTONE + str ( pid or os.getpid() ) + '.' + socket.gethostname() + TOMBSTONE_HOST + name
+
+def tombstone_parts ( name ) :
+    ## ( host, pid, name of the directory ) of a tombstone name, None when it is not one
+    if not name.startswith( TOMBSTONE ) :
+        return None
+    pid, _, rest = name[len ( TOMBSTONE ):].partition( '.' )
+    host, _, directory = rest.partition( TOMBSTONE_HOST )
+    if not pid.isdigit() or not host or not directory :
+        return None
+    return host, int ( pid ), directory
+
+def tombstone_owner ( name ) :
+    ## ( host, pid ) of a tombstone name, None when it is not one
+    parts = tombstone_parts( name )
+    return parts[:2] if parts is not None else None
+
+def alive ( pid ) :
+    try :
+        os.kill( pid, 0 )
+    except ProcessLookupError :
+        return False
+    except PermissionError :
+        return True
+    return True
+
+def _unlink_batch ( paths ) :
+    for path in paths :
+        try :
+            os.unlink( path )
+        except FileNotFoundError :
+            pass
+        except IsADirectoryError :
+            shutil.rmtree( path, ignore_errors=True )
+
+def delete_tree ( directory, threads=REAP_THREADS ) :
+    ## rmtree with the unlinks of every directory shared by a few threads, the directories
+    ## themselves are removed deepest first once they are empty
+    directories = []
+    pool = ThreadPool( threads )
+    try :
+        for top, subdirs, files in os.walk( directory ) :
+            directories.append( top )
+            paths = [ os.path.join( top, name ) for name in files ]
+            ## os.walk lists the links to directories as directories but does not enter them
+            paths += [ os.path.join( top, name ) for name in subdirs if os.path.islink( os.path.join( top, name ) ) ]
+            pool.map( _unlink_batch, [ paths[i:i + REAP_BATCH] for i in range ( 0, len ( paths ), REAP_BATCH ) ] )
+    finally :
+        pool.close()
+        pool.join()
+    for top in reversed ( directories ) :
+        try :
+            os.rmdir( top )
+        except OSError :
+            pass
+    remove_tree( directory )
+
+def start_reaper ( tombstone ) :
+    ## a detached python that deletes the tombstone, it outlives the script that started it
+    with open( os.devnull, 'r+' ) as null :
+        subprocess.Popen( [ sys.executable, os.path.abspath( __file__ ), tombstone ], stdin=null, stdout=null, stderr=null,
+                          close_fds=True, start_new_session=True, cwd=os.path.dirname( tombstone ) )
+
+def reap ( directory ) :
+    ## rename the directory to a tombstone and delete it in the background
+    directory = os.path.abspath( directory )
+    if not os.path.isdir( directory ) :
+        return
+    tombstone = os.path.join( os.path.dirname( directory ), tombstone_name( os.path.basename( directory ) ) )
+    try :
+        os.rename( directory, tombstone )
+        start_reaper( tombstone )
+    except OSError :
+        remove_tree( tombstone if os.path.isdir( tombstone ) else directory )
+
+def reclaim ( parent ) :
+    ## start a reaper for every tombstone in parent whose reaper is gone, returns how many
+    host = socket.gethostname()
+    reclaimed = 0
+    try :
+        entries = [ e for e in os.scandir( parent ) if e.name.startswith( TOMBSTONE ) and e.is_dir( follow_symlinks=False ) ]
+    except OSError :
+        return 0
+    for entry in entries :
+        owner = tombstone_owner( entry.name )
+        if owner is None :
+            continue
+        if owner[0] == host :
+            if alive( owner[1] ) :
+                continue
+        else :
+            try :
+                if time.time() - entry.stat( follow_symlinks=False ).st_mtime < REAP_AGE :
+                    continue
+            except OSError :
+                continue
+        ## the new reaper takes the tombstone over under its own name
+        start_reaper( entry.path )
+        reclaimed += 1
+    return reclaimed
+
+def reaper ( tombstone ) :
+    ## the background process: the tombstone is renamed to carry the pid of this reaper, so a
+    ## run that starts while it works leaves it alone
+    name = os.path.basename( tombstone )
+    parts = tombstone_parts( name )
+    if parts is None :
+        return
+    mine = os.path.join( os.path.dirname( tombstone ), tombstone_name( parts[2] ) )
+    try :
+        os.rename( tombstone, mine )
+    except OSError :
+        ## another reaper was faster
+        return
+    delete_tree( mine )
+
+if __name__ == '__main__' :
+    for tombstone in sys.argv[1:] :
+        reaper( tombstone )
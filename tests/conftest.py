@@ -0,0 +1,5 @@
+## the modules are flat next to the scripts, the tests import them from the top of the repo
+
+import os, sys
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
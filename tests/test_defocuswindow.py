@@ -0,0 +1,48 @@
+import os
+import defocuswindow
+
+def fake_gctf ( directory, batch, defocus, outlier ) :
+    ## Gctf that finds the defocus of the micrograph, or the edge of the search when it is outside
+    low, high = defocus[:2] if defocus is not None else ( 5000, 90000 )
+    for micrograph in batch :
+        i = int ( micrograph[3:6] )
+        true = 40000.0 if micrograph == outlier else 15000.0 + 100 * ( i % 10 )
+        found = min ( max ( true, low ), high )
+        with open( os.path.join( directory, micrograph[:-4] + '_gctf.log' ), 'w' ) as f :
+            f.write( '%10.2f %10.2f %10.2f %10.6f  Final Values\n' % ( found, found + 300, 30, 0.25 if found == true else 0.05 ) )
+            f.write( 'RES_LIMIT %.3f\n' % ( 4.0 + 0.01 * ( i % 7 ) ) )
+
+def run ( tmpdir, outlier, count=40, size=4 ) :
+    windows = []
+    def make_command ( batch, gpu, number, defocus=None ) :
+        windows.append( defocus )
+        fake_gctf( str ( tmpdir ), batch, defocus, outlier )
+        return 'Gctf'
+    window = defocuswindow.DefocusWindow( make_command, 'gctf', str ( tmpdir ) )
+    micrographs = [ 'mic%03d.mrc' % i for i in range ( count ) ]
+    for i in range ( 0, count, size ) :
+        window( micrographs[i:i + size], 0, i )
+    return window, micrographs, windows
+
+def test_window_narrows ( tmpdir ) :
+    window, micrographs, windows = run( tmpdir, None )
+    assert windows[:2] == [ None, None ]
+    assert all ( w is not None for w in windows[2:] )
+    low, high, step = windows[-1]
+    assert low <= 15000 and high >= 15900 + 300
+    assert high < defocuswindow.FULL['gctf'][1]
+    assert window.refits() == []
+    assert defocuswindow.full_search( window, micrographs ) == micrographs[:8]
+
+def test_fall_back_and_refit ( tmpdir ) :
+    window, micrographs, windows = run( tmpdir, 'mic013.mrc' )
+    ## the batch after the one with the outlier searches the full range again
+    assert windows[3] is not None and windows[4] is None and windows[5] is None
+    assert windows[6] is not None
+    assert window.refits() == [ 'mic013.mrc' ]
+    window.refitted( [ 'mic013.mrc' ] )
+    assert window.refits() == []
+    assert 'mic013.mrc' in defocuswindow.full_search( window, micrographs )
+
+def test_full_search_of_a_plain_command () :
+    assert defocuswindow.full_search( lambda batch, gpu, number : '', [ 'a.mrc' ] ) == [ 'a.mrc' ]
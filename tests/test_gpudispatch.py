@@ -0,0 +1,132 @@
+import os, collections
+import pytest
+import gpudispatch, jobwatch
+
+## stands in for Gctf: one <stem>.out per input next to the script, fails the batch when an
+## input is called bad*
+STAND_IN = """#!/bin/sh
+status=0
+for f in "$@" ; do
+    case $( basename "$f" ) in bad*) status=1 ; continue ;; esac
+    echo "$f" >> "$( dirname "$0" )/processed.txt"
+    touch "$( dirname "$0" )/$( basename "$f" .mrc ).out"
+done
+exit $status
+"""
+
+@pytest.fixture
+def stand_in ( tmpdir ) :
+    script = tmpdir.join( 'stand_in.sh' )
+    script.write( STAND_IN )
+    script.chmod( 0o755 )
+    return str ( script )
+
+def micrographs ( tmpdir, sizes, prefix='mic' ) :
+    files = []
+    for i, size in enumerate ( sizes ) :
+        name = tmpdir.join( '%s%03d.mrc' % ( prefix, i ) )
+        with open( str ( name ), 'wb' ) as f :
+            f.truncate( size )
+        files.append( str ( name ) )
+    return files
+
+def recording ( script, batches ) :
+    def make_command ( batch, slot, number ) :
+        batches.append( list ( batch ) )
+        return script + ' ' + ' '.join( batch )
+    return make_command
+
+def processed ( tmpdir ) :
+    return tmpdir.join( 'processed.txt' ).read().split()
+
+def finish ( workers ) :
+    for w in workers :
+        w.join( 30 )
+        assert not w.is_alive()
+
+def test_every_file_once ( tmpdir, stand_in ) :
+    files = micrographs( tmpdir, [ 1000 * ( 1 + i % 7 ) for i in range ( 40 ) ] )
+    batches = []
+    workers = gpudispatch.dispatch( files, [ 0, 1, 2 ], recording( stand_in, batches ), min_bytes=0 )
+    finish( workers )
+    assert sorted ( processed( tmpdir ) ) == sorted ( files )
+    assert sorted ( f for b in batches for f in b ) == sorted ( files )
+    assert sorted ( f for w in workers for f in w.files ) == sorted ( files )
+    assert gpudispatch.failed_files( workers ) == []
+    assert [ w.returncode for w in workers ] == [ 0, 0, 0 ]
+
+def test_max_files ( tmpdir, stand_in ) :
+    files = micrographs( tmpdir, [ 10 ] * 50 )
+    batches = []
+    finish( gpudispatch.dispatch( files, [ 0 ], recording( stand_in, batches ), min_bytes=0, max_files=4 ) )
+    assert max ( len ( b ) for b in batches ) == 4
+    assert sum ( len ( b ) for b in batches ) == 50
+
+def test_batches_shrink_with_the_queue ( ) :
+    queue = gpudispatch.WorkQueue( [], 2, min_bytes=0, max_files=1000 )
+    queue.items = collections.deque( ( 'f%d' % i, 1000 ) for i in range ( 100 ) )
+    queue.remaining = 100 * 1000
+    sizes = []
+    while True :
+        job = queue.next_batch()
+        if job is None :
+            break
+        sizes.append( len ( job[0] ) )
+    ## half of a fair share of what is left: 100000 / 2 / 2 bytes, then less and less
+    assert sizes[0] == 25
+    assert sizes == sorted ( sizes, reverse=True )
+    assert sizes[-1] == 1
+    assert sum ( sizes ) == 100
+
+def test_byte_floor_and_big_files ( ) :
+    queue = gpudispatch.WorkQueue( [], 4, min_bytes=5000, max_files=1000 )
+    queue.items = collections.deque( [ ( 'big', 10 ** 9 ) ] + [ ( 'f%d' % i, 1000 ) for i in range ( 20 ) ] )
+    queue.remaining = 10 ** 9 + 20 * 1000
+    ## a file bigger than the target goes alone, the small ones at least min_bytes together
+    assert queue.next_batch()[0] == [ 'big' ]
+    assert len ( queue.next_batch()[0] ) == 5
+
+def test_failing_batch ( tmpdir, stand_in ) :
+    files = micrographs( tmpdir, [ 10 ] * 6 ) + micrographs( tmpdir, [ 10 ], prefix='bad' )
+    batches = []
+    workers = gpudispatch.dispatch( files, [ 0 ], recording( stand_in, batches ), min_bytes=0, max_files=2 )
+    finish( workers )
+    failed = gpudispatch.failed_files( workers )
+    bad = [ b for b in batches if files[-1] in b ][0]
+    assert sorted ( failed ) == sorted ( bad )
+    assert workers[0].returncode != 0
+    assert sorted ( processed( tmpdir ) ) == sorted ( f for f in files if not os.path.basename( f ).startswith( 'bad' ) )
+
+def test_make_command_raises ( tmpdir, stand_in ) :
+    files = micrographs( tmpdir, [ 10 ] * 8 )
+    def make_command ( batch, slot, number ) :
+        raise IOError( 'cannot write the .com' )
+    workers = gpudispatch.dispatch( files, [ 0, 1 ], make_command, min_bytes=0, max_files=2 )
+    finish( workers )
+    assert all ( w.poll() not in ( None, 0 ) for w in workers )
+    assert sorted ( gpudispatch.failed_files( workers ) ) == sorted ( files )
+    ## the wait on outputs that never come returns once the workers are gone
+    codes = jobwatch.wait_for_outputs( str ( tmpdir.join( '*.out' ) ), len ( files ), workers )
+    assert all ( c != 0 for c in codes )
+
+def test_one_worker_raises ( tmpdir, stand_in ) :
+    ## the other worker goes on with the queue, only the batch of the broken one fails
+    files = micrographs( tmpdir, [ 10 ] * 12 )
+    good = recording( stand_in, [] )
+    def broken ( batch, slot, number ) :
+        raise OSError( 'no such program' )
+    workers = gpudispatch.dispatch_mixed( files, [ ( 'gctf', [ 0 ], broken ), ( 'ctffind4', [ 0 ], good ) ], max_files=2 )
+    finish( workers )
+    failed = gpudispatch.failed_files( workers )
+    assert len ( failed ) <= 2
+    assert sorted ( failed + processed( tmpdir ) ) == sorted ( files )
+
+def test_dispatch_mixed ( tmpdir, stand_in ) :
+    files = micrographs( tmpdir, [ 1000 ] * 30 )
+    workers = gpudispatch.dispatch_mixed( files, [ ( 'gctf', [ 0, 1 ], recording( stand_in, [] ) ),
+                                                   ( 'ctffind4', [ 0, 1, 2 ], recording( stand_in, [] ) ) ] )
+    finish( workers )
+    done = gpudispatch.files_by_kind( workers )
+    assert sorted ( done['gctf'] + done['ctffind4'] ) == sorted ( files )
+    assert sorted ( processed( tmpdir ) ) == sorted ( files )
+    assert gpudispatch.failed_files( workers ) == []
@@ -0,0 +1,96 @@
+import os, json, time, threading, subprocess, sys
+import pytest
+import gpulease
+
+@pytest.fixture
+def host ( tmpdir ) :
+    ## a host with 4 fake GPUs ( one empty file each ) and an empty lease directory
+    devices = tmpdir.mkdir( 'gpus' )
+    for i in range ( 4 ) :
+        devices.ensure( '0000:%02d:00.0' % i )
+    leases = []
+    def acquire ( ngpu=0, ncpu=1, **kwargs ) :
+        kwargs.setdefault( 'total_cores', 8 )
+        lease = gpulease.acquire( ngpu, ncpu, 'test', directory=str ( tmpdir.join( 'leases' ) ), device_dir=str ( devices ), **kwargs )
+        leases.append( lease )
+        return lease
+    acquire.directory = str ( tmpdir.join( 'leases' ) )
+    yield acquire
+    for lease in leases :
+        lease.release()
+
+def dead_pid () :
+    proc = subprocess.Popen( [ sys.executable, '-c', 'pass' ] )
+    proc.wait()
+    return proc.pid
+
+def test_devices ( tmpdir ) :
+    assert gpulease.devices( str ( tmpdir.join( 'none' ) ) ) == []
+    tmpdir.ensure( 'gpus', 'a' )
+    tmpdir.ensure( 'gpus', 'b' )
+    assert gpulease.devices( str ( tmpdir.join( 'gpus' ) ) ) == [ 0, 1 ]
+
+def test_disjoint_gpus ( host ) :
+    first = host( 2 )
+    second = host( 2 )
+    assert len ( first.gpus ) == 2 and len ( second.gpus ) == 2
+    assert not set ( first.gpus ) & set ( second.gpus )
+    assert sorted ( gpulease.holders( host.directory ) ) == sorted ( [ first.key, second.key ] )
+
+def test_timeout_when_all_gpus_are_held ( host ) :
+    first = host( 0 )
+    assert first.gpus == [ 0, 1, 2, 3 ]
+    started = time.time()
+    second = host( 0, wait=0 )
+    assert second.gpus == []
+    assert time.time() - started < gpulease.WAIT_POLL
+
+def test_wait_for_a_released_gpu ( host, monkeypatch ) :
+    monkeypatch.setattr( gpulease, 'WAIT_POLL', 0.05 )
+    first = host( 0 )
+    got = []
+    waiting = threading.Thread( target=lambda : got.append( host( 1 ) ) )
+    waiting.start()
+    time.sleep( 0.3 )
+    assert not got
+    first.release()
+    waiting.join( 10 )
+    assert len ( got ) == 1 and len ( got[0].gpus ) == 1
+
+def write_registry ( directory, leases ) :
+    if not os.path.isdir( directory ) :
+        os.makedirs( directory )
+    with open( os.path.join( directory, 'leases.json' ), 'w' ) as f :
+        json.dump( leases, f )
+
+def test_dead_and_expired_leases_are_dropped ( host ) :
+    now = time.time()
+    write_registry( host.directory, {
+        'dead' : dict ( pid=dead_pid(), user='u', program='p', gpus=[ 0, 1 ], cores=4, started=now, expires=now + 600 ),
+        'expired' : dict ( pid=os.getpid(), user='u', program='p', gpus=[ 2, 3 ], cores=4, started=now - 600, expires=now - 1 ) } )
+    assert gpulease.holders( host.directory ) == {}
+    assert host( 0 ).gpus == [ 0, 1, 2, 3 ]
+
+def test_core_budget ( host ) :
+    first = host( 1, 6 )
+    second = host( 1, 6 )
+    third = host( 1, 0 )
+    assert first.cores == 6
+    assert second.cores == 2
+    ## nothing left, a run still gets a core
+    assert third.cores == 1
+
+def test_release_gives_the_devices_back ( host ) :
+    first = host( 0, 8 )
+    first.release()
+    assert gpulease.holders( host.directory ) == {}
+    second = host( 0, 8 )
+    assert second.gpus == [ 0, 1, 2, 3 ]
+    assert second.cores == 8
+
+def test_renew_pushes_the_expiry ( host ) :
+    lease = host( 1, ttl=60 )
+    before = gpulease.holders( host.directory )[lease.key]['expires']
+    time.sleep( 0.01 )
+    lease.renew()
+    assert gpulease.holders( host.directory )[lease.key]['expires'] > before
@@ -0,0 +1,19 @@
+import time
+import jobwatch, gpudispatch
+
+def test_no_procs_and_no_outputs ( tmpdir ) :
+    ## a dispatch over no GPUs gives no workers, the wait must not poll for ever
+    tmpdir.ensure( 'a.ctf' )
+    workers = gpudispatch.dispatch( [ 'a.mrc', 'b.mrc' ], [], lambda batch, gpu, number : 'true' )
+    assert workers == []
+    started = time.time()
+    codes = jobwatch.wait_for_outputs( str ( tmpdir.join( '*.ctf' ) ), 2, workers )
+    assert codes == []
+    assert time.time() - started < 5
+
+def test_outputs_already_there ( tmpdir ) :
+    for name in ( 'a.ctf', 'b.ctf' ) :
+        tmpdir.ensure( name )
+    tracker = jobwatch.CompletionTracker( str ( tmpdir.join( '*.ctf' ) ), 2, expected=[ 'a.ctf', 'b.ctf' ] )
+    tracker.wait()
+    assert tracker.count() == 2
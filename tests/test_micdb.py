@@ -0,0 +1,33 @@
+import micdb
+
+def test_stem () :
+    assert micdb.stem( 'data/FoilHole_1.frames.mrcs' ) == 'FoilHole_1'
+    assert micdb.stem( 'FoilHole_1.tif' ) == 'FoilHole_1'
+    assert micdb.stem( 'aligned/FoilHole_1_DW.mrc' ) == 'FoilHole_1_DW'
+    assert micdb.stem( 'Grid1.sq2_0001.mrc' ) == 'Grid1.sq2_0001'
+    assert micdb.stem( 'Grid1.sq2_0001.frames.tif' ) == 'Grid1.sq2_0001'
+
+def test_dotted_names_are_separate_micrographs ( tmpdir ) :
+    sources = [ tmpdir.ensure( 'Grid1.sq2_000%d.mrc' % i ) for i in ( 1, 2 ) ]
+    db = micdb.open_manifest( str ( tmpdir ) )
+    names = micdb.register( db, [ str ( s ) for s in sources ] )
+    assert names == [ 'Grid1.sq2_0001', 'Grid1.sq2_0002' ]
+    micdb.mark( db, names[:1], 'ctf' )
+    assert micdb.pending( db, names, 'ctf' ) == names[1:]
+
+def test_sum_and_dw_sum_are_separate_micrographs ( tmpdir ) :
+    ## makesum on a MotionCor2 output directory reads both sums
+    sources = [ str ( tmpdir.ensure( 'X.mrc' ) ), str ( tmpdir.ensure( 'X_DW.mrc' ) ) ]
+    db = micdb.open_manifest( str ( tmpdir ) )
+    names = micdb.register( db, sources )
+    assert names == [ 'X', 'X_DW' ]
+    assert micdb.names_for( db, sources ) == names
+    micdb.mark( db, names[:1], 'ctf' )
+    assert micdb.pending( db, names, 'ctf' ) == [ 'X_DW' ]
+
+def test_dw_sum_of_a_movie ( tmpdir ) :
+    ## the sums MotionCor2 wrote for a movie map back to it through the manifest
+    db = micdb.open_manifest( str ( tmpdir ) )
+    names = micdb.register( db, [ str ( tmpdir.ensure( 'Grid1.sq2_0002.frames.tif' ) ) ] )
+    micdb.update_many( db, 'dw', { names[0] : str ( tmpdir.join( 'aligned', 'Grid1.sq2_0002_DW.mrc' ) ) } )
+    assert micdb.names_for( db, [ 'aligned/Grid1.sq2_0002_DW.mrc' ] ) == [ 'Grid1.sq2_0002' ]
@@ -0,0 +1,39 @@
+import struct
+import numpy as np
+import mrcheader
+
+def write_bytes ( filename, pixels, imod_flags=None ) :
+    ## a mode 0 MRC, with the IMOD stamp and these flags when given
+    header = bytearray( mrcheader.pack_header( pixels.shape[1], pixels.shape[0], 1, 1.0, mode=0 ) )
+    if imod_flags is not None :
+        struct.pack_into( '<2i', header, 152, mrcheader.IMOD_STAMP, imod_flags )
+    with open( filename, 'wb' ) as f :
+        f.write( bytes ( header ) )
+        f.write( pixels.astype( np.uint8 ).tobytes() )
+
+def test_mode_0_is_signed_by_default ( tmpdir ) :
+    filename = str ( tmpdir.join( 'signed.mrc' ) )
+    write_bytes( filename, np.full( ( 4, 4 ), 200 ) )
+    h = mrcheader.read_header( filename )
+    assert not h.unsigned and mrcheader.dtype( h ) == '<i1'
+    assert mrcheader.read_image( filename )[0, 0] == 200 - 256
+
+def test_mode_0_unsigned_with_the_imod_flags ( tmpdir ) :
+    filename = str ( tmpdir.join( 'unsigned.mrc' ) )
+    write_bytes( filename, np.full( ( 4, 4 ), 200 ), imod_flags=0 )
+    h = mrcheader.read_header( filename )
+    assert h.unsigned and mrcheader.dtype( h ) == '<u1'
+    assert mrcheader.read_image( filename )[0, 0] == 200
+
+def test_mode_0_signed_bytes_flag ( tmpdir ) :
+    filename = str ( tmpdir.join( 'flagged.mrc' ) )
+    write_bytes( filename, np.full( ( 4, 4 ), 200 ), imod_flags=mrcheader.IMOD_SIGNED_BYTES )
+    assert mrcheader.dtype( mrcheader.read_header( filename ) ) == '<i1'
+
+def test_float_round_trip ( tmpdir ) :
+    filename = str ( tmpdir.join( 'float.mrc' ) )
+    image = np.arange( 12, dtype=np.float32 ).reshape( 3, 4 )
+    mrcheader.write_mrc( filename, image, 1.5 )
+    h = mrcheader.read_header( filename )
+    assert ( h.nx, h.ny, h.nz, h.mode, h.pixel_size, h.truncated ) == ( 4, 3, 1, 2, 1.5, False )
+    assert np.array_equal( mrcheader.read_image( filename ), image )
@@ -0,0 +1,50 @@
+import os, time, socket, subprocess, sys
+import staging
+
+HOST = 'node01.cluster.local'
+
+def dead_pid () :
+    ## the pid of a process that has exited
+    proc = subprocess.Popen( [ sys.executable, '-c', 'pass' ] )
+    proc.wait()
+    return proc.pid
+
+def work_dir ( parent, name='EM_01_Jan_2018_10_00_00AM' ) :
+    directory = parent.join( name )
+    directory.ensure( 'links', 'a.mrc' )
+    directory.ensure( 'gctf.log' )
+    return str ( directory )
+
+def test_tombstone_of_a_dotted_host ( monkeypatch ) :
+    monkeypatch.setattr( socket, 'gethostname', lambda : HOST )
+    name = staging.tombstone_name( 'EM_x.y', 1234 )
+    assert staging.tombstone_owner( name ) == ( HOST, 1234 )
+    assert staging.tombstone_parts( name ) == ( HOST, 1234, 'EM_x.y' )
+    assert staging.tombstone_owner( 'EM_x' ) is None
+    assert staging.tombstone_owner( staging.TOMBSTONE + 'node01.1234.EM_x' ) is None
+
+def test_reaper_deletes_the_tombstone_of_a_dotted_host ( tmpdir, monkeypatch ) :
+    monkeypatch.setattr( socket, 'gethostname', lambda : HOST )
+    directory = work_dir( tmpdir )
+    tombstone = str ( tmpdir.join( staging.tombstone_name( os.path.basename( directory ), dead_pid() ) ) )
+    os.rename( directory, tombstone )
+    staging.reaper( tombstone )
+    assert os.listdir( str ( tmpdir ) ) == []
+
+def test_reclaim_restarts_the_reaper_of_a_dead_run ( tmpdir, monkeypatch ) :
+    monkeypatch.setattr( socket, 'gethostname', lambda : HOST )
+    directory = work_dir( tmpdir )
+    os.rename( directory, str ( tmpdir.join( staging.tombstone_name( os.path.basename( directory ), dead_pid() ) ) ) )
+    assert staging.reclaim( str ( tmpdir ) ) == 1
+    deadline = time.time() + 30
+    while os.listdir( str ( tmpdir ) ) and time.time() < deadline :
+        time.sleep( 0.1 )
+    assert os.listdir( str ( tmpdir ) ) == []
+
+def test_reclaim_leaves_a_live_reaper_alone ( tmpdir, monkeypatch ) :
+    monkeypatch.setattr( socket, 'gethostname', lambda : HOST )
+    directory = work_dir( tmpdir )
+    tombstone = staging.tombstone_name( os.path.basename( directory ) )
+    os.rename( directory, str ( tmpdir.join( tombstone ) ) )
+    assert staging.reclaim( str ( tmpdir ) ) == 0
+    assert os.listdir( str ( tmpdir ) ) == [ tombstone ]
@@ -0,0 +1,120 @@
+## Micrograph triage on the ctf fits
+##
+## Every micrograph gets a robust z score ( distance from the median in MADs, the MAD scaled by
+## 1.4826 to a standard deviation ) for its mean defocus, astigmatism, CC, resolution limit and
+## the sum of its Gctf validation scores, for all micrographs at once with NumPy over a ctflog
+## table. Only the bad side counts: more astigmatism, a worse resolution, a lower CC or lower
+## validation scores, the defocus both ways. A micrograph more than OUTLIER_Z from the median in
+## any of them is rejected. The scores of a mixed table are taken per estimator, the CC of Gctf
+## and ctffind4 are not on the same scale. A score whose MAD is 0 ( more than half the values
+## the same, eg no validation scores ) is left out.
+##
+## micrographs_selected.star has the rows of the micrographs star that are kept,
+## micrographs_rejected.star the others with the reason; picking and extraction only use the
+## selected ones.
+
+import os, collections
+import numpy as np
+import relionstar, ctflog
+
+OUTLIER_Z = 3.5
+## with fewer micrographs nothing is rejected, the median is not worth much
+TRIAGE_MIN = 8
+MAD_SCALE = 1.4826
+SELECTED = 'micrographs_selected.star'
+REJECTED = 'micrographs_rejected.star'
+## score : side that is bad, 1 high, -1 low, 0 both
+SIDES = collections.OrderedDict( [ ( 'defocus', 0 ), ( 'astigmatism', 1 ), ( 'ccc', -1 ), ( 'resolution', 1 ), ( 'validation', -1 ) ] )
+## micrographs star label : ctflog field
+STAR_FIELDS = ( ( 'rlnDefocusU', 'defocus_u' ), ( 'rlnDefocusV', 'defocus_v' ), ( 'rlnDefocusAngle', 'defocus_angle' ),
+                ( 'rlnCtfFigureOfMerit', 'ccc' ), ( 'rlnCtfMaxResolution', 'resolution' ) )
+
+def metrics ( table ) :
+    ## { score : values } of a ctflog table
+    names = table.dtype.names
+    values = collections.OrderedDict()
+    values['defocus'] = ( table['defocus_u'] + table['defocus_v'] ) / 2
+    values['astigmatism'] = np.abs( table['defocus_u'] - table['defocus_v'] )
+    values['ccc'] = table['ccc'].astype( np.float64 )
+    values['resolution'] = table['resolution'].astype( np.float64 )
+    fields = [ f for f in ctflog.VALIDATION_FIELDS if f in names ]
+    if fields :
+        values['validation'] = np.sum( [ table[f] for f in fields ], axis=0 ).astype( np.float64 )
+    return values
+
+def robust_z ( values ) :
+    ## ( x - median ) / ( 1.4826 MAD ), nan where the value is missing or the MAD is 0
+    values = np.asarray( values, dtype=np.float64 )
+    z = np.full( len ( values ), np.nan )
+    finite = np.isfinite( values )
+    if finite.sum() < TRIAGE_MIN :
+        return z
+    median = np.median( values[finite] )
+    mad = MAD_SCALE * np.median( np.abs( values[finite] - median ) )
+    if mad > 0 :
+        z[finite] = ( values[finite] - median ) / mad
+    return z
+
+def scores ( table ) :
+    ## { score : robust z with the bad side positive }, per estimator for a mixed table
+    groups = [ np.ones( len ( table ), dtype=bool ) ]
+    if 'estimator' in table.dtype.names :
+        groups = [ table['estimator'] == e for e in np.unique( table['estimator'] ) ]
+    result = collections.OrderedDict()
+    for name, values in metrics( table ).items() :
+        z = np.full( len ( table ), np.nan )
+        for rows in groups :
+            z[rows] = robust_z( values[rows] )
+        side = SIDES[name]
+        result[name] = np.abs( z ) if side == 0 else side * z
+    return result
+
+def select ( table, z=OUTLIER_Z ) :
+    ## ( keep, reasons ) for the rows of a ctflog table, the reason is the scores that are too far off
+    z_scores = scores( table )
+    reasons = [ [] for i in range ( len ( table ) ) ]
+    keep = np.ones( len ( table ), dtype=bool )
+    for name, values in z_scores.items() :
+        bad = np.nan_to_num( values ) > z
+        keep &= ~bad
+        for i in np.nonzero( bad )[0] :
+            reasons[i].append( name )
+    return keep, [ ','.join( r ) for r in reasons ]
+
+def from_star ( star, directory='.' ) :
+    ## a ctflog table of a micrographs star ( loop ), with the validation scores of the Gctf logs
+    ## next to the micrographs when there are any
+    stems = np.array( [ os.path.splitext( os.path.basename( str ( m ) ) )[0] for m in star['rlnMicrographName'] ], dtype=str )
+    columns = [ ( 'micrograph', stems ) ]
+    columns += [ ( field, star[label].astype( np.float64 ) ) for label, field in STAR_FIELDS ]
+    logs = [ os.path.join( directory, s + '_gctf.log' ) for s in stems ]
+    logs = [ l for l in logs if os.path.exists( l ) ]
+    if logs :
+        parsed = ctflog.parse_logs( logs, 'gctf' )
+        rows = dict ( ( str ( m ), i ) for i, m in enumerate ( parsed['micrograph'] ) )
+        for field in ctflog.VALIDATION_FIELDS :
+            columns.append( ( field, np.array( [ parsed[field][rows[s]] if s in rows else 0 for s in stems ], dtype=np.int32 ) ) )
+    return relionstar.make_table( columns )
+
+def write_stars ( star, keep, reasons, selected=SELECTED, rejected=REJECTED ) :
+    ## the rows of a micrographs star that are kept and the others, with the reason
+    relionstar.write_loop( selected, star[keep] )
+    relionstar.write_loop( rejected, relionstar.with_column( star[~keep], 'emTriageReason', np.array( [ r for r, k in zip( reasons, keep ) if not k ], dtype=str ) ) )
+    return int ( keep.sum() ), int ( ( ~keep ).sum() )
+
+def triage_star ( filename, selected=SELECTED, rejected=REJECTED, z=OUTLIER_Z ) :
+    ## micrographs_ctf.star -> micrographs_selected.star and micrographs_rejected.star, returns the
+    ## names of the selected micrographs and the rejected rows with the reason
+    blocks = relionstar.read_star( filename )
+    star = blocks[relionstar.default_block( blocks )]
+    keep, reasons = select( from_star( star, os.path.dirname( filename ) or '.' ), z )
+    write_stars( star, keep, reasons, selected, rejected )
+    return [ str ( m ) for m in star['rlnMicrographName'][keep] ], [ ( str ( m ), r ) for m, r, k in zip( star['rlnMicrographName'], reasons, keep ) if not k ]
+
+def report ( rejected, total, filename=REJECTED, shown=20 ) :
+    ## what the scripts print, the first few rejected micrographs
+    print ('\nTriage:', total - len ( rejected ), 'of', total, 'micrographs selected, the others are in', filename )
+    for micrograph, reason in rejected[:shown] :
+        print ( '  ' + micrograph + ' : ' + reason )
+    if len ( rejected ) > shown :
+        print ( '  ...', len ( rejected ) - shown, 'more' )